@@ -1,12 +1,9 @@
-
 import logging
-import requests
 import tornado, json
-from concurrent.futures import ThreadPoolExecutor
-from tornado.concurrent import run_on_executor
 
-from pybragi.server.loadbalance import roundrobin, hash_balance
-from pybragi.server.dao_server_discovery import get_server_online
+from pybragi.server import health_check
+from pybragi.server.async_loadbalance import AsyncLoadBalanceClient
+from pybragi.server.dao_server_discovery import aget_server_online
 from pybragi.base.metrics import PrometheusMixIn
 from pybragi.base.base_handler import CORSBaseHandler
 
@@ -14,52 +11,49 @@ from pybragi.base.base_handler import CORSBaseHandler
 rvc_name = "rvc_infer"
 seed_name = "seed_infer"
 
+# 后台探测下游健康状态 转发路径不再同步请求 /health
+health_prober = health_check.start_health_prober(rvc_name, seed_name)
+
+# 在 ioloop 上转发 不再受线程池大小限制
+roundrobin_client = AsyncLoadBalanceClient(strategy="roundrobin", request_timeout=1, health_prober=health_prober)
+hash_client = AsyncLoadBalanceClient(strategy="hash", request_timeout=10, health_prober=health_prober)
+
 
 class ForwardTransmit(PrometheusMixIn, CORSBaseHandler):
-    executor = ThreadPoolExecutor(40)
 
-    @run_on_executor
-    def get(self):
+    async def get(self):
         path = self.request.path
         if path == "/v1/rvc/get_model_list":
-            servers = get_server_online(rvc_name)
-            host = roundrobin(servers)
-            resp = requests.get(f"{host}/api/get_model_list", timeout=1)
-            return self.write(resp.json())
+            servers = await aget_server_online(rvc_name)
+            return self.write(await roundrobin_client.fetch_json(servers, "/api/get_model_list", hedge=True))
         elif path == "/v1/seed/get_model_list":
-            servers = get_server_online(seed_name)
-            host = roundrobin(servers)
-            resp = requests.get(f"{host}/api/get_model_list", timeout=1)
-            return self.write(resp.json())
+            servers = await aget_server_online(seed_name)
+            return self.write(await roundrobin_client.fetch_json(servers, "/api/get_model_list", hedge=True))
         return self.write({"ret": -1, "msg": "invalid request path"})
 
-    @run_on_executor
-    def post(self):
+    async def post(self):
         path = self.request.path
-        logging.info(f"{path} request:{self.request.body}")
-        task = json.loads(self.request.body)
+        task = self.json_body()
         mid = task.get("mid", "0")
 
         if "rvc" in path:
-            servers = get_server_online(rvc_name)
-            host = hash_balance(servers, mid)
+            servers = await aget_server_online(rvc_name)
         elif "seed" in path:
-            servers = get_server_online(seed_name)
-            host = hash_balance(servers, mid)
+            servers = await aget_server_online(seed_name)
         else:
             return self.write({"ret": -1, "msg": "invalid request path"})
-        
+
 
         if path == "/v1/rvc/load_model":
-            resp = requests.post(f"{host}/api/load_model", json=task, timeout=10)
+            api = "/api/load_model"
         elif path == "/v1/rvc/infer_rvc":
-            resp = requests.post(f"{host}/api/infer_rvc", json=task, timeout=10)
+            api = "/api/infer_rvc"
         elif path == "/v1/seed/reference_audio":
-            resp = requests.post(f"{host}/api/reference_audio", json=task, timeout=10)
+            api = "/api/reference_audio"
         elif path == "/v1/seed/infer_seed":
-            resp = requests.post(f"{host}/api/infer_seed", json=task, timeout=10)
+            api = "/api/infer_seed"
         else:
             return self.write({"ret": -1, "msg": "invalid request path"})
-        
-        return self.write(resp.json())
-        
+
+        resp = await hash_client.fetch_json(servers, api, method="POST", json_body=task, key=str(mid))
+        return self.write(resp)
@@ -26,7 +26,8 @@ from pybragi.base import base_handler, ps
 from pybragi.base.species_queue import (
     global_exit_event
 )
-from pybragi.server.dao_server_discovery import register_server, unregister_server
+from pybragi.server.dao_server_discovery import Heartbeat
+from pybragi.server import discovery_cache
 
 global_exit_event()
 
@@ -41,7 +42,7 @@ from pybragi.base.base_handler import CORSBaseHandler
 def handle_exit_signal(signum, frame):
     logging.info("Received exit signal. Setting exit event.")
     if Config.Online:
-        unregister_server(ps.get_ipv4(), Config.Port, Config.Name)
+        heartbeat.unregister(ps.get_ipv4(), Config.Port, Config.Name)
     # 退出web server线程 先关闭生产线程
     tornado_ioloop = ioloop.IOLoop.current()
     tornado_ioloop.add_callback_from_signal(tornado_ioloop.stop)
@@ -49,6 +50,8 @@ def handle_exit_signal(signum, frame):
     global_exit_event().set()  # 再用信号退出消费线程
 
 
+heartbeat = Heartbeat()
+
 signal.signal(signal.SIGINT, handle_exit_signal)
 signal.signal(signal.SIGTERM, handle_exit_signal)
 
@@ -61,7 +64,9 @@ def run_tornado_app(app: web.Application, port=37000):
     server1.listen(port)
 
     if Config.Online:
-        register_server(ps.get_ipv4(), Config.Port, Config.Name)
+        # 带 ttl 注册并后台续期 进程崩溃后自动从在线列表消失
+        heartbeat.register(ps.get_ipv4(), Config.Port, Config.Name)
+        heartbeat.start()
 
     ioloop.IOLoop.current().start()
 
@@ -94,6 +99,9 @@ if __name__ == "__main__":
             (r"/v1/rvc/infer_rvc", forward_transmit.ForwardTransmit),
         ],
     )
+    # 后台维护在线列表缓存 转发路径不再查询 mongo
+    discovery_cache.start_discovery_cache()
+
     logging.info(f"server start, port:{Config.Port}")
     run_tornado_app(app, Config.Port)
 
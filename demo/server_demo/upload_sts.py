@@ -23,7 +23,7 @@ class Echo2(PrometheusMixIn):
 
     @run_on_executor
     def post(self):
-        request_body = json.loads(self.request.body)
+        request_body = self.json_body()
         return self.write(request_body)
     
     @run_on_executor
@@ -1,5 +1,7 @@
 import numpy as np
 
+from pybragi.base.sketch import DDSketch, load_sketches, merge_sketches
+
 def parse_infer_delta(data, tag=""):
     print(f"========== {tag} ==========")
     percentiles = np.percentile(data, [10, 30, 50, 80, 90, 95, 99])
@@ -19,13 +21,41 @@ def parse_infer_delta(data, tag=""):
 
     print(info)
 
+
+def parse_sketch(sketch: DDSketch, tag=""):
+    """同 parse_infer_delta  数据来自 DDSketch (相对误差 relative_accuracy)  多个进程/多次压测 merge 后使用"""
+    print(f"========== {tag} ==========")
+    percentiles = sketch.quantiles([0.1, 0.3, 0.5, 0.8, 0.9, 0.95, 0.99])
+
+    info = """
+    ## {:}  sum: {:.3f}  median: {:.3f} max: {:.3f}
+    | len | mean   | p10    | p30    | p50    | p80    | p90    | p95    | p99    |
+    |-----|--------|--------|--------|--------|--------|--------|--------|--------|
+    | {:.1f} | {:.3f} | {:.3f} | {:.3f} | {:.3f} | {:.3f} | {:.3f} | {:.3f} | {:.3f} |
+    """.format(tag, sketch.sum, percentiles[2], sketch.max, sketch.count, sketch.mean, \
+            percentiles[0], percentiles[1], percentiles[2], percentiles[3], percentiles[4], percentiles[5], percentiles[6]
+        )
+
+    print(info)
+
+
 if __name__ == "__main__":
     import argparse
     parser = argparse.ArgumentParser()
-    parser.add_argument("-d", "--data", type=str, required=True)
+    parser.add_argument("-d", "--data", type=str, default="")
+    parser.add_argument("-s", "--sketch", type=str, action="append", default=[], help="sketch json file, repeat to merge")
     parser.add_argument("-t", "--tag", type=str, default="")
     args = parser.parse_args()
 
+    if args.sketch:
+        sketches = {}
+        for path in args.sketch:
+            for name, sketch in load_sketches(path).items():
+                sketches.setdefault(name, []).append(sketch)
+        for name, items in sketches.items():
+            parse_sketch(merge_sketches(items), f"{args.tag} {name}".strip())
+        exit()
+
     data = np.array([float(x) for x in args.data.strip(',').split(',')])
     print(f"view first 10: {data[:10]}")
     parse_infer_delta(data, args.tag)
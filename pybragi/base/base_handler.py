@@ -7,7 +7,7 @@ from typing import Callable, Optional
 from tornado import web, ioloop
 
 import asyncio
-from pybragi.base import metrics, ps
+from pybragi.base import loop_monitor, metrics, metrics_multiprocess, ps
 from pybragi.bragi_config import BragiConfig
 from pybragi.base.shutdown import global_exit_event
 
@@ -77,8 +77,17 @@ class CORSBaseHandler(web.RequestHandler):
         self.finish()
 
 
-def make_tornado_web(service: str, big_latency=False, kafka=False):
-    metrics_manager = metrics.MetricsManager(service, big_latency, kafka)
+# multiprocess: 多个 worker 进程共用端口时 /metrics 汇总所有进程  None 表示设置了 PROMETHEUS_MULTIPROC_DIR 时自动开启
+# 需要在 fork worker 之前调用
+# monitor_loop: 统计 ioloop 调度延迟  阻塞超过 block_threshold 时打印 loop 线程栈  参数见 loop_monitor.enable_loop_monitor
+# latency_sketch: 请求时延额外以 DDSketch summary 导出分位数  见 MetricsManager
+def make_tornado_web(service: str, big_latency=False, kafka=False, multiprocess: Optional[bool] = None,
+                     monitor_loop=False, block_threshold=0.5, latency_sketch=False):
+    if multiprocess or (multiprocess is None and metrics_multiprocess.configured_dir()):
+        metrics_multiprocess.enable_multiprocess()
+    if monitor_loop:
+        loop_monitor.enable_loop_monitor(block_threshold=block_threshold)
+    metrics_manager = metrics.MetricsManager(service, big_latency, kafka, latency_sketch=latency_sketch)
     metrics.register_metrics(metrics_manager)
     app = web.Application(
         [
@@ -95,12 +104,16 @@ def run_tornado_app(app: web.Application, port=8888, ipv4 = ps.get_ipv4()):
     asyncio.set_event_loop(loop)
     
     app.listen(port)
+    if loop_monitor.get_monitor():
+        loop_monitor.get_monitor().attach(loop)
 
     logging.info(f"Tornado app started on port http://0.0.0.0:{port} ipv4: {ipv4}")
     ioloop.IOLoop.current().start()
 
 async def run_tornado_app_async(app: web.Application, port=8888, ipv4 = ps.get_ipv4()):
     app.listen(port)
+    if loop_monitor.get_monitor():
+        loop_monitor.get_monitor().attach(asyncio.get_running_loop())
     
     logging.info(f"Tornado app started on port http://0.0.0.0:{port} ipv4: {ipv4}")
     await asyncio.Future()
@@ -142,13 +155,12 @@ if __name__ == "__main__":
 
     async def exit_func(start_time: datetime):
         global_exit_event().set()
-        while metrics.active_handlers:
-            for handler_type, handlers in metrics.active_handlers.items():
-                logging.info(f"{handler_type} length: {len(handlers)}")
-                for handler in handlers:
-                    handler: metrics.PrometheusMixIn
-                    logging.info(f"handler: {handler.bragi_connection_info()}")
-            await asyncio.sleep(0.5)
+        while not await metrics.active_requests.wait_drained(timeout=5):
+            for handler_type, count in metrics.active_requests.class_counts.items():
+                logging.info(f"{handler_type} length: {count}")
+            for handler in metrics.active_requests.snapshot():
+                handler: metrics.PrometheusMixIn
+                logging.info(f"handler: {handler.bragi_connection_info()}")
         
         logging.info(f"server start_time: {start_time}, duration: {datetime.now() - start_time}")
         ioloop.IOLoop.current().stop()
@@ -1,3 +1,4 @@
+import hashlib
 
 
 def djb2_hash(s: str) -> int:
@@ -7,3 +8,7 @@ def djb2_hash(s: str) -> int:
         hash = ((hash << 5) + hash) + ord(c)  # hash * 33 + c
     return hash & 0x7FFFFFFF  # Keep it positive
 
+
+# ketama 风格 取 md5 前 8 字节 分布比 djb2 均匀 用于一致性哈希环
+def md5_hash(s: str) -> int:
+    return int.from_bytes(hashlib.md5(str(s).encode("utf-8")).digest()[:8], "big")
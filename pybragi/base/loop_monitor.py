@@ -0,0 +1,181 @@
+import asyncio
+import logging
+import os
+import sys
+import threading
+import time
+import traceback
+import weakref
+from typing import Optional
+
+from pybragi.base import metrics
+from pybragi.base.shutdown import global_exit_event
+
+
+# ioloop 阻塞检测  health 超时最常见的原因是 ioloop 被同步调用阻塞
+# 1. 每 interval 秒调度一次回调  实际执行时间与预期时间之差即 loop lag  记入 ioloop_lag
+# 2. watchdog 线程检查回调是否按时执行  超过 block_threshold 说明 loop 被阻塞  抓取 loop 线程当前栈打日志 记入 ioloop_blocked
+# 3. PrometheusMixIn 的请求协程每一步在 loop 上的执行时间  按 handler 类记入 handler_loop_seconds
+# 每个 loop 在第一次请求或 run_tornado_app 时接入  fork 之后的 worker 各自启动 watchdog
+
+
+class _LoopState:
+    __slots__ = ("loop", "thread_id", "name", "expected", "blocked_since", "current", "__weakref__")
+
+    def __init__(self, loop: asyncio.AbstractEventLoop):
+        self.loop = loop
+        self.thread_id = threading.get_ident()
+        self.name = threading.current_thread().name
+        self.expected = time.monotonic()
+        self.blocked_since = 0.0 # 已上报的阻塞开始时间  0 表示未阻塞
+        self.current = None # 正在 loop 上执行的 handler
+
+
+class _TimedCoroutine:
+    """包装 handler._execute 协程  统计每一步 send/throw 的耗时 即该请求占用 loop 的时间"""
+    __slots__ = ("coro", "handler", "state", "monitor", "elapsed")
+
+    def __init__(self, coro, handler, state: _LoopState, monitor: "LoopMonitor"):
+        self.coro = coro
+        self.handler = handler
+        self.state = state
+        self.monitor = monitor
+        self.elapsed = 0.0
+
+    def __await__(self):
+        return self
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return self._step(self.coro.send, None)
+
+    def send(self, value):
+        return self._step(self.coro.send, value)
+
+    def throw(self, *args):
+        return self._step(self.coro.throw, *args)
+
+    def close(self):
+        return self.coro.close()
+
+    def _step(self, func, *args):
+        state = self.state
+        previous, state.current = state.current, self.handler
+        start = time.perf_counter()
+        done = True
+        try:
+            result = func(*args)
+            done = False
+            return result
+        finally:
+            self.elapsed += time.perf_counter() - start
+            state.current = previous
+            if done:
+                self.monitor.record_handler(self.handler, self.elapsed)
+
+
+class LoopMonitor:
+    def __init__(self, interval: float = 0.1, block_threshold: float = 0.5, stack_limit: int = 30, asyncio_debug: bool = False):
+        self.interval = interval
+        self.block_threshold = block_threshold
+        self.stack_limit = stack_limit
+        self.asyncio_debug = asyncio_debug # asyncio 自带的慢回调日志 (slow_callback_duration)  开销较大 默认关闭
+
+        self.states = weakref.WeakKeyDictionary() # loop -> _LoopState
+        self.lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+        self._pid = 0
+
+    def attach(self, loop: Optional[asyncio.AbstractEventLoop] = None) -> _LoopState:
+        """在 loop 所在线程调用  重复调用返回同一个 state"""
+        loop = loop or asyncio.get_event_loop()
+        state = self.states.get(loop)
+        if state is not None:
+            return state
+
+        with self.lock:
+            state = self.states.get(loop)
+            if state is None:
+                state = self.states[loop] = _LoopState(loop)
+                if self.asyncio_debug:
+                    loop.set_debug(True)
+                    loop.slow_callback_duration = self.block_threshold
+                state.expected = time.monotonic() + self.interval
+                loop.call_later(self.interval, self._tick, state)
+                logging.info(f"loop monitor attached: {state.name} interval:{self.interval} block_threshold:{self.block_threshold}")
+            self._ensure_thread()
+        return state
+
+    def _tick(self, state: _LoopState):
+        now = time.monotonic()
+        lag = max(now - state.expected, 0.0)
+        mgr = metrics.get_metrics_manager()
+        if mgr:
+            mgr.ioloop_lag.labels(mgr.server_name, state.name).observe(lag)
+        if state.blocked_since:
+            logging.warning(f"ioloop {state.name} unblocked, lag:{lag:.3f}s")
+            state.blocked_since = 0.0
+
+        state.expected = now + self.interval
+        state.loop.call_later(self.interval, self._tick, state)
+
+    def _check(self, state: _LoopState, now: float):
+        blocked = now - state.expected
+        if blocked < self.block_threshold or state.blocked_since or not state.loop.is_running():
+            return
+        state.blocked_since = now
+
+        handler = state.current
+        handler_name = type(handler).__name__ if handler is not None else ""
+        frame = sys._current_frames().get(state.thread_id)
+        stack = "".join(traceback.format_stack(frame, limit=self.stack_limit)) if frame else ""
+        if handler is not None:
+            handler_name = f"{handler_name} {handler.request.method} {handler.request.path}"
+        logging.warning(f"ioloop {state.name} blocked {blocked:.3f}s handler:[{handler_name}]\n{stack}")
+
+        mgr = metrics.get_metrics_manager()
+        if mgr:
+            mgr.ioloop_blocked.labels(mgr.server_name, state.name, type(handler).__name__ if handler is not None else "").inc()
+
+    def _run(self):
+        step = min(self.block_threshold / 2, self.interval)
+        while not global_exit_event().wait(step):
+            now = time.monotonic()
+            for state in list(self.states.values()):
+                try:
+                    self._check(state, now)
+                except Exception as e:
+                    logging.error(f"loop monitor check failed: {e}")
+
+    def _ensure_thread(self):
+        # fork 之后子进程里线程已不存在  按 pid 重新启动
+        if self._thread is not None and self._thread.is_alive() and self._pid == os.getpid():
+            return
+        self._pid = os.getpid()
+        self._thread = threading.Thread(target=self._run, name="loop_monitor", daemon=True)
+        self._thread.start()
+
+    def wrap(self, handler, coro):
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            return coro
+        state = self.states.get(loop) or self.attach(loop)
+        return _TimedCoroutine(coro, handler, state, self)
+
+    def record_handler(self, handler, elapsed: float):
+        mgr = metrics.get_metrics_manager()
+        if mgr:
+            mgr.handler_loop_seconds.labels(mgr.server_name, type(handler).__name__).inc(elapsed)
+
+
+def get_monitor() -> Optional[LoopMonitor]:
+    return metrics.loop_monitor
+
+
+def enable_loop_monitor(interval: float = 0.1, block_threshold: float = 0.5, stack_limit: int = 30, asyncio_debug: bool = False) -> LoopMonitor:
+    if metrics.loop_monitor is None:
+        metrics.loop_monitor = LoopMonitor(interval, block_threshold, stack_limit, asyncio_debug)
+    return metrics.loop_monitor
@@ -1,15 +1,25 @@
 #!/usr/bin/env python3
 # -*- coding:utf-8 -*-
+import asyncio
+import bisect
+import gzip
 import json
 import logging
+import math
+import random
+import threading
 import time
 import weakref
+from array import array
+from typing import Callable, Dict, List, Optional, Tuple
 import prometheus_client as pc
+from prometheus_client.exposition import choose_encoder
 from tornado import web
 from tornado.concurrent import run_on_executor
 from concurrent.futures import ThreadPoolExecutor
 
 from pybragi.base.shutdown import global_exit_event
+from pybragi.base.sketch import DDSketch, SketchSummary
 global_exit_event()
 
 class MetricsManager:
@@ -28,12 +38,15 @@ class MetricsManager:
         [3*i for i in range(50)]
     )
 
+    loop_lag_buckets = [0.001, 0.002, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30]
+
     service_label = ["service"]
     server_labels = [*service_label, "uri", "status"]
     task_queue_labels = [*service_label, "queue_type"] # ['priority', 'normal', 'batch',]
     speed_labels = [ "backend", ]  # ['vllm', 'sglang', 'transformer',]
 
-    def __init__(self, name: str, big_latency=False, kafka=False):
+    # latency_sketch: 额外用 DDSketch 记录请求时延和 token 间隔  以 summary 导出 p50/p90/p99  相对误差 1% 不受 bucket 划分限制
+    def __init__(self, name: str, big_latency=False, kafka=False, local_accumulate=False, latency_sketch=False):
         if big_latency:
             latency_buckets = MetricsManager.big_latency_buckets
         else:
@@ -48,8 +61,9 @@ class MetricsManager:
             buckets=latency_buckets,
         )
 
+        # multiprocess_mode 只在多进程模式生效 (metrics_multiprocess)  live* 在进程退出后不再计入
         self.task_queue_length = pc.Gauge(
-            "task_queue_length", "任务队列长度", MetricsManager.task_queue_labels
+            "task_queue_length", "任务队列长度", MetricsManager.task_queue_labels, multiprocess_mode="livesum"
         )
 
         self.caller_histogram = pc.Histogram(
@@ -90,6 +104,10 @@ class MetricsManager:
         self.max_itl_latency = pc.Histogram(
             "max_itl_latency", "max itl latency", MetricsManager.speed_labels, buckets=MetricsManager.latency_buckets
         )
+        self.p99_itl_latency = pc.Histogram(
+            "p99_itl_latency", "p99 itl latency", MetricsManager.speed_labels, buckets=MetricsManager.latency_buckets
+        )
+        self.token_stall = pc.Counter("token_stall", "token间隔超过StreamMetrics.stall_threshold的次数", MetricsManager.speed_labels)
         
 
         if kafka:
@@ -98,7 +116,7 @@ class MetricsManager:
                 "partition",
             ]
             self.kafka_lag = pc.Gauge(
-                "kafka_lag", "lag", kafka_labels
+                "kafka_lag", "lag", kafka_labels, multiprocess_mode="livemax"
             )
 
             batch_buckets = [1] + [i * 4 for i in range(1, 26)]
@@ -110,13 +128,194 @@ class MetricsManager:
 
             self.task_get_latency = pc.Histogram("task_total_latency", "获取任务-时延", ["topic"], buckets=latency_buckets)
 
-        self.remote_down = pc.Gauge("remote_down", "远端服务down", ["endpoint"])
+        self.hedge_request = pc.Counter(
+            "hedge_request", "对冲请求数量", [*MetricsManager.service_label, "url", "result"] # ['sent', 'won', 'lost', 'no_budget']
+        )
+
+        self.remote_down = pc.Gauge("remote_down", "远端服务down", ["endpoint"], multiprocess_mode="livemax")
+
+        self.mongo_pool_connections = pc.Gauge("mongo_pool_connections", "mongo连接池连接数", ["pool", "state"], multiprocess_mode="livesum") # ['open', 'checked_out']
+        self.mongo_pool_wait = pc.Histogram("mongo_pool_wait", "mongo连接池等待时延", ["pool"], buckets=latency_buckets)
+        self.mongo_pool_checkout_failed = pc.Counter("mongo_pool_checkout_failed", "mongo连接池获取失败", ["pool", "reason"])
+        self.mongo_write_dropped = pc.Counter("mongo_write_dropped", "WriteBehindBuffer在ioloop上缓冲满丢弃的文档", ["table"])
+
+        self.pg_pool_connections = pc.Gauge("pg_pool_connections", "postgre连接池连接数", ["pool", "state"], multiprocess_mode="livesum") # ['size', 'idle', 'max']
+        self.pg_acquire_wait = pc.Histogram("pg_acquire_wait", "postgre连接池等待时延", ["pool"], buckets=latency_buckets)
+        self.pg_query_latency = pc.Histogram("pg_query_latency", "postgre操作时延", ["pool", "op"], buckets=latency_buckets)
         self.except_cnt = pc.Counter("except_cnt", "异常数量", ["type", "except"])
 
         self.status = pc.Gauge(
-            "status", "状态值", ["type"]
+            "status", "状态值", ["type"], multiprocess_mode="livemax"
         )
 
+        self.scrape_duration = pc.Histogram(
+            "metrics_scrape_duration", "/metrics 渲染耗时", ["format"], buckets=MetricsManager.latency_buckets
+        )
+        self.scrape_cache = pc.Counter("metrics_scrape_cache", "/metrics 缓存命中", ["result"]) # ['hit', 'stale', 'render']
+        self.scrape_bytes = pc.Gauge("metrics_scrape_bytes", "/metrics 响应大小", ["format"], multiprocess_mode="livemax")
+
+        # loop_monitor
+        self.ioloop_lag = pc.Histogram("ioloop_lag", "ioloop调度延迟", [*MetricsManager.service_label, "loop"], buckets=MetricsManager.loop_lag_buckets)
+        self.ioloop_blocked = pc.Counter("ioloop_blocked", "ioloop阻塞次数", [*MetricsManager.service_label, "loop", "handler"])
+        self.handler_loop_seconds = pc.Counter("handler_loop_seconds", "请求占用ioloop时间", [*MetricsManager.service_label, "handler"])
+
+        self.active_requests = pc.Gauge(
+            "active_requests", "进行中的请求数", [*MetricsManager.service_label, "uri"], multiprocess_mode="livesum"
+        )
+
+        self.request_sketch: Optional[SketchSummary] = None
+        self.itl_sketch: Optional[SketchSummary] = None
+        if latency_sketch:
+            self.request_sketch = SketchSummary("httpsrv_latency_sketch", "http接口请求时延分位数", [*MetricsManager.service_label, "uri"])
+            self.itl_sketch = SketchSummary("itl_sketch", "token间隔分位数", MetricsManager.speed_labels)
+
+        self.request_recorder = RequestRecorder(self, local_accumulate)
+
+
+
+class RequestRecorder:
+    """http 请求指标的快速记录
+    (route, status) 对应的 child 只 labels() 一次 之后直接 observe/inc
+    local_accumulate=True 时每个线程先累加到本地 (count, sum, buckets)  抓取 /metrics 前由 flush 合并
+    热路径只有一次无竞争的加锁 不再经过 prometheus_client 每个 child 的锁
+    合并按 bucket 一次 inc  开销与请求数无关  bucket 边界取自 child._upper_bounds 与之保持一致
+    每个线程最多 flush_interval 秒自行合并一次  多进程模式下其他 worker 不会收到抓取请求
+    """
+    flush_interval = 1.0
+    def __init__(self, manager: "MetricsManager", local_accumulate: bool = False):
+        self.manager = manager
+        self.local_accumulate = local_accumulate
+        self.children: Dict[Tuple[str, int], tuple] = {}
+        self.upper_bounds: List[float] = []
+
+        self.local = threading.local()
+        self.accumulators: List[list] = [] # [lock, {(route, status): [count, sum, buckets, sketch]}, last_flush]
+        self.lock = threading.Lock()
+
+    def child(self, route: str, status: int) -> tuple:
+        key = (route, status)
+        children = self.children.get(key)
+        if children is None:
+            mgr = self.manager
+            histogram = mgr.request_histogram.labels(mgr.server_name, route, status)
+            sketch = mgr.request_sketch.labels(mgr.server_name, route) if mgr.request_sketch else None
+            children = self.children[key] = (histogram, mgr.request_qps.labels(mgr.server_name, route, status), sketch)
+            if not self.upper_bounds:
+                self.upper_bounds = list(histogram._upper_bounds)
+        return children
+
+    def record(self, route: str, status: int, latency: float):
+        if not self.local_accumulate:
+            histogram, qps, sketch = self.child(route, status)
+            histogram.observe(latency)
+            qps.inc()
+            if sketch:
+                sketch.observe(latency)
+            return
+
+        accumulator = getattr(self.local, "accumulator", None)
+        if accumulator is None:
+            accumulator = self.local.accumulator = [threading.Lock(), {}, time.monotonic()]
+            with self.lock:
+                self.accumulators.append(accumulator)
+        if not self.upper_bounds:
+            self.child(route, status)
+
+        with accumulator[0]:
+            entry = accumulator[1].get((route, status))
+            if entry is None:
+                sketch = DDSketch() if self.manager.request_sketch else None
+                entry = accumulator[1][(route, status)] = [0, 0.0, [0] * len(self.upper_bounds), sketch]
+            entry[0] += 1
+            entry[1] += latency
+            entry[2][bisect.bisect_left(self.upper_bounds, latency)] += 1
+            if entry[3] is not None:
+                entry[3].add(latency)
+
+        now = time.monotonic()
+        if now - accumulator[2] >= self.flush_interval:
+            accumulator[2] = now
+            self._merge(accumulator)
+
+    def _merge(self, accumulator: list):
+        with accumulator[0]:
+            pending = list(accumulator[1].items())
+            accumulator[1].clear()
+        for (route, status), (count, total, buckets, local_sketch) in pending:
+            histogram, qps, sketch = self.child(route, status)
+            if sketch and local_sketch is not None:
+                sketch.merge(local_sketch)
+            # prometheus_client 没有批量 observe  逐条 observe 会让 flush 变成 O(请求数) 卡住 loop
+            # 直接按 bucket 累加 child 的 sum 和 bucket 值 (多进程模式下同样是 mmap 值)
+            histogram._sum.inc(total)
+            for i, n in enumerate(buckets):
+                if n:
+                    histogram._buckets[i].inc(n)
+            qps.inc(count)
+
+    def flush(self):
+        with self.lock:
+            accumulators = list(self.accumulators)
+        for accumulator in accumulators:
+            self._merge(accumulator)
+
+
+# 路由归一化  避免动态 path (/v1/user/123) 让 uri 标签无限增长
+max_static_routes = 64
+_static_routes: Dict[type, set] = {}
+_route_patterns: Dict[type, List[Tuple[object, str]]] = {}
+
+
+def _collect_patterns(rules, handler_class, patterns: list):
+    for rule in rules:
+        target = rule.target
+        if hasattr(target, "rules"):
+            _collect_patterns(target.rules, handler_class, patterns)
+        elif target is handler_class and hasattr(rule.matcher, "regex"):
+            regex = rule.matcher.regex
+            patterns.append((regex, regex.pattern.rstrip("$")))
+
+
+def route_pattern(handler: web.RequestHandler) -> str:
+    handler_class = type(handler)
+    patterns = _route_patterns.get(handler_class)
+    if patterns is None:
+        patterns = []
+        application = handler.application
+        _collect_patterns(application.wildcard_router.rules, handler_class, patterns)
+        _collect_patterns(application.default_router.rules, handler_class, patterns)
+        _route_patterns[handler_class] = patterns
+
+    path = handler.request.path
+    for regex, pattern in patterns:
+        if regex.match(path):
+            return pattern
+    return "other"
+
+
+def route_of(handler: web.RequestHandler) -> str:
+    """handler.metrics_route 优先  默认使用匹配到的路由正则 标签数量等于路由数
+    handler.metrics_raw_path=True 时不带捕获组的请求使用原始 path  每个 handler 类最多 max_static_routes 个 超过后归到路由正则
+    """
+    route = getattr(handler, "metrics_route", None)
+    if route:
+        return route
+    if not getattr(handler, "metrics_raw_path", False) or handler.path_args or handler.path_kwargs:
+        return route_pattern(handler)
+
+    path = handler.request.path
+    routes = _static_routes.setdefault(type(handler), set())
+    if path in routes:
+        return path
+    if len(routes) < max_static_routes:
+        routes.add(path)
+        return path
+    return route_pattern(handler)
+
+
+def flush_metrics():
+    if metrics_manager is not None:
+        metrics_manager.request_recorder.flush()
 
 
 metrics_manager: MetricsManager = None
@@ -133,41 +332,283 @@ def register_metrics(manager: MetricsManager):
 
 
 
+class ExpositionCache:
+    """/metrics 渲染结果缓存  ttl 内的抓取直接返回缓存 (多个 prometheus 副本同时抓取只渲染一次)
+    有抓取时后台线程每 ttl 秒预先渲染  请求路径上基本不再执行 generate_latest
+    缓存过期但不超过 max_stale 时先返回旧结果再后台刷新  更旧时同步渲染 并发请求共享同一次渲染
+    按 Accept 区分 text/openmetrics  gzip 结果随渲染一起缓存
+    """
+    def __init__(self, ttl: float = 1.0, max_stale: float = 5.0, idle_after: float = 60.0, registry=pc.REGISTRY):
+        self.ttl = ttl
+        self.max_stale = max_stale
+        self.idle_after = idle_after # 超过该时间没有抓取 后台停止渲染
+        self.registry = registry
+        self.hooks: List[Callable[[], None]] = [flush_metrics] # 每次渲染前调用
+
+        self.cache: Dict[str, Tuple[float, bytes, bytes]] = {} # content_type -> (rendered_at, body, gzipped)
+        self.encoders: Dict[str, object] = {}
+        self.last_scrape: Dict[str, float] = {}
+        self.lock = threading.Lock()
+        self.render_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def render(self, content_type: str, min_age: Optional[float] = None) -> Tuple[float, bytes, bytes]:
+        with self.render_lock:
+            cached = self.cache.get(content_type)
+            if cached and time.monotonic() - cached[0] < (self.ttl if min_age is None else min_age):
+                return cached # 等锁期间已被其他线程渲染
+
+            start = time.perf_counter()
+            for hook in self.hooks:
+                hook()
+            body = self.encoders[content_type](self.registry)
+            entry = (time.monotonic(), body, gzip.compress(body, compresslevel=1))
+            self.cache[content_type] = entry
+
+            mgr = get_metrics_manager()
+            if mgr:
+                label = "openmetrics" if "openmetrics" in content_type else "text"
+                mgr.scrape_duration.labels(label).observe(time.perf_counter() - start)
+                mgr.scrape_bytes.labels(label).set(len(body))
+            return entry
+
+    def _count(self, result: str):
+        mgr = get_metrics_manager()
+        if mgr:
+            mgr.scrape_cache.labels(result).inc()
+
+    def lookup(self, accept: str) -> Tuple[str, Optional[Tuple[float, bytes, bytes]], bool]:
+        """返回 (content_type, 缓存, 是否需要同步渲染)  不渲染 可以在 ioloop 上调用"""
+        encoder, content_type = choose_encoder(accept)
+        now = time.monotonic()
+        with self.lock:
+            self.encoders.setdefault(content_type, encoder)
+            self.last_scrape[content_type] = now
+        self._ensure_thread()
+
+        cached = self.cache.get(content_type)
+        if cached is None or now - cached[0] >= self.max_stale:
+            return content_type, cached, True
+        if now - cached[0] >= self.ttl:
+            self._count("stale")
+            self._wakeup.set()
+        else:
+            self._count("hit")
+        return content_type, cached, False
+
+    def get(self, accept: str = "") -> Tuple[str, Tuple[float, bytes, bytes]]:
+        content_type, cached, need_render = self.lookup(accept)
+        if need_render:
+            self._count("render")
+            cached = self.render(content_type)
+        return content_type, cached
+
+    def _run(self):
+        while not global_exit_event().is_set():
+            # 提前半个 ttl 渲染  抓取方拿到的结果不超过 ttl
+            self._wakeup.wait(self.ttl / 2)
+            self._wakeup.clear()
+            now = time.monotonic()
+            with self.lock:
+                active = [content_type for content_type, last in self.last_scrape.items() if now - last < self.idle_after]
+            for content_type in active:
+                try:
+                    self.render(content_type, min_age=self.ttl / 2)
+                except Exception as e:
+                    logging.error(f"render metrics failed: {e}")
+            if not active:
+                with self.lock:
+                    if not any(now - last < self.idle_after for last in self.last_scrape.values()):
+                        self._thread = None
+                        return
+
+    def _ensure_thread(self):
+        if self._thread is not None:
+            return
+        with self.lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="metrics_render", daemon=True)
+                self._thread.start()
+
+
+exposition_cache = ExpositionCache()
+
+
 class MetricsHandler(web.RequestHandler):
     executor = ThreadPoolExecutor(1)
+    cache = exposition_cache
     def _log(self):
         return
 
     @run_on_executor
-    def get(self):
-        self.set_header("Content-Type", pc.CONTENT_TYPE_LATEST)
-        self.write(pc.generate_latest())
-
-
-def kv_for_show(body: dict):
-    ret = {}
-    for k, v in body.items():
-        if isinstance(v, dict):
-            ret[k] = kv_for_show(v)
-        else:
-            ret[k] = v if len(str(v)) < 200 else "..."
-    return ret
-
-
-active_handlers = weakref.WeakKeyDictionary()
+    def _render(self, content_type: str):
+        return self.cache.render(content_type)
+
+    async def get(self):
+        content_type, cached, need_render = self.cache.lookup(self.request.headers.get("Accept", ""))
+        if need_render:
+            self.cache._count("render")
+            cached = await self._render(content_type)
+
+        _, body, gzipped = cached
+        self.set_header("Content-Type", content_type)
+        self.set_header("Vary", "Accept, Accept-Encoding")
+        if "gzip" in self.request.headers.get("Accept-Encoding", ""):
+            self.set_header("Content-Encoding", "gzip")
+            body = gzipped
+        self.write(body)
+
+
+def _brief(v, limit: int):
+    # 只看长度 不对大字段做 str()  base64 图片/音频几 MB 时 str 和日志格式化都很慢
+    if isinstance(v, dict):
+        return kv_for_show(v, limit)
+    if isinstance(v, (list, tuple)):
+        if len(v) > 20:
+            return [_brief(item, limit) for item in v[:3]] + [f"...({len(v)})"]
+        return [_brief(item, limit) for item in v]
+    if isinstance(v, (str, bytes)):
+        return v if len(v) < limit else f"{v[:32]!r}...({len(v)})"
+    if v is None or isinstance(v, (int, float)):
+        return v
+    return type(v).__name__
+
+
+def kv_for_show(body: dict, limit: int = 200):
+    return {k: _brief(v, limit) for k, v in body.items()}
+
+
+class ActiveRequests:
+    """进行中的请求  add/discard 都是 O(1)  按 uri 计数导出 active_requests gauge
+    websocket 从握手到连接关闭都计入
+    只持有 handler 的弱引用  没有走到 on_finish/on_connection_close 的 handler 被回收时自动移除  不会卡住 wait_drained
+    退出时 await wait_drained() 等待全部 (或某个 handler 类) 结束  不需要轮询
+    """
+    def __init__(self):
+        self.handlers: Dict[int, tuple] = {} # id(handler) -> (weakref, uri, handler_class)
+        self.class_counts: Dict[type, int] = {}
+        self.gauges: Dict[str, object] = {}
+        self.waiters: List[tuple] = [] # (handler_class, loop, future)
+        self.lock = threading.RLock() # 弱引用回调可能在持锁时由 gc 触发
+
+    def __len__(self):
+        return len(self.handlers)
+
+    def count(self, handler_class: Optional[type] = None) -> int:
+        if handler_class is None:
+            return len(self.handlers)
+        return sum(n for cls, n in self.class_counts.items() if issubclass(cls, handler_class))
+
+    def snapshot(self, handler_class: Optional[type] = None) -> List[web.RequestHandler]:
+        with self.lock:
+            handlers = [entry[0]() for entry in self.handlers.values()]
+        return [handler for handler in handlers if handler is not None and (handler_class is None or isinstance(handler, handler_class))]
+
+    def _gauge(self, route: str):
+        gauge = self.gauges.get(route)
+        if gauge is None:
+            mgr = get_metrics_manager()
+            if mgr is None:
+                return None
+            gauge = self.gauges[route] = mgr.active_requests.labels(mgr.server_name, route)
+        return gauge
+
+    def add(self, handler: web.RequestHandler, route: str):
+        key = id(handler)
+        with self.lock:
+            if key in self.handlers:
+                return
+            ref = weakref.ref(handler, lambda ref, key=key: self._remove(key, ref))
+            self.handlers[key] = (ref, route, type(handler))
+            self.class_counts[type(handler)] = self.class_counts.get(type(handler), 0) + 1
+        gauge = self._gauge(route)
+        if gauge:
+            gauge.inc()
+
+    def discard(self, handler: web.RequestHandler) -> Optional[str]:
+        return self._remove(id(handler))
+
+    def _remove(self, key: int, ref: Optional[weakref.ref] = None) -> Optional[str]:
+        with self.lock:
+            entry = self.handlers.get(key)
+            if entry is None or (ref is not None and entry[0] is not ref):
+                return None
+            del self.handlers[key]
+            _, route, handler_class = entry
+            left = self.class_counts[handler_class] - 1
+            if left:
+                self.class_counts[handler_class] = left
+            else:
+                self.class_counts.pop(handler_class)
+            ready = self._ready_waiters() if self.waiters and not left else []
+        if ref is not None:
+            logging.warning(f"active request {handler_class.__name__} {route} collected without finish")
+        gauge = self._gauge(route)
+        if gauge:
+            gauge.dec()
+        for loop, future in ready:
+            loop.call_soon_threadsafe(_set_drained, future)
+        return route
+
+    def _ready_waiters(self) -> list:
+        ready, pending = [], []
+        for waiter in self.waiters:
+            if self.count(waiter[0]) == 0:
+                ready.append(waiter[1:])
+            else:
+                pending.append(waiter)
+        self.waiters = pending
+        return ready
+
+    async def wait_drained(self, timeout: Optional[float] = None, handler_class: Optional[type] = None) -> bool:
+        """全部结束返回 True  超时返回 False"""
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        waiter = (handler_class, loop, future)
+        with self.lock:
+            if self.count(handler_class) == 0:
+                return True
+            self.waiters.append(waiter)
+        try:
+            await asyncio.wait_for(future, timeout)
+            return True
+        except asyncio.TimeoutError:
+            with self.lock:
+                if waiter in self.waiters:
+                    self.waiters.remove(waiter)
+            return False
+
+
+def _set_drained(future: asyncio.Future):
+    if not future.done():
+        future.set_result(True)
+
+
+active_requests = ActiveRequests()
+loop_monitor = None # loop_monitor.enable_loop_monitor 设置
 
 
 pass_path = ["/healthcheck", "/health", "/metrics"]
 class PrometheusMixIn(web.RequestHandler):
+    metrics_route: Optional[str] = None # 固定 uri 标签  默认见 route_of
+    metrics_raw_path = False # uri 标签使用原始 path 而不是路由正则
+    body_log_limit = 1000 # 小于该长度的 body 原样打印  否则只打印截断后的内容
+    body_log_sample_rate = 1.0 # 请求/响应 body 日志采样率  可以按 handler 类修改
+    _log_body = True # prepare 中按采样率决定
+
+    def _execute(self, transforms, *args, **kwargs):
+        coro = super()._execute(transforms, *args, **kwargs)
+        if loop_monitor is None:
+            return coro
+        return loop_monitor.wrap(self, coro)
 
     def bragi_connection_info(self):
         info_str = f"{self.request.remote_ip} {self.request.method.upper()} {self.request.path} request-time:{self.request.request_time():.3f}"
         return info_str
 
     async def prepare(self):
-        if type(self) not in active_handlers:
-            active_handlers[type(self)] = []
-        active_handlers[type(self)].append(self)
+        active_requests.add(self, route_of(self))
 
         if global_exit_event().is_set():
             self.set_status(503)
@@ -175,49 +616,51 @@ class PrometheusMixIn(web.RequestHandler):
             self.finish() # 没有显示调用 tornado 会继续执行 get/post 方法
             return
 
-        if self.request.method != "POST":
+        self._log_body = logging.getLogger().isEnabledFor(logging.INFO) and \
+            (self.body_log_sample_rate >= 1 or random.random() < self.body_log_sample_rate)
+        if self.request.method != "POST" or not self._log_body:
             return
-        
-        if len(self.request.body) < 1000:
-            try:
-                body_str = self.request.body.decode('utf-8')
-                logging.info(f"{self.request.path} body: {body_str}")
-            except UnicodeDecodeError:
-                logging.info(f"{self.request.path} body: {self.request.body}")
-        elif self.request.headers.get('Content-Type') == "application/json":
+
+        body = self.request.body
+        if len(body) < self.body_log_limit:
             try:
-                body_str = self.request.body.decode('utf-8')
+                logging.info(f"{self.request.path} body: {body.decode('utf-8')}")
             except UnicodeDecodeError:
-                body_str = self.request.body
-            
-            body = json.loads(body_str)
-            try:
-                logging.info(f"{self.request.path} part body: {kv_for_show(body)}")
-            except Exception as e:
-                pass
+                logging.info(f"{self.request.path} body: {body}")
+        elif self._is_json():
+            # 大 json 不在 ioloop 上解析  只打印前 body_log_limit 字节  不依赖 handler 是否调用 json_body
+            part = body[:self.body_log_limit].decode("utf-8", errors="replace")
+            logging.info(f"{self.request.path} part body: {part}...({len(body)})")
+        else:
+            logging.info(f"{self.request.path} body: {body[:64]!r}...({len(body)}) {self.request.headers.get('Content-Type', '')}")
+
+    def _is_json(self) -> bool:
+        return self.request.headers.get("Content-Type", "").startswith("application/json")
+
+    def json_body(self):
+        """解析后的请求体 缓存在 request 上  prepare 和 handler 共用一次解析
+        返回的对象在同一请求内共享  解析失败抛出 json.JSONDecodeError
+        """
+        parsed = getattr(self.request, "_bragi_json", None)
+        if parsed is None:
+            parsed = json.loads(self.request.body)
+            self.request._bragi_json = parsed
+        return parsed
 
     def on_finish(self):
-        if type(self) in active_handlers and self in active_handlers[type(self)]:
-            active_handlers[type(self)].remove(self)
-            if len(active_handlers[type(self)]) == 0:
-                active_handlers.pop(type(self))
-
-        path = self.request.path
-        method = self.request.method
-        request_time = self.request.request_time()
         status = self.get_status()
+        route = active_requests.discard(self) if status != 101 else None # websocket 握手后连接仍在  关闭时再移除
 
         mgr = get_metrics_manager()
+        mgr.request_recorder.record(route or route_of(self), status, self.request.request_time())
 
-        mgr.request_histogram.labels(
-            mgr.server_name, path, status
-        ).observe(request_time)
-        mgr.request_qps.labels(
-            mgr.server_name, path, status
-        ).inc()
+    def on_connection_close(self):
+        super().on_connection_close()
+        if self.get_status() == 101:
+            active_requests.discard(self)
     
     def write(self, chunk):
-        if self.request.path not in pass_path:
+        if self._log_body and self.request.path not in pass_path:
             if isinstance(chunk, dict):
                 logging.info(f"{self.request.path} part response: {kv_for_show(chunk)}")
         super().write(chunk)
@@ -226,6 +669,16 @@ class PrometheusMixIn(web.RequestHandler):
 class StreamMetrics:
     # Inter-Token Latency (ITL) ： 在第一个令牌后生成每个后续令牌所需的时间，与流相关
     # Time Per Output Token (TPOT): 对于非流请求，在输出序列中生成每个令牌的平均时间
+    # 每个 token 间隔写入预分配的 array('f')  finish_infer 时统计 ITL p50/p90/p99 和卡顿次数  速率曲线按需计算
+    __slots__ = (
+        "request_id", "timestamp2", "prompt_len", "start", "start_perf", "last_token_time",
+        "prompt_tokens", "output_tokens", "output_speed", "infer_total", "finished_at",
+        "ttft", "tpot", "max_token_delta", "delta_streaming",
+        "deltas", "delta_count", "itl_p50", "itl_p90", "itl_p99", "stall_count",
+    )
+    itl_capacity = 2048 # 预分配的间隔个数  不够时翻倍
+    stall_threshold = 0.5 # token 间隔超过该值 (秒) 记一次卡顿
+
     def __init__(self, request_id, timestamp2, prompt_len) -> None:
         self.request_id = request_id
         self.timestamp2 = timestamp2
@@ -238,28 +691,82 @@ class StreamMetrics:
         self.output_tokens = 0
         self.output_speed = 0
         self.infer_total = 0
+        self.finished_at = 0.0
 
         self.ttft = float('inf')
         self.tpot = float('inf')
         self.max_token_delta = float('inf')
         self.delta_streaming = float('inf')
 
+        self.deltas = array('f', bytes(4 * self.itl_capacity))
+        self.delta_count = 0
+        self.itl_p50 = float('inf')
+        self.itl_p90 = float('inf')
+        self.itl_p99 = float('inf')
+        self.stall_count = 0
+
+    def __setstate__(self, state):
+        # 兼容加了 __slots__ 之前保存的 pkl
+        if isinstance(state, tuple):
+            state = {**(state[0] or {}), **(state[1] or {})}
+        StreamMetrics.__init__(self, state.get("request_id"), state.get("timestamp2", 0), state.get("prompt_len", 0))
+        for key, value in state.items():
+            if key in StreamMetrics.__slots__:
+                setattr(self, key, value)
+
     def output_token(self):
         current = time.perf_counter()
         
         if self.output_tokens == 0:
-           self.ttft = current - self.start_perf
+            self.ttft = current - self.start_perf
         else:
-            if self.max_token_delta == float('inf'):
-                self.max_token_delta = current-self.last_token_time
-            self.max_token_delta = max(self.max_token_delta, current-self.last_token_time)
+            n = self.delta_count
+            if n == len(self.deltas):
+                self.deltas.frombytes(bytes(4 * max(n, 64)))
+            delta = current - self.last_token_time
+            self.deltas[n] = delta
+            self.delta_count = n + 1
+            # 流式过程中 __str__/dict 也要能看到 max_itl  不等 finish_infer
+            if n == 0 or delta > self.max_token_delta:
+                self.max_token_delta = delta
         self.output_tokens += 1
         self.last_token_time = current
         self.infer_total = current-self.start_perf
         return
+
+    def itl_list(self) -> array:
+        return self.deltas[:self.delta_count]
+
+    def itl_sketch(self, relative_accuracy: float = 0.01) -> DDSketch:
+        """逐 token 间隔的 sketch  多个请求/多次压测 merge 后求分位数 不需要保留原始数组"""
+        sketch = DDSketch(relative_accuracy)
+        sketch.add_many(self.deltas[:self.delta_count])
+        return sketch
+
+    def _summarize_itl(self):
+        n = self.delta_count
+        del self.deltas[n:] # 释放预分配的空间
+        if n == 0:
+            return
+        ordered = sorted(self.deltas)
+        self.itl_p50, self.itl_p90, self.itl_p99 = (ordered[max(math.ceil(q * n) - 1, 0)] for q in (0.5, 0.9, 0.99))
+        self.stall_count = n - bisect.bisect_right(ordered, self.stall_threshold)
+
+    def token_rate_timeline(self, window: float = 1.0) -> List[float]:
+        """从请求开始每 window 秒的输出速率 token/s  第一个 token 之前的窗口为 0"""
+        if self.ttft == float('inf'):
+            return []
+        counts = [0] * (int((self.last_token_time - self.start_perf) / window) + 1)
+        offset = self.ttft
+        counts[min(int(offset / window), len(counts) - 1)] += 1
+        for delta in self.deltas[:self.delta_count]:
+            offset += delta
+            counts[min(int(offset / window), len(counts) - 1)] += 1
+        return [count / window for count in counts]
     
     def finish_infer(self, output_tokens=0, prompt_tokens=0, backend: str = "openai"):
         current = time.perf_counter()
+        self.finished_at = time.time()
         if output_tokens:
             self.output_tokens = output_tokens
         if prompt_tokens:
@@ -272,6 +779,7 @@ class StreamMetrics:
 
         if self.ttft < float('inf'):
             self.delta_streaming = self.infer_total-self.ttft
+        self._summarize_itl()
 
         if get_metrics_manager():
             get_metrics_manager().token_speed.labels(backend).observe(self.output_speed)
@@ -281,6 +789,14 @@ class StreamMetrics:
                 get_metrics_manager().tpot_latency.labels(backend).observe(self.tpot)
             if self.max_token_delta < float('inf'):
                 get_metrics_manager().max_itl_latency.labels(backend).observe(self.max_token_delta)
+                get_metrics_manager().p99_itl_latency.labels(backend).observe(self.itl_p99)
+            if self.stall_count:
+                get_metrics_manager().token_stall.labels(backend).inc(self.stall_count)
+            if get_metrics_manager().itl_sketch and self.delta_count:
+                get_metrics_manager().itl_sketch.labels(backend).observe_many(self.deltas)
+
+    def _from_request_total(self) -> float:
+        return (self.finished_at or time.time())-self.timestamp2
 
     def dict(self):
         return {
@@ -293,18 +809,23 @@ class StreamMetrics:
             "ttft": self.ttft,
             "tpot": self.tpot,
             "max_itl": self.max_token_delta,
+            "itl_p50": self.itl_p50,
+            "itl_p90": self.itl_p90,
+            "itl_p99": self.itl_p99,
+            "stall_count": self.stall_count,
             "speed": self.output_speed,
             "infer_total": self.infer_total,
             "delta_streaming": self.delta_streaming,
-            "from_request_total": time.time()-self.timestamp2,
+            "from_request_total": self._from_request_total(),
         }
 
     def __str__(self):
         # self.finish_infer()
         str = f"request_id={self.request_id} prompt_len:{self.prompt_len} prompt_tokens:{self.prompt_tokens} output_tokens:{self.output_tokens} produce_at:{self.timestamp2:.3f} " \
             f"infer_start_delta:{self.start-self.timestamp2:.3f} " \
-            f"ttft:{self.ttft:.3f} tpot:{self.tpot:.3f} max_itl:{self.max_token_delta:.3f} speed:{self.output_speed:.3f} token/s " \
-            f"infer_total:{self.infer_total:.3f} delta_streaming:{self.delta_streaming:.3f} from_request_total:{time.time()-self.timestamp2:.3f}"
+            f"ttft:{self.ttft:.3f} tpot:{self.tpot:.3f} max_itl:{self.max_token_delta:.3f} " \
+            f"itl_p50:{self.itl_p50:.3f} itl_p90:{self.itl_p90:.3f} itl_p99:{self.itl_p99:.3f} stall:{self.stall_count} speed:{self.output_speed:.3f} token/s " \
+            f"infer_total:{self.infer_total:.3f} delta_streaming:{self.delta_streaming:.3f} from_request_total:{self._from_request_total():.3f}"
         return str
 
 
@@ -320,8 +841,21 @@ if __name__ == "__main__":
             print(f"{met}")
         met.finish_infer()
         print(f"{met}")
+        print(f"token rate timeline: {met.token_rate_timeline(0.1)}")
+
+    def bench_stream_metrics(tokens=2000, loop=100):
+        cost = 0
+        for _ in range(loop):
+            met = StreamMetrics(request_id="bench", timestamp2=time.time(), prompt_len=100)
+            start = time.perf_counter()
+            for _ in range(tokens):
+                met.output_token()
+            met.finish_infer()
+            cost += time.perf_counter() - start
+        print(f"{tokens} tokens stream: {cost/loop*1e3:.3f}ms per stream {cost/loop/tokens*1e9:.0f}ns per token")
 
     test_metrics()
+    bench_stream_metrics()
 
     print(MetricsManager.latency_buckets)
     print(MetricsManager.big_latency_buckets)
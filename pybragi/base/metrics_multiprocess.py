@@ -0,0 +1,98 @@
+import glob
+import logging
+import os
+import re
+import tempfile
+import time
+from typing import Optional, Set
+
+import prometheus_client as pc
+from prometheus_client import multiprocess, values
+
+
+# 多个 worker 进程监听同一端口时  每个进程的指标写入共享目录下的 mmap 文件  /metrics 汇总所有进程
+# 必须在创建任何指标 (MetricsManager) 之前、fork 之前启用
+
+
+multiproc_dir: Optional[str] = None
+registry: Optional[pc.CollectorRegistry] = None # /metrics 使用的 registry  自定义 collector (sketch.SketchSummary) 也要注册到这里
+_pid_pattern = re.compile(r"_(\d+)\.(db|json)$")
+_last_cleanup = 0.0
+cleanup_interval = 10.0
+
+
+def configured_dir() -> Optional[str]:
+    return os.environ.get("PROMETHEUS_MULTIPROC_DIR", os.environ.get("prometheus_multiproc_dir"))
+
+
+def is_enabled() -> bool:
+    return multiproc_dir is not None
+
+
+def _pid_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def _file_pids(path: str) -> Set[int]:
+    pids = set()
+    for file in glob.glob(os.path.join(path, "*.db")) + glob.glob(os.path.join(path, "*.json")):
+        match = _pid_pattern.search(file)
+        if match:
+            pids.add(int(match.group(1)))
+    return pids
+
+
+def clear_stale_files(path: str):
+    """删除已不存在进程的全部文件  启动时 (fork 前) 调用 清理上一次运行残留的数据"""
+    for pid in _file_pids(path):
+        if pid != os.getpid() and not _pid_alive(pid):
+            for file in glob.glob(os.path.join(path, f"*_{pid}.db")) + glob.glob(os.path.join(path, f"*_{pid}.json")):
+                os.remove(file)
+
+
+def cleanup_dead_pids(force: bool = False):
+    """live* 模式的 gauge 去掉已退出的 worker  counter/histogram 保留 (进程退出前的计数仍然有效)"""
+    global _last_cleanup
+    if multiproc_dir is None:
+        return
+    now = time.monotonic()
+    if not force and now - _last_cleanup < cleanup_interval:
+        return
+    _last_cleanup = now
+
+    for pid in _file_pids(multiproc_dir):
+        if not _pid_alive(pid):
+            multiprocess.mark_process_dead(pid, multiproc_dir)
+
+
+def enable_multiprocess(path: Optional[str] = None) -> str:
+    global multiproc_dir, registry
+    if multiproc_dir is not None:
+        return multiproc_dir
+
+    path = path or configured_dir() or os.path.join(tempfile.gettempdir(), f"pybragi_metrics_{os.getpid()}")
+    os.makedirs(path, exist_ok=True)
+    clear_stale_files(path)
+
+    # prometheus_client 在 import 时根据环境变量选择 ValueClass  这里补上运行时开启的情况
+    os.environ["PROMETHEUS_MULTIPROC_DIR"] = path
+    if values.ValueClass is values.MutexValue:
+        values.ValueClass = values.MultiProcessValue()
+
+    registry = pc.CollectorRegistry()
+    multiprocess.MultiProcessCollector(registry, path)
+    # sketch 不是 mmap 值  每个进程写 sketch_{name}_{pid}.json  SketchSummary 抓取时合并
+
+    from pybragi.base import metrics
+    metrics.exposition_cache.registry = registry
+    metrics.exposition_cache.hooks.append(cleanup_dead_pids)
+
+    multiproc_dir = path
+    logging.info(f"prometheus multiprocess mode enabled, dir: {path}")
+    return path
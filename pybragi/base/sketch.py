@@ -0,0 +1,303 @@
+import glob
+import json
+import logging
+import math
+import os
+import threading
+from typing import Dict, Iterable, List, Optional, Sequence
+
+import prometheus_client as pc
+from prometheus_client.metrics_core import Metric
+
+from pybragi.base import metrics_multiprocess
+from pybragi.base.shutdown import global_exit_event
+
+
+class DDSketch:
+    """相对误差有界的分位数 sketch (DDSketch)  桶 key 覆盖 (gamma^(key-1), gamma^key]
+    任意分位数的相对误差不超过 relative_accuracy  内存只和数值范围有关 与样本数无关
+    桶数 = ln(max/min) / ln(gamma)  0.01 精度下 1us ~ 50s 约 887 个桶  1us ~ 1h 约 1100 个
+    默认 max_bins=2048 可覆盖约 17 个数量级  时延场景不会触发合并  超过 max_bins 时合并最小的桶
+    参数相同的 sketch 可以 merge  to_dict/from_dict 序列化后跨进程/跨次运行合并
+    非线程安全  多线程见 SketchSummary
+    """
+    def __init__(self, relative_accuracy: float = 0.01, max_bins: int = 2048, min_value: float = 1e-9):
+        self.relative_accuracy = relative_accuracy
+        self.max_bins = max_bins
+        self.min_value = min_value # 不超过该值的样本计入 zero_count
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self._multiplier = 1 / math.log(self.gamma)
+
+        self.bins: Dict[int, int] = {}
+        self.zero_count = 0
+        self.count = 0
+        self.sum = 0.0
+        self.min = float('inf')
+        self.max = float('-inf')
+
+    def add(self, value: float, n: int = 1):
+        self.count += n
+        self.sum += value * n
+        if value < self.min:
+            self.min = value
+        if value > self.max:
+            self.max = value
+        if value <= self.min_value:
+            self.zero_count += n
+            return
+        key = math.ceil(math.log(value) * self._multiplier)
+        bins = self.bins
+        if key in bins:
+            bins[key] += n
+        else:
+            bins[key] = n
+            if len(bins) > self.max_bins:
+                self._collapse()
+
+    def add_many(self, values: Iterable[float]):
+        add = self.add
+        for value in values:
+            add(value)
+
+    def _collapse(self):
+        keys = sorted(self.bins)
+        for key in keys[:len(keys) - self.max_bins]:
+            self.bins[keys[len(keys) - self.max_bins]] += self.bins.pop(key)
+
+    def merge(self, other: "DDSketch"):
+        if not math.isclose(self.gamma, other.gamma):
+            raise ValueError(f"cannot merge sketch with relative_accuracy {other.relative_accuracy} into {self.relative_accuracy}")
+        for key, n in other.bins.items():
+            self.bins[key] = self.bins.get(key, 0) + n
+        self.zero_count += other.zero_count
+        self.count += other.count
+        self.sum += other.sum
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+        if len(self.bins) > self.max_bins:
+            self._collapse()
+        return self
+
+    @property
+    def mean(self) -> float:
+        return self.sum / self.count if self.count else float('nan')
+
+    def quantiles(self, qs: Sequence[float]) -> List[float]:
+        """qs 取值 0~1  返回对应分位数  空 sketch 返回 nan"""
+        if self.count == 0:
+            return [float('nan')] * len(qs)
+
+        order = sorted(range(len(qs)), key=lambda i: qs[i])
+        result = [0.0] * len(qs)
+        keys = sorted(self.bins)
+        index, cumulative = 0, self.zero_count
+        for i in order:
+            rank = qs[i] * (self.count - 1)
+            if rank < self.zero_count:
+                result[i] = min(max(0.0, self.min), self.max)
+                continue
+            while index < len(keys) and cumulative <= rank:
+                cumulative += self.bins[keys[index]]
+                index += 1
+            value = 2 * self.gamma ** keys[index - 1] / (self.gamma + 1)
+            result[i] = min(max(value, self.min), self.max)
+        return result
+
+    def quantile(self, q: float) -> float:
+        return self.quantiles([q])[0]
+
+    def copy(self) -> "DDSketch":
+        sketch = DDSketch(self.relative_accuracy, self.max_bins, self.min_value)
+        return sketch.merge(self)
+
+    def to_dict(self) -> dict:
+        return {
+            "relative_accuracy": self.relative_accuracy,
+            "max_bins": self.max_bins,
+            "min_value": self.min_value,
+            "zero_count": self.zero_count,
+            "count": self.count,
+            "sum": self.sum,
+            "min": self.min if self.count else None,
+            "max": self.max if self.count else None,
+            "bins": {str(key): n for key, n in self.bins.items()},
+        }
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "DDSketch":
+        sketch = cls(data["relative_accuracy"], data.get("max_bins", 2048), data.get("min_value", 1e-9))
+        sketch.bins = {int(key): n for key, n in data["bins"].items()}
+        sketch.zero_count = data["zero_count"]
+        sketch.count = data["count"]
+        sketch.sum = data["sum"]
+        if data.get("min") is not None:
+            sketch.min = data["min"]
+            sketch.max = data["max"]
+        return sketch
+
+
+def merge_sketches(sketches: Iterable[DDSketch], relative_accuracy: float = 0.01) -> DDSketch:
+    merged = None
+    for sketch in sketches:
+        merged = sketch.copy() if merged is None else merged.merge(sketch)
+    return merged if merged is not None else DDSketch(relative_accuracy)
+
+
+def save_sketches(path: str, sketches: Dict[str, DDSketch]):
+    with open(path, "w") as f:
+        json.dump({name: sketch.to_dict() for name, sketch in sketches.items()}, f)
+
+
+def load_sketches(path: str) -> Dict[str, DDSketch]:
+    with open(path) as f:
+        data = json.load(f)
+    if "bins" in data: # 单个 sketch
+        return {"": DDSketch.from_dict(data)}
+    return {name: DDSketch.from_dict(item) for name, item in data.items()}
+
+
+class _SketchChild:
+    __slots__ = ("parent", "sketch", "lock")
+
+    def __init__(self, parent: "SketchSummary"):
+        self.parent = parent
+        self.sketch = DDSketch(parent.relative_accuracy)
+        self.lock = threading.Lock()
+
+    def observe(self, value: float):
+        with self.lock:
+            self.sketch.add(value)
+        self.parent._maybe_dump()
+
+    def observe_many(self, values: Iterable[float]):
+        with self.lock:
+            self.sketch.add_many(values)
+        self.parent._maybe_dump()
+
+    def merge(self, sketch: DDSketch):
+        with self.lock:
+            self.sketch.merge(sketch)
+        self.parent._maybe_dump()
+
+    def snapshot(self) -> DDSketch:
+        with self.lock:
+            return self.sketch.copy()
+
+
+class SketchSummary:
+    """以 prometheus summary 导出的 DDSketch  用法同 pc.Summary: labels(...).observe(v)
+    quantile 样本由 sketch 计算  每个标签组合只有一个 sketch  不再是 60~100 个固定 bucket
+    多进程模式 (metrics_multiprocess) 下每个进程的后台线程每 dump_interval 秒把有变化的 sketch 写入共享目录  抓取时合并所有进程
+    """
+    dump_interval = 1.0
+    _dirty: set = set()
+    _dump_lock = threading.Lock()
+    _dump_thread: Optional[threading.Thread] = None
+    _dump_pid = 0
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                 quantiles: Sequence[float] = (0.5, 0.9, 0.99), relative_accuracy: float = 0.01, registry=pc.REGISTRY):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.quantiles = tuple(quantiles)
+        self.relative_accuracy = relative_accuracy
+
+        self.children: Dict[tuple, _SketchChild] = {}
+        self.lock = threading.Lock()
+
+        if registry is not None:
+            registry.register(self)
+        if metrics_multiprocess.registry is not None and metrics_multiprocess.registry is not registry:
+            metrics_multiprocess.registry.register(self)
+
+    def labels(self, *values) -> _SketchChild:
+        key = tuple(str(value) for value in values)
+        child = self.children.get(key)
+        if child is None:
+            with self.lock:
+                child = self.children.setdefault(key, _SketchChild(self))
+        return child
+
+    def _file(self, pid: int) -> str:
+        return os.path.join(metrics_multiprocess.multiproc_dir, f"sketch_{self.name}_{pid}.json")
+
+    def _maybe_dump(self):
+        if metrics_multiprocess.multiproc_dir is None:
+            return
+        # 已在集合中时不加锁  交换发生在 dump 的 snapshot 之前 这次 observe 的数据一定会被写出
+        if self not in SketchSummary._dirty:
+            with SketchSummary._dump_lock:
+                SketchSummary._dirty.add(self)
+        # fork 之后子进程里线程已不存在  按 pid 重新启动
+        if SketchSummary._dump_pid != os.getpid():
+            with SketchSummary._dump_lock:
+                if SketchSummary._dump_pid != os.getpid():
+                    SketchSummary._dump_pid = os.getpid()
+                    SketchSummary._dump_thread = threading.Thread(target=SketchSummary._dump_loop, name="sketch_dump", daemon=True)
+                    SketchSummary._dump_thread.start()
+
+    @staticmethod
+    def _dump_loop():
+        while not global_exit_event().wait(SketchSummary.dump_interval):
+            SketchSummary._dump_dirty()
+        SketchSummary._dump_dirty()
+
+    @staticmethod
+    def _dump_dirty():
+        # observe 在其他线程里随时 add  交换出整个集合后再 dump
+        with SketchSummary._dump_lock:
+            dirty, SketchSummary._dirty = SketchSummary._dirty, set()
+        for sketch in dirty:
+            sketch.dump()
+
+    def dump(self):
+        data = [[list(key), child.snapshot().to_dict()] for key, child in list(self.children.items())]
+        path = self._file(os.getpid())
+        tmp = f"{path}.tmp"
+        try:
+            with open(tmp, "w") as f:
+                json.dump(data, f)
+            os.replace(tmp, path)
+        except OSError as e:
+            logging.error(f"dump sketch {self.name} failed: {e}")
+
+    def merged(self) -> Dict[tuple, DDSketch]:
+        result = {key: child.snapshot() for key, child in list(self.children.items())}
+        if metrics_multiprocess.multiproc_dir is None:
+            return result
+
+        if self.children:
+            self.dump()
+        own = self._file(os.getpid())
+        prefix = f"sketch_{self.name}_"
+        for path in glob.glob(self._file("*")):
+            pid = os.path.basename(path)[len(prefix):-len(".json")]
+            if path == own or not pid.isdigit(): # 跳过名字以 self.name 为前缀的其他 sketch
+                continue
+            try:
+                with open(path) as f:
+                    data = json.load(f)
+            except (OSError, ValueError):
+                continue
+            for key, item in data:
+                sketch = DDSketch.from_dict(item)
+                key = tuple(key)
+                if key in result:
+                    result[key].merge(sketch)
+                else:
+                    result[key] = sketch
+        return result
+
+    def describe(self):
+        return [Metric(self.name, self.documentation, "summary")]
+
+    def collect(self):
+        metric = Metric(self.name, self.documentation, "summary")
+        for key, sketch in self.merged().items():
+            labels = dict(zip(self.labelnames, key))
+            for q, value in zip(self.quantiles, sketch.quantiles(self.quantiles)):
+                metric.add_sample(self.name, {**labels, "quantile": str(q)}, value)
+            metric.add_sample(f"{self.name}_count", labels, sketch.count)
+            metric.add_sample(f"{self.name}_sum", labels, sketch.sum)
+        yield metric
@@ -1,11 +1,12 @@
 from concurrent.futures import ThreadPoolExecutor
+import threading
 import time
 import pycurl
 from io import BytesIO
 import sys
 from pydantic import BaseModel
-import numpy as np
 from pybragi.base.counter import RunningStatus
+from pybragi.base.sketch import DDSketch, save_sketches
 from tqdm import tqdm
 
 class RequestLatency(BaseModel):
@@ -23,6 +24,16 @@ class RequestLatency(BaseModel):
 latencySt_list = []
 running_status = RunningStatus()
 
+# 各阶段耗时 (毫秒) 的 sketch  内存不随请求数增长  --sketch-file 保存后可用 percentile_calculator -s 合并多次压测
+phases = {
+    "request_sent": "1. 连接建立与请求准备     ",
+    "ttfb": "2. 服务端响应等待 (TTFB):     ",
+    "content_download": "3. 内容下载     ",
+    "total": "4. 总耗时     ",
+}
+latency_sketches = {phase: DDSketch() for phase in phases}
+sketch_lock = threading.Lock()
+
 @running_status.running_decorator
 def make_http_request(url, method="GET", headers=None, body=None, print_log=True, verbose=False):
     buffer = BytesIO()
@@ -105,6 +116,12 @@ def make_http_request(url, method="GET", headers=None, body=None, print_log=True
         c.close()
     
     latencySt_list.append(latencySt)
+    if latencySt.success:
+        with sketch_lock:
+            latency_sketches["request_sent"].add(latencySt.setup_and_send_preparation_time)
+            latency_sketches["ttfb"].add(latencySt.waiting_for_server_response_time)
+            latency_sketches["content_download"].add(latencySt.content_download_time)
+            latency_sketches["total"].add(latencySt.total_time)
     return latencySt
 
 
@@ -133,20 +150,17 @@ def concurrent_make_http_request(url, method, headers, body, num, qps, verbose=F
         time.sleep(0.1)
 
 
-def analyze_latency_st_list():
-    latencySt_list_success = [latencySt for latencySt in latencySt_list if latencySt.success]
-    print(f"总请求：{len(latencySt_list)} 失败请求数: {len(latencySt_list) - len(latencySt_list_success)}")
-
-    request_sent = np.array([latencySt.setup_and_send_preparation_time for latencySt in latencySt_list_success])
-    ttfb = np.array([latencySt.waiting_for_server_response_time for latencySt in latencySt_list_success])
-    content_download = np.array([latencySt.content_download_time for latencySt in latencySt_list_success])
-    total = np.array([latencySt.total_time for latencySt in latencySt_list_success])
+def analyze_latency_st_list(sketch_file: str = ""):
+    success = sum(1 for latencySt in latencySt_list if latencySt.success)
+    print(f"总请求：{len(latencySt_list)} 失败请求数: {len(latencySt_list) - success}")
 
+    for phase, title in phases.items():
+        sketch = latency_sketches[phase]
+        p50, p90, max_value = sketch.quantiles([0.5, 0.9, 1.0])
+        print(f"{title} mean:{sketch.mean:.3f}ms P50:{p50:.3f}ms P90:{p90:.3f}ms max:{max_value:.3f}ms")
 
-    print(f"1. 连接建立与请求准备      mean:{np.mean(request_sent):.3f}ms P50:{np.percentile(request_sent, 50):.3f}ms P90:{np.percentile(request_sent, 90):.3f}ms max:{np.max(request_sent):.3f}ms")
-    print(f"2. 服务端响应等待 (TTFB):      mean:{np.mean(ttfb):.3f}ms P50:{np.percentile(ttfb, 50):.3f}ms P90:{np.percentile(ttfb, 90):.3f}ms max:{np.max(ttfb):.3f}ms")
-    print(f"3. 内容下载      mean:{np.mean(content_download):.3f}ms P50:{np.percentile(content_download, 50):.3f}ms P90:{np.percentile(content_download, 90):.3f}ms max:{np.max(content_download):.3f}ms")
-    print(f"4. 总耗时      mean:{np.mean(total):.3f}ms P50:{np.percentile(total, 50):.3f}ms P90:{np.percentile(total, 90):.3f}ms max:{np.max(total):.3f}ms")
+    if sketch_file:
+        save_sketches(sketch_file, latency_sketches)
 
 
 
@@ -161,8 +175,9 @@ if __name__ == "__main__":
     parser.add_argument("--verbose", action="store_true")
     parser.add_argument("--num", type=int, default=1)
     parser.add_argument("--qps", type=float, default=1.0)
+    parser.add_argument("--sketch-file", type=str, default="", help="save latency sketches (json) for merging across runs")
 
     args = parser.parse_args()
     concurrent_make_http_request(args.url, args.method, args.headers, args.body, args.num, args.qps, args.verbose)
-    analyze_latency_st_list()
+    analyze_latency_st_list(args.sketch_file)
 
@@ -9,6 +9,7 @@ import uuid
 import tqdm
 from openai import OpenAI
 from pybragi.base.metrics import StreamMetrics
+from pybragi.base.sketch import merge_sketches, save_sketches
 
 
 
@@ -169,16 +170,21 @@ def save_metrics(file_dir = ""):
 
     with open(filename, "wb") as f:
         pickle.dump(metrics_list, f)
+    # 多次压测的 itl 可以用 percentile_calculator -s 合并
+    save_sketches(filename.replace(".pkl", ".itl_sketch.json"), {"itl": merge_sketches(metrics.itl_sketch() for metrics in metrics_list)})
 
 def analyze():
     import numpy as np
 
     # change to ms
     prompt_len_list = np.array([metrics.prompt_len for metrics in metrics_list])
-    output_len_list = np.array([metrics.output_token_count for metrics in metrics_list])
+    output_len_list = np.array([metrics.output_tokens for metrics in metrics_list])
     e2e_list = np.array([metrics.infer_total for metrics in metrics_list]) * 1000
     ttft_list = np.array([metrics.ttft for metrics in metrics_list]) * 1000
-    itl_list = np.array([metrics.max_token_delta for metrics in metrics_list]) * 1000
+    max_itl_list = np.array([metrics.max_token_delta for metrics in metrics_list]) * 1000
+    # 所有请求的逐 token 间隔合并到一个 sketch  不需要拼接原始数组
+    itl_sketch = merge_sketches(metrics.itl_sketch() for metrics in metrics_list)
+    stall_count = sum(metrics.stall_count for metrics in metrics_list)
 
     prompt_mean = np.mean(prompt_len_list)
     prompt_median = np.percentile(prompt_len_list, [50])[0]
@@ -200,11 +206,19 @@ def analyze():
     ttft_p99 = np.percentile(ttft_list, [99])[0]
     ttft_max = np.max(ttft_list)
     
-    itl_mean = np.mean(itl_list)
-    itl_median = np.percentile(itl_list, [50])[0]
-    itl_p99 = np.percentile(itl_list, [99])[0]
-    itl_max = np.max(itl_list)
+    if itl_sketch.count:
+        itl_mean = itl_sketch.mean * 1000
+        itl_median, itl_p99, itl_max = (value * 1000 for value in itl_sketch.quantiles([0.5, 0.99, 1.0]))
+    else: # 旧 pkl 没有逐 token 间隔  退化为每个请求的最大间隔
+        itl_mean = np.mean(max_itl_list)
+        itl_median = np.percentile(max_itl_list, [50])[0]
+        itl_p99 = np.percentile(max_itl_list, [99])[0]
+        itl_max = np.max(max_itl_list)
 
+    max_itl_mean = np.mean(max_itl_list)
+    max_itl_median = np.percentile(max_itl_list, [50])[0]
+    max_itl_p99 = np.percentile(max_itl_list, [99])[0]
+    max_itl_max = np.max(max_itl_list)
     
     row_table = """
 ## 性能指标表格 单位毫秒ms 行式
@@ -216,34 +230,37 @@ def analyze():
 | 端到端 | {:.3f} | {:.3f} | {:.3f} | {:.3f} |
 | ttft | {:.3f} | {:.3f} | {:.3f} | {:.3f} |
 | itl | {:.3f} | {:.3f} | {:.3f} | {:.3f} |
+| max_itl | {:.3f} | {:.3f} | {:.3f} | {:.3f} |
 """.format(
         prompt_mean, prompt_median, prompt_p99, prompt_max,
         output_mean, output_median, output_p99, output_max,
         e2e_mean, e2e_median, e2e_p99, e2e_max,
         ttft_mean, ttft_median, ttft_p99, ttft_max,
-        itl_mean, itl_median, itl_p99, itl_max
+        itl_mean, itl_median, itl_p99, itl_max,
+        max_itl_mean, max_itl_median, max_itl_p99, max_itl_max
     )
     
     col_table = """
 ## 性能指标表格 单位毫秒ms 列式
 
-| 统计类型 | prompt_len | output_len | 端到端 | ttft | itl |
-|---------|-----------|-----------|-------|------|-----|
-| 平均值 | {:.3f} | {:.3f} | {:.3f} | {:.3f} | {:.3f} |
-| 中位数 | {:.3f} | {:.3f} | {:.3f} | {:.3f} | {:.3f} |
-| 99分位 | {:.3f} | {:.3f} | {:.3f} | {:.3f} | {:.3f} |
-| 最大值 | {:.3f} | {:.3f} | {:.3f} | {:.3f} | {:.3f} |
+| 统计类型 | prompt_len | output_len | 端到端 | ttft | itl | max_itl |
+|---------|-----------|-----------|-------|------|-----|---------|
+| 平均值 | {:.3f} | {:.3f} | {:.3f} | {:.3f} | {:.3f} | {:.3f} |
+| 中位数 | {:.3f} | {:.3f} | {:.3f} | {:.3f} | {:.3f} | {:.3f} |
+| 99分位 | {:.3f} | {:.3f} | {:.3f} | {:.3f} | {:.3f} | {:.3f} |
+| 最大值 | {:.3f} | {:.3f} | {:.3f} | {:.3f} | {:.3f} | {:.3f} |
 """.format(
-        prompt_mean, output_mean, e2e_mean, ttft_mean, itl_mean,
-        prompt_median, output_median, e2e_median, ttft_median, itl_median,
-        prompt_p99, output_p99, e2e_p99, ttft_p99, itl_p99,
-        prompt_max, output_max, e2e_max, ttft_max, itl_max
+        prompt_mean, output_mean, e2e_mean, ttft_mean, itl_mean, max_itl_mean,
+        prompt_median, output_median, e2e_median, ttft_median, itl_median, max_itl_median,
+        prompt_p99, output_p99, e2e_p99, ttft_p99, itl_p99, max_itl_p99,
+        prompt_max, output_max, e2e_max, ttft_max, itl_max, max_itl_max
     )
     
     # 打印markdown表格
     print(row_table)
     print("\n\n")
     print(col_table)
+    print(f"token 间隔超过 {StreamMetrics.stall_threshold}s 的卡顿次数: {stall_count}")
 
 
 if __name__ == "__main__":
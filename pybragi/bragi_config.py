@@ -3,6 +3,7 @@
 class BragiConfig:
     IPv4 = "127.0.0.1"
     LBCheck = True # LoadBalanceWithHealthCheck
+    LBProbeInterval = 1.0 # seconds, background health probe interval
     ForceExitTimeout = 20.0 # seconds
 
 
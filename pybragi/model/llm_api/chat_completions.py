@@ -1,7 +1,6 @@
 import time
 import traceback
 import logging
-import json
 from concurrent.futures import ThreadPoolExecutor
 from tornado import ioloop
 from tornado.concurrent import run_on_executor
@@ -50,8 +49,7 @@ class ChatCompletions(PrometheusMixIn):
 
     @run_on_executor
     def post(self):
-        request = self.request.body
-        request_json = json.loads(request)
+        request_json = self.json_body()
         request_id = request_json.pop("request_id", "")
         timestamp2 = request_json.pop("timestamp2", round(time.time(), 3))
         messages = request_json.get("messages", [])
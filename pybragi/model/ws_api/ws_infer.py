@@ -389,21 +389,18 @@ class WSHandler(metrics.PrometheusMixIn, WebSocketHandler):
     
 async def websocket_graceful_shutdown(max_wait_time = 70):
     logging.info("Waiting for active connections to complete...")
-    
-    # 1. 等待所有WebSocket连接处理完成
-    wait_cnt = 0
-    while WSHandler.client_to_task:
-        if wait_cnt >= max_wait_time:
-            break
-        active_count = len(WSHandler.client_to_task)
-        logging.info(f"Still {active_count} active connections, waiting...")
-        await asyncio.sleep(1)
-        wait_cnt += 1
-    
-    # 2. 如果还有连接，强制关闭
-    if WSHandler.client_to_task:
-        logging.warning(f"Forcefully closing {len(WSHandler.client_to_task)} remaining connections")
-        for client in list(WSHandler.client_to_task.keys()):
+    WSHandler._shutdown_in_progress = True
+
+    # 1. 没有任务的连接直接关闭  等待其余 WebSocket 连接处理完成
+    for client in metrics.active_requests.snapshot(WSHandler):
+        if client not in WSHandler.client_to_task:
+            client.close(code=proto_ws.code_shutting_down, reason="Server is shutting down")
+
+    if not await metrics.active_requests.wait_drained(max_wait_time, WSHandler):
+        # 2. 如果还有连接，强制关闭
+        clients = metrics.active_requests.snapshot(WSHandler)
+        logging.warning(f"Forcefully closing {len(clients)} remaining connections")
+        for client in clients:
             client: WSHandler
             try:
                 client.close(code=proto_ws.code_force_close, reason="Server shutdown timeout")
@@ -0,0 +1,221 @@
+import asyncio
+import json
+import logging
+from typing import Any, Callable, Dict, Optional, Tuple
+
+from tornado import ioloop
+from tornado.httpclient import AsyncHTTPClient, HTTPRequest, HTTPResponse, HTTPClientError
+
+from pybragi.bragi_config import BragiConfig
+from pybragi.server import loadbalance, health_check, endpoint_load
+from pybragi.server.hedge import HedgePolicy, record_hedge
+
+
+strategies: Dict[str, Callable[..., str]] = {
+    "roundrobin": loadbalance.roundrobin,
+    "weighted_roundrobin": loadbalance.weighted_roundrobin,
+    "hash": loadbalance.hash_balance,
+    "least_outstanding": loadbalance.least_outstanding,
+    "power_of_two": loadbalance.power_of_two_choices,
+    "peak_ewma": loadbalance.peak_ewma,
+}
+
+# 599: 连接失败/超时   502/503/504: 网关类错误  可以换节点重试
+retry_codes = {599, 502, 503, 504}
+
+
+class AsyncLBStatus:
+    request_cnt = 0
+    retry_cnt = 0
+    failed_cnt = 0
+    hedge_cnt = 0
+
+
+class AsyncLoadBalanceClient:
+    """在 ioloop 上转发请求  和 loadbalance.py 共用策略和 in-flight/ewma 统计
+    默认使用 CurlAsyncHTTPClient  libcurl 按 host 复用 keep-alive 连接
+    负载均衡选择节点时只读健康表  同步 /health 探测会阻塞 ioloop
+    构造时传入 health_prober 或事先 start_health_prober  否则 (LBCheck 开启时) 在构造时启动一个不带 target 的 prober
+    """
+    def __init__(
+        self,
+        strategy: str = "roundrobin",
+        max_clients: int = 1000,
+        connect_timeout: float = 1.0,
+        request_timeout: float = 10.0,
+        retries: int = 1,
+        use_curl: bool = True,
+        hedge_policy: Optional[HedgePolicy] = None,
+        health_prober: Optional[health_check.HealthProber] = None,
+    ):
+        if strategy not in strategies:
+            raise ValueError(f"unknown strategy: {strategy}, support: {list(strategies)}")
+        self.strategy = strategy
+        self.balance = strategies[strategy]
+        self.max_clients = max_clients
+        self.connect_timeout = connect_timeout
+        self.request_timeout = request_timeout
+        self.retries = retries
+        self.use_curl = use_curl
+        self.hedge_policy = hedge_policy or HedgePolicy()
+
+        if health_prober is not None:
+            if health_check.get_health_prober() is None:
+                health_check.register_health_prober(health_prober)
+        elif BragiConfig.LBCheck and health_check.get_health_prober() is None:
+            logging.info("no health prober registered, start one for async load balance")
+            health_check.start_health_prober()
+
+        # AsyncHTTPClient 绑定创建时的 ioloop  每个 loop 一个实例
+        self._clients: Dict[ioloop.IOLoop, AsyncHTTPClient] = {}
+
+    def http_client(self) -> AsyncHTTPClient:
+        loop = ioloop.IOLoop.current()
+        client = self._clients.get(loop)
+        if client is None:
+            if self.use_curl:
+                from tornado.curl_httpclient import CurlAsyncHTTPClient
+                client = CurlAsyncHTTPClient(force_instance=True, max_clients=self.max_clients)
+            else:
+                from tornado.simple_httpclient import SimpleAsyncHTTPClient
+                client = SimpleAsyncHTTPClient(force_instance=True, max_clients=self.max_clients)
+            self._clients[loop] = client
+        return client
+
+    def pick(self, servers: list, key: Optional[str] = None) -> str:
+        if self.strategy == "hash":
+            return self.balance(servers, "" if key is None else key)
+        return self.balance(servers)
+
+    async def _attempt(self, host: str, path: str, method: str, body: Any, headers: Optional[dict],
+                       request_timeout: Optional[float]) -> Tuple[Optional[HTTPResponse], Optional[Exception]]:
+        request = HTTPRequest(
+            f"{host}{path}",
+            method=method,
+            body=body,
+            headers=headers,
+            connect_timeout=self.connect_timeout,
+            request_timeout=request_timeout or self.request_timeout,
+        )
+        with endpoint_load.track_request(host, path) as tracked:
+            try:
+                response = await self.http_client().fetch(request, raise_error=False)
+                error = response.error if response.code in retry_codes else None
+            except HTTPClientError as e:
+                response, error = e.response, e
+            except Exception as e:
+                response, error = None, e
+
+            # 只有 retry_codes 换节点重试  但所有 5xx 都计入熔断和 ewma  否则快速返回 500 的节点会吸走更多流量
+            if error is not None or (response is not None and response.code >= 500):
+                tracked.mark_error()
+        return response, error
+
+    async def _hedged_attempt(self, servers: list, host: str, path: str, key: Optional[str], *args) -> Tuple[Optional[HTTPResponse], Optional[Exception], list]:
+        """首个请求超过 p95 未返回时 向另一个节点发送对冲请求 取先成功的 取消另一个"""
+        hosts = [host]
+        first = asyncio.ensure_future(self._attempt(host, path, *args))
+        delay = self.hedge_policy.delay(endpoint_load.endpoint_of_host(host), path)
+        done, _ = await asyncio.wait({first}, timeout=delay)
+        if done:
+            return (*first.result(), hosts)
+
+        others = [server for server in servers if health_check.endpoint_of(server) != endpoint_load.endpoint_of_host(host)]
+        if not others:
+            return (*(await first), hosts)
+        if not self.hedge_policy.try_acquire():
+            record_hedge(path, "no_budget")
+            return (*(await first), hosts)
+
+        try:
+            second_host = self.pick(others, key)
+        except Exception:
+            return (*(await first), hosts)
+        hosts.append(second_host)
+        AsyncLBStatus.hedge_cnt += 1
+        record_hedge(path, "sent")
+        second = asyncio.ensure_future(self._attempt(second_host, path, *args))
+
+        # curl 请求本身无法中止 取消后只是不再等待结果 也不计入时延统计
+        pending = {first, second}
+        result = (None, None)
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                result = task.result()
+                if result[1] is None:
+                    for loser in pending:
+                        loser.cancel()
+                    record_hedge(path, "won" if task is second else "lost")
+                    return (*result, hosts)
+        return (*result, hosts)
+
+    async def fetch(
+        self,
+        servers: list,
+        path: str,
+        method: str = "GET",
+        body: Any = None,
+        json_body: Any = None,
+        headers: Optional[dict] = None,
+        key: Optional[str] = None,
+        request_timeout: Optional[float] = None,
+        retries: Optional[int] = None,
+        hedge: bool = False,
+    ) -> HTTPResponse:
+        """选择节点并请求 path  连接失败或 502/503/504 时换下一个节点重试
+        返回最后一次的 HTTPResponse  4xx/500 等业务错误不重试直接返回
+        hedge=True 开启对冲请求  只应用于幂等接口
+        """
+        if json_body is not None:
+            body = json.dumps(json_body)
+            headers = {**(headers or {}), "Content-Type": "application/json"}
+        if isinstance(body, dict):
+            body = json.dumps(body)
+        retries = self.retries if retries is None else retries
+        if hedge:
+            self.hedge_policy.on_request()
+
+        AsyncLBStatus.request_cnt += 1
+        tried = set()
+        candidates = servers
+        response: Optional[HTTPResponse] = None
+        last_error: Optional[Exception] = None
+        for attempt in range(retries + 1):
+            if not candidates:
+                break
+            try:
+                host = self.pick(candidates, key)
+            except Exception as e:
+                last_error = e
+                break
+
+            if attempt > 0:
+                AsyncLBStatus.retry_cnt += 1
+                logging.warning(f"retry {method} {path} on {host}, attempt: {attempt}")
+
+            if hedge:
+                response, last_error, hosts = await self._hedged_attempt(candidates, host, path, key, method, body, headers, request_timeout)
+            else:
+                response, last_error = await self._attempt(host, path, method, body, headers, request_timeout)
+                hosts = [host]
+            if last_error is None:
+                return response
+
+            tried.update(endpoint_load.endpoint_of_host(h) for h in hosts)
+            candidates = [server for server in servers if health_check.endpoint_of(server) not in tried]
+
+        AsyncLBStatus.failed_cnt += 1
+        if response is not None:
+            return response
+        raise last_error if last_error else Exception("No healthy server found")
+
+    async def fetch_json(self, servers: list, path: str, **kwargs) -> Any:
+        response = await self.fetch(servers, path, **kwargs)
+        response.rethrow()
+        return json.loads(response.body)
+
+    def close(self):
+        for client in self._clients.values():
+            client.close()
+        self._clients.clear()
@@ -0,0 +1,227 @@
+import logging
+import threading
+import time
+from typing import Dict
+
+from pybragi.base.metrics import get_metrics_manager
+from pybragi.server import dao_server_discovery
+
+
+class CircuitBreaker:
+    """本地熔断  closed -> open -> half_open -> closed
+    closed: 连续失败 failure_threshold 次 或 窗口内错误率超过 error_rate 时熔断
+    open: open_timeout 内不分配流量  之后进入 half_open
+    half_open: 只放行 half_open_requests 个试探请求  成功则恢复 失败则以翻倍的 open_timeout 再次熔断
+    """
+    closed = "closed"
+    open = "open"
+    half_open = "half_open"
+
+    def __init__(
+        self,
+        endpoint: str,
+        failure_threshold: int = 5,
+        error_rate: float = 0.5,
+        min_requests: int = 20,
+        window: float = 10.0,
+        bucket_count: int = 10,
+        open_timeout: float = 5.0,
+        max_open_timeout: float = 60.0,
+        half_open_requests: int = 1,
+    ):
+        self.endpoint = endpoint
+        self.failure_threshold = failure_threshold
+        self.error_rate = error_rate
+        self.min_requests = min_requests
+        self.bucket_width = window / bucket_count
+        self.base_open_timeout = open_timeout
+        self.max_open_timeout = max_open_timeout
+        self.half_open_requests = half_open_requests
+
+        self.lock = threading.Lock()
+        self.state = CircuitBreaker.closed
+        self.consecutive_failures = 0
+        self.open_timeout = open_timeout
+        self.opened_at = 0.0
+        self.half_open_inflight = 0
+        self.half_open_at = 0.0
+        self.buckets = [[0, 0, 0] for _ in range(bucket_count)] # [bucket_id, success, failure]
+
+    def _bucket(self, now: float) -> list:
+        bucket_id = int(now / self.bucket_width)
+        bucket = self.buckets[bucket_id % len(self.buckets)]
+        if bucket[0] != bucket_id:
+            bucket[0], bucket[1], bucket[2] = bucket_id, 0, 0
+        return bucket
+
+    def window_counts(self, now: float = 0.0):
+        now = now or time.monotonic()
+        oldest = int(now / self.bucket_width) - len(self.buckets)
+        success = sum(b[1] for b in self.buckets if b[0] > oldest)
+        failure = sum(b[2] for b in self.buckets if b[0] > oldest)
+        return success, failure
+
+    def _set_state(self, state: str, now: float):
+        if state == self.state:
+            return
+        logging.warning(f"circuit breaker {self.endpoint}: {self.state} -> {state}")
+        self.state = state
+        if state == CircuitBreaker.open:
+            self.opened_at = now
+        elif state == CircuitBreaker.half_open:
+            self.half_open_inflight = 0
+        else:
+            self.consecutive_failures = 0
+            self.open_timeout = self.base_open_timeout
+
+        mgr = get_metrics_manager()
+        if mgr:
+            mgr.remote_down.labels(self.endpoint).set(0 if state == CircuitBreaker.closed else 1)
+
+    def is_available(self) -> bool:
+        """只读判断 用于选节点时过滤  选中后再调用 allow 占用 half_open 的试探名额"""
+        state = self.state
+        if state == CircuitBreaker.closed:
+            return True
+        now = time.monotonic()
+        if state == CircuitBreaker.open:
+            return now - self.opened_at >= self.open_timeout
+        return self.half_open_inflight < self.half_open_requests or now - self.half_open_at > self.open_timeout
+
+    def allow(self) -> bool:
+        """真正发出请求前调用  half_open 时占用一个试探名额"""
+        if self.state == CircuitBreaker.closed:
+            return True
+
+        now = time.monotonic()
+        with self.lock:
+            if self.state == CircuitBreaker.open:
+                if now - self.opened_at < self.open_timeout:
+                    return False
+                self._set_state(CircuitBreaker.half_open, now)
+
+            # 试探请求若没有回报结果 超过 open_timeout 后允许再次试探
+            if self.half_open_inflight >= self.half_open_requests and now - self.half_open_at > self.open_timeout:
+                self.half_open_inflight = 0
+            if self.half_open_inflight < self.half_open_requests:
+                self.half_open_inflight += 1
+                self.half_open_at = now
+                return True
+            return False
+
+    def on_success(self):
+        now = time.monotonic()
+        with self.lock:
+            self._bucket(now)[1] += 1
+            self.consecutive_failures = 0
+            if self.state == CircuitBreaker.half_open:
+                self._set_state(CircuitBreaker.closed, now)
+
+    def on_failure(self):
+        now = time.monotonic()
+        with self.lock:
+            self._bucket(now)[2] += 1
+            self.consecutive_failures += 1
+            if self.state == CircuitBreaker.half_open:
+                self.open_timeout = min(self.open_timeout * 2, self.max_open_timeout)
+                self._set_state(CircuitBreaker.open, now)
+                return
+            if self.state != CircuitBreaker.closed:
+                return
+
+            if self.consecutive_failures >= self.failure_threshold:
+                self._set_state(CircuitBreaker.open, now)
+                return
+            success, failure = self.window_counts(now)
+            if success + failure >= self.min_requests and failure / (success + failure) >= self.error_rate:
+                self._set_state(CircuitBreaker.open, now)
+
+    def dict(self):
+        success, failure = self.window_counts()
+        return {
+            "endpoint": self.endpoint,
+            "state": self.state,
+            "consecutive_failures": self.consecutive_failures,
+            "open_timeout": self.open_timeout,
+            "window_success": success,
+            "window_failure": failure,
+        }
+
+
+class CircuitBreakers:
+    def __init__(self, **kwargs):
+        self.kwargs = kwargs # 新建 CircuitBreaker 的参数
+        self.breakers: Dict[str, CircuitBreaker] = {}
+        self.lock = threading.Lock()
+
+    def get(self, endpoint: str) -> CircuitBreaker:
+        breaker = self.breakers.get(endpoint)
+        if breaker is None:
+            with self.lock:
+                breaker = self.breakers.setdefault(endpoint, CircuitBreaker(endpoint, **self.kwargs))
+        return breaker
+
+    def is_available(self, endpoint: str) -> bool:
+        breaker = self.breakers.get(endpoint)
+        return breaker is None or breaker.is_available()
+
+    def allow(self, endpoint: str) -> bool:
+        breaker = self.breakers.get(endpoint)
+        return breaker is None or breaker.allow()
+
+    def snapshot(self):
+        return [breaker.dict() for breaker in list(self.breakers.values())]
+
+
+circuit_breakers = CircuitBreakers()
+
+
+def get_circuit_breakers() -> CircuitBreakers:
+    global circuit_breakers
+    return circuit_breakers
+
+
+def configure_circuit_breakers(**kwargs) -> CircuitBreakers:
+    global circuit_breakers
+    circuit_breakers = CircuitBreakers(**kwargs)
+    return circuit_breakers
+
+
+class UnregisterLimiter:
+    # 全局令牌桶 + 单节点冷却  防止一次 GC 停顿把整个集群下线
+    def __init__(self, rate_per_minute: float = 2, burst: int = 2, cooldown: float = 300.0):
+        self.rate = rate_per_minute / 60
+        self.burst = burst
+        self.cooldown = cooldown
+        self.tokens = float(burst)
+        self.stamp = time.monotonic()
+        self.last_unregister: Dict[str, float] = {}
+        self.lock = threading.Lock()
+
+    def acquire(self, endpoint: str) -> bool:
+        now = time.monotonic()
+        with self.lock:
+            if now - self.last_unregister.get(endpoint, -self.cooldown) < self.cooldown:
+                return False
+            self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+            self.stamp = now
+            if self.tokens < 1:
+                return False
+            self.tokens -= 1
+            self.last_unregister[endpoint] = now
+            return True
+
+
+unregister_limiter = UnregisterLimiter()
+
+
+# 远端下线的唯一入口 不在请求路径上调用
+def remote_unregister(server: dict, status: str = "offline_unhealthy", reason: str = "") -> bool:
+    endpoint = f"{server['ipv4']}:{server['port']}"
+    if not unregister_limiter.acquire(endpoint):
+        logging.warning(f"remote unregister rate limited: {endpoint} {reason}")
+        return False
+
+    logging.error(f"remote unregister server: {endpoint} {reason}")
+    dao_server_discovery.unregister_server(server['ipv4'], server['port'], server['name'], status=status, type=server.get('type', ""))
+    return True
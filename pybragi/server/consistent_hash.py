@@ -0,0 +1,112 @@
+import bisect
+import math
+import threading
+from collections import OrderedDict
+from typing import Dict, FrozenSet, Iterator, List, Optional, Tuple
+
+from pybragi.base.hash import md5_hash
+from pybragi.server.health_check import endpoint_of
+
+
+default_vnodes = 160
+
+
+def server_list_version(servers: list) -> FrozenSet[Tuple[str, int, float]]:
+    # 与顺序无关  frozenset 只需哈希 不排序也不拼接 endpoint 字符串  id 缓存未命中 (每次请求新 list) 时也足够便宜
+    return frozenset((server['ipv4'], server['port'], server.get('weight', 1)) for server in servers)
+
+
+class ConsistentHashRing:
+    """一致性哈希环 每个节点按 weight 放置 vnodes*weight 个虚拟节点
+    节点增减只会迁移约 1/N 的 key  查找为二分 O(log(N*vnodes))
+    """
+    def __init__(self, servers: list, vnodes: int = default_vnodes):
+        self.vnodes = vnodes
+        self.version = server_list_version(servers)
+        self.servers: Dict[str, dict] = {endpoint_of(server): server for server in servers}
+
+        # weight 全为 0 时退化为等权 与 weighted_roundrobin 保持一致
+        use_weight = any(server.get('weight', 1) > 0 for server in servers)
+
+        points: List[Tuple[int, str]] = []
+        for endpoint, server in self.servers.items():
+            weight = server.get('weight', 1) if use_weight else 1
+            for i in range(int(round(vnodes * weight))):
+                points.append((md5_hash(f"{endpoint}#{i}"), endpoint))
+        points.sort()
+
+        self.hashes = [point[0] for point in points]
+        self.endpoints = [point[1] for point in points]
+
+    def __len__(self):
+        return len(self.servers)
+
+    def _position(self, key: str) -> int:
+        idx = bisect.bisect_left(self.hashes, md5_hash(key))
+        return idx if idx < len(self.hashes) else 0
+
+    def get(self, key: str) -> Optional[dict]:
+        if not self.hashes:
+            return None
+        return self.servers[self.endpoints[self._position(key)]]
+
+    def iter_servers(self, key: str) -> Iterator[dict]:
+        """从 key 所在位置顺时针遍历 依次返回不重复的节点 用于不健康时顺延"""
+        if not self.hashes:
+            return
+        start = self._position(key)
+        seen = set()
+        for i in range(len(self.endpoints)):
+            endpoint = self.endpoints[(start + i) % len(self.endpoints)]
+            if endpoint in seen:
+                continue
+            seen.add(endpoint)
+            yield self.servers[endpoint]
+            if len(seen) == len(self.servers):
+                return
+
+    def iter_bounded(self, key: str, loads: Dict[str, int], load_factor: float = 1.25) -> Iterator[dict]:
+        """consistent hashing with bounded loads
+        单节点负载上限为 ceil(load_factor * (total+1) / N)  超过上限的节点放到最后
+        """
+        capacity = math.ceil(load_factor * (sum(loads.get(e, 0) for e in self.servers) + 1) / max(len(self.servers), 1))
+        overloaded = []
+        for server in self.iter_servers(key):
+            if loads.get(endpoint_of(server), 0) < capacity:
+                yield server
+            else:
+                overloaded.append(server)
+        yield from overloaded
+
+
+# 按 server list 版本缓存 节点列表不变时不重建
+_max_cached_rings = 32
+_rings: "OrderedDict[Tuple[FrozenSet, int], ConsistentHashRing]" = OrderedDict()
+# discovery_cache 成员不变时返回同一个 list 对象  按对象 id 命中无需计算版本
+_rings_by_list: "OrderedDict[Tuple[int, int], Tuple[list, ConsistentHashRing]]" = OrderedDict()
+_rings_lock = threading.Lock()
+
+
+def get_ring(servers: list, vnodes: int = default_vnodes) -> ConsistentHashRing:
+    cached = _rings_by_list.get((id(servers), vnodes))
+    if cached is not None and cached[0] is servers:
+        return cached[1]
+
+    cache_key = (server_list_version(servers), vnodes)
+    ring = _rings.get(cache_key)
+    if ring is None:
+        ring = ConsistentHashRing(servers, vnodes)
+
+    with _rings_lock:
+        _rings[cache_key] = ring
+        _rings_by_list[(id(servers), vnodes)] = (servers, ring) # 持有 list 引用 避免 id 被复用
+        for cache in (_rings, _rings_by_list):
+            while len(cache) > _max_cached_rings:
+                cache.popitem(last=False)
+    return ring
+
+
+# discovery_cache listener  成员变化时提前构建 请求路径上不再建环
+def prebuild_ring(name: str, type: str, servers: list):
+    if servers:
+        get_ring(servers)
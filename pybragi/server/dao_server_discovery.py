@@ -1,59 +1,57 @@
 
 import logging
-from datetime import datetime
-from pybragi.store import mongo_impl
-from pybragi.base import time_utils
+import threading
+import time
+from typing import List, Optional, Tuple
+from pybragi.base.shutdown import global_exit_event
+from pybragi.store.base import BaseServerDiscoveryStore
+from pybragi.store.mongo_discovery import MongoDiscoveryStore
 
 
 server_table = "servers"
+lease_table = "server_leases"
 
 
-def register_server(ipv4: str, port: int, name: str, type: str = ""):
-    now = datetime.now().strftime("%Y-%m-%d %H:%M:%S.%f")
-    query = {"ipv4": ipv4, "port": port, "name": name, "type": type}
-    
-    update = {
-        "$set": {"status": "online", "datetime": now}, 
-        "$push": {
-            "history": {
-                "$each": [{ "status": "online", "datetime": now }],
-                "$slice": -10  # 只保留最近的10条记录
-            }
-        }
-    }
-    mongo_impl.update_item(server_table, query, update, upsert=True)
+# 默认使用 mongo_impl 的全局连接  use_store 可切换到 memory / postgre
+discovery_store: Optional[BaseServerDiscoveryStore] = None
+
+def use_store(store: BaseServerDiscoveryStore):
+    global discovery_store
+    discovery_store = store
+
+
+def get_store() -> BaseServerDiscoveryStore:
+    global discovery_store
+    if discovery_store is None:
+        discovery_store = MongoDiscoveryStore(server_table, lease_table)
+    return discovery_store
+
+
+# discovery_cache.start_discovery_cache 注册后 查询走内存
+server_cache = None
+
+def use_cache(cache):
+    global server_cache
+    server_cache = cache
+
+
+def register_server(ipv4: str, port: int, name: str, type: str = "", ttl: float = 0):
+    get_store().register_server(ipv4, port, name, type, ttl=ttl)
 
 
 def unregister_server(ipv4: str, port: int, name: str, status: str = "offline", type: str = ""):
-    if status == "online":
-        status = "offline" # online is forbid for unregister
-
-    now = datetime.now().strftime("%Y-%m-%d %H:%M:%S.%f")
-    query = {"ipv4": ipv4, "port": port, "name": name, "type": type}
-    logging.info(f"{query}")
-    mongo_impl.update_item(server_table, query, {
-                "$set": { "status": status, "datetime": now },
-                "$push": { 
-                    "history": {
-                          "$each": [{ "status": status, "datetime": now }],
-                          "$slice": -10  # 只保留最近的10条记录
-                    }
-                }
-            }
-        )
+    get_store().unregister_server(ipv4, port, name, status=status, type=type)
 
 def check_self(ipv4: str, port: int, name: str, type: str = ""):
-    query = {"ipv4": ipv4, "port": port, "name": name, "status": "online", "type": type}
-    items = mongo_impl.get_items(server_table, query)
-    if len(items) > 0:
-        return True
-    return False
+    items = get_store().get_server_online(name, type)
+    return any(item["ipv4"] == ipv4 and item["port"] == port for item in items)
 
 # @cache_server_status
 # @time_utils.elapsed_time # mongo only use 1ms
 def get_server_online(name: str, type: str = "") -> list[dict]:
-    query = {"name": name, "status": "online", "type": type}
-    return mongo_impl.get_items(server_table, query)
+    if server_cache is not None:
+        return server_cache.get_server_online(name, type)
+    return get_store().get_server_online(name, type)
 
 
 def remove_server(ipv4: str, port: int, name: str, type: str = ""):
@@ -64,29 +62,157 @@ def remove_server(ipv4: str, port: int, name: str, type: str = ""):
 
 
 def get_all_server(type, online: bool = True) -> list[dict]:
-    if type is None:
-        query = {}
-    else:
-        query = {"type": type}
+    if server_cache is not None:
+        return server_cache.get_all_server(type, online)
+    return get_store().get_all_server(type, online)
 
-    if online:
-        query["status"] = "online"
-    return mongo_impl.get_items(server_table, query)
+
+async def aregister_server(ipv4: str, port: int, name: str, type: str = "", ttl: float = 0):
+    await get_store().aregister_server(ipv4, port, name, type, ttl=ttl)
+
+
+async def aunregister_server(ipv4: str, port: int, name: str, status: str = "offline", type: str = ""):
+    await get_store().aunregister_server(ipv4, port, name, status=status, type=type)
+
+
+async def aget_server_online(name: str, type: str = "") -> list[dict]:
+    if server_cache is not None:
+        return server_cache.get_server_online(name, type)
+    return await get_store().aget_server_online(name, type)
+
+
+async def aget_all_server(type, online: bool = True) -> list[dict]:
+    if server_cache is not None:
+        return server_cache.get_all_server(type, online)
+    return await get_store().aget_all_server(type, online)
 
 
 
 # lowest   ip+port+datetime   is master
+# 每次调用都要查询在线列表  需要稳定的单主请使用 LeaderLease
 def is_me_master(ipv4: str, port: int, name: str, type: str = "", reverse: bool = False):
     me = f"{ipv4}:{port}"
     items = get_server_online(name, type)
+    if not items:
+        return False
+
+    pick = max if reverse else min
+    master = pick(items, key=lambda x: f"{x['ipv4']}:{x['port']}:{x['datetime']}")
+    return f"{master['ipv4']}:{master['port']}" == me
+
+
+def ensure_ttl_index():
+    store = get_store()
+    if isinstance(store, MongoDiscoveryStore):
+        store.ensure_ttl_index()
 
-    items = sorted(items, key=lambda x: f"{x['ipv4']}:{x['port']}:{x['datetime']}", reverse=reverse)
 
-    # sorted_key = [f"{item['ipv4']}:{item['port']}:{item['datetime']}" for item in items]
-    # sorted_key.sort(reverse=reverse)
-    if me in items[0]:
-        return True
-    return False
+def heartbeat_servers(servers: List[Tuple[str, int, str, str]], ttl: float) -> List[Tuple[str, int, str, str]]:
+    """一次批量写为本进程注册的所有 (ipv4, port, name, type) 续期
+    只续期 online 的记录  已下线的不会被心跳拉回  返回记录已不存在的 server
+    """
+    return get_store().heartbeat_servers(servers, ttl)
+
+
+class LeaderLease:
+    """compare-and-set 租约  key = name:type  具体实现见 store.acquire_lease
+    holder 续期不改变 token  换主时 token 自增 作为 fencing token 交给下游校验
+    is_leader 只看本地截止时间 不查询数据库
+    """
+    def __init__(self, ipv4: str, port: int, name: str, type: str = "", ttl: float = 10.0, safety: float = 1.0):
+        self.me = f"{ipv4}:{port}"
+        self.key = f"{name}:{type}"
+        self.ttl = ttl
+        self.safety = safety # 本地提前 safety 秒认为租约失效 容忍时钟漂移和网络延迟
+        self.token = 0
+        self.deadline = 0.0
+
+    def _on_acquire(self, start: float, token: Optional[int]) -> Optional[int]:
+        if token is None:
+            self.deadline = 0.0
+            return None
+
+        if token != self.token:
+            logging.info(f"leader lease {self.key} acquired by {self.me}, token: {token}")
+        self.token = token
+        self.deadline = start + self.ttl - self.safety
+        return self.token
+
+    def try_acquire(self) -> Optional[int]:
+        start = time.monotonic()
+        return self._on_acquire(start, get_store().acquire_lease(self.key, self.me, self.ttl))
+
+    async def atry_acquire(self) -> Optional[int]:
+        start = time.monotonic()
+        return self._on_acquire(start, await get_store().aacquire_lease(self.key, self.me, self.ttl))
+
+    def is_leader(self) -> bool:
+        return time.monotonic() < self.deadline
+
+    def release(self):
+        if self.deadline:
+            get_store().release_lease(self.key, self.me, self.token)
+        self.deadline = 0.0
+
+
+class Heartbeat:
+    """后台线程  每 interval 秒批量续期注册记录和租约"""
+    def __init__(self, ttl: float = 10.0, interval: float = 3.0):
+        self.ttl = ttl
+        self.interval = interval
+        self.servers: List[Tuple[str, int, str, str]] = []
+        self.leases: List[LeaderLease] = []
+        self._stop_event = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def register(self, ipv4: str, port: int, name: str, type: str = ""):
+        register_server(ipv4, port, name, type, ttl=self.ttl)
+        self.servers.append((ipv4, port, name, type))
+
+    def unregister(self, ipv4: str, port: int, name: str, type: str = ""):
+        if (ipv4, port, name, type) in self.servers:
+            self.servers.remove((ipv4, port, name, type))
+        unregister_server(ipv4, port, name, type=type)
+
+    def add_lease(self, lease: LeaderLease) -> LeaderLease:
+        self.leases.append(lease)
+        return lease
+
+    def beat(self):
+        # 记录被 TTL 删除 (如心跳线程卡住或数据库短暂不可用超过 ttl) 时重新注册
+        # 显式 unregister 的 server 已从 self.servers 移除  也不会被拉回
+        for ipv4, port, name, type in heartbeat_servers(self.servers, self.ttl) or []:
+            logging.warning(f"heartbeat: {ipv4}:{port} {name} {type} record expired, register again")
+            register_server(ipv4, port, name, type, ttl=self.ttl)
+        for lease in self.leases:
+            lease.try_acquire()
+
+    def _run(self):
+        while not self._stop_event.is_set() and not global_exit_event().is_set():
+            try:
+                self.beat()
+            except Exception as e:
+                logging.error(f"heartbeat failed: {e}")
+            self._stop_event.wait(self.interval)
+
+        for lease in self.leases:
+            try:
+                lease.release()
+            except Exception as e:
+                logging.error(f"release lease failed: {e}")
+        logging.info("heartbeat exit")
+
+    def start(self):
+        if self._thread and self._thread.is_alive():
+            return
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._run, name="discovery_heartbeat", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop_event.set()
+        if self._thread:
+            self._thread.join(timeout=self.interval + 1)
 
 
 
@@ -102,7 +228,7 @@ if __name__ == "__main__":
     parser.add_argument("--port", type=int, help="port")
     args = parser.parse_args()
 
-    from pybragi.base import mongo_impl
+    from pybragi.store import mongo_impl
     from pybragi.base import ps
     from pybragi.server import dao_server_discovery
 
@@ -123,8 +249,8 @@ if __name__ == "__main__":
         res = dao_server_discovery.get_all_server(args.model_type, online=False)
         print(mongo_impl.pretty_print(res))
     elif args.action == "show_all":
-        res = dao_server_discovery.get_all_server(None, online=False)
-        print(mongo_impl.pretty_print(res))
+        # 包含所有历史节点 流式导出
+        mongo_impl.pretty_print_stream(mongo_impl.iter_items(server_table, {}, projection={"_id": 0}))
     elif args.action == "show_all_online":
         res = dao_server_discovery.get_all_server(None, online=True)
         print(mongo_impl.pretty_print(res))
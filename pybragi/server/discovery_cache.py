@@ -0,0 +1,145 @@
+import logging
+import threading
+from datetime import datetime
+from typing import Callable, Dict, List, Optional, Tuple
+
+from pybragi.base.shutdown import global_exit_event
+from pybragi.store.base import utc_now
+from pybragi.server import dao_server_discovery, consistent_hash
+
+
+class DiscoveryCache:
+    """servers 表的内存视图  按 (name, type) 建索引 O(1) 查询
+    同一成员集合返回同一个 list 对象 调用方不要修改
+    成员变化时回调 listener(name, type, servers)
+    source 为 store.base.BaseServerDiscoveryStore  默认与 dao_server_discovery 使用同一个 store
+    """
+    def __init__(self, source=None, poll_interval: float = 1.0):
+        self.source = source or dao_server_discovery.get_store()
+        self.poll_interval = poll_interval
+
+        self.servers: List[dict] = []
+        self.online: Dict[Tuple[str, str], List[dict]] = {}
+        self.version = 0
+        self.etag = None
+        self.next_expire: Optional[datetime] = None # 在线节点中最早的 expire_at
+        self.listeners: List[Callable[[str, str, List[dict]], None]] = []
+        self.lock = threading.Lock()
+
+        self._stop_event = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def add_listener(self, listener: Callable[[str, str, List[dict]], None]):
+        self.listeners.append(listener)
+
+    def get_server_online(self, name: str, type: str = "") -> List[dict]:
+        return self.online.get((name, type), [])
+
+    def get_all_server(self, type, online: bool = True) -> List[dict]:
+        if online:
+            return [server for key, servers in self.online.items() if type is None or key[1] == type for server in servers]
+        return [server for server in self.servers if type is None or server.get("type", "") == type]
+
+    def tick(self):
+        # 心跳停止的节点 到期后从在线列表移除
+        if self.next_expire is not None and utc_now() >= self.next_expire:
+            self.refresh()
+
+    def refresh(self):
+        servers = self.source.load()
+
+        now = utc_now()
+        next_expire = None
+        online: Dict[Tuple[str, str], List[dict]] = {}
+        for server in sorted(servers, key=lambda x: (x["ipv4"], x["port"])):
+            if server.get("status") != "online":
+                continue
+            expire_at = server.get("expire_at")
+            if expire_at is not None:
+                if expire_at <= now:
+                    continue
+                next_expire = expire_at if next_expire is None else min(next_expire, expire_at)
+            online.setdefault((server["name"], server.get("type", "")), []).append(server)
+        self.next_expire = next_expire
+
+        with self.lock:
+            changed = []
+            for key in set(online) | set(self.online):
+                old, new = self.online.get(key, []), online.get(key, [])
+                if consistent_hash.server_list_version(old) == consistent_hash.server_list_version(new):
+                    online[key] = old # 成员未变 保留原对象
+                else:
+                    changed.append(key)
+            self.servers = servers
+            self.online = {key: value for key, value in online.items() if value}
+            if changed:
+                self.version += 1
+
+        for name, type in changed:
+            logging.info(f"discovery cache changed: {name} {type} online: {len(online.get((name, type), []))} version: {self.version}")
+            for listener in self.listeners:
+                try:
+                    listener(name, type, online.get((name, type), []))
+                except Exception as e:
+                    logging.error(f"discovery cache listener failed: {e}")
+
+    def reload(self):
+        """先取 etag 再全量加载  加载期间的变更会让下一次 poll 的 etag 不同 不会漏掉"""
+        self.etag = self.source.etag()
+        self.refresh()
+
+    def _poll(self):
+        while not self._stop_event.is_set() and not global_exit_event().is_set():
+            try:
+                if self.source.etag() != self.etag:
+                    self.reload()
+                else:
+                    self.tick()
+            except Exception as e:
+                logging.error(f"discovery cache poll failed: {e}")
+            self._stop_event.wait(self.poll_interval)
+
+    def _run(self):
+        while not self._stop_event.is_set() and not global_exit_event().is_set():
+            try:
+                if not self.source.watch(self.refresh, self._stop_event, self.tick):
+                    break
+            except Exception as e:
+                logging.error(f"discovery cache watch failed: {e}")
+                self._stop_event.wait(self.poll_interval)
+                continue
+            # change stream 断开期间可能漏掉变更
+            self.reload()
+        self._poll()
+        logging.info("discovery cache exit")
+
+    def start(self):
+        if self._thread and self._thread.is_alive():
+            return
+        self.reload()
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._run, name="discovery_cache", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop_event.set()
+        if self._thread:
+            self._thread.join(timeout=self.poll_interval + 2)
+
+
+discovery_cache: Optional[DiscoveryCache] = None
+
+
+def get_discovery_cache() -> Optional[DiscoveryCache]:
+    global discovery_cache
+    return discovery_cache
+
+
+def start_discovery_cache(source=None, poll_interval: float = 1.0) -> DiscoveryCache:
+    global discovery_cache
+    cache = DiscoveryCache(source, poll_interval)
+    cache.add_listener(consistent_hash.prebuild_ring)
+    cache.start()
+    discovery_cache = cache
+    dao_server_discovery.use_cache(cache)
+    return cache
@@ -0,0 +1,177 @@
+import asyncio
+import math
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict
+
+from pybragi.base.metrics import get_metrics_manager
+from pybragi.server import circuit_breaker
+
+
+def endpoint_of_host(host: str) -> str:
+    # http://ip:port -> ip:port   负载均衡返回的 host 和 endpoint 统一
+    if "://" in host:
+        host = host.split("://", 1)[1]
+    return host.rstrip("/")
+
+
+class EndpointLoad:
+    def __init__(self, endpoint: str):
+        self.endpoint = endpoint
+        self.inflight = 0 # 本进程发往该节点且未返回的请求数
+        self.remote_queue = 0.0 # 对端导出的 task_queue_length
+        self.remote_update = 0.0
+
+        self.ewma = 0.0 # peak-EWMA 时延估计 秒
+        self.ewma_stamp = time.monotonic()
+        self.errors = 0
+
+    def load(self) -> float:
+        return self.inflight + self.remote_queue
+
+
+class TrackedRequest:
+    def __init__(self, state: EndpointLoad):
+        self.state = state
+        self.error = False
+        self.cancelled = False # 对冲请求中被取消的一方 不计入时延和熔断
+
+    # 非异常的失败 (如 5xx) 由调用方标记 会按 error_penalty 计入时延
+    def mark_error(self):
+        self.error = True
+
+
+class LoadTracker:
+    def __init__(self, remote_expire: float = 10.0, decay_time: float = 10.0, error_penalty: float = 1.0, unknown_penalty: float = 1e3):
+        self.loads: Dict[str, EndpointLoad] = {}
+        self.lock = threading.Lock()
+        self.remote_expire = remote_expire # 对端队列长度超过该时间未更新则忽略
+        self.decay_time = decay_time # ewma 衰减时间常数 秒
+        self.error_penalty = error_penalty # 失败请求按至少该时延计入 ewma
+        self.unknown_penalty = unknown_penalty # 尚无时延样本但已有 in-flight 的节点
+
+    def get(self, endpoint: str) -> EndpointLoad:
+        state = self.loads.get(endpoint)
+        if state is None:
+            with self.lock:
+                state = self.loads.setdefault(endpoint, EndpointLoad(endpoint))
+        return state
+
+    def load(self, endpoint: str) -> float:
+        state = self.loads.get(endpoint)
+        if state is None:
+            return 0
+        if state.remote_queue and time.time() - state.remote_update > self.remote_expire:
+            state.remote_queue = 0.0
+        return state.load()
+
+    def inflight_map(self) -> Dict[str, int]:
+        return {endpoint: state.inflight for endpoint, state in list(self.loads.items())}
+
+    def update_remote(self, endpoint: str, queue_length: float):
+        state = self.get(endpoint)
+        state.remote_queue = queue_length
+        state.remote_update = time.time()
+
+    def _decay(self, state: EndpointLoad, now: float) -> float:
+        return math.exp(-max(now - state.ewma_stamp, 0.0) / self.decay_time)
+
+    def observe(self, endpoint: str, latency: float, error: bool = False):
+        """peak-EWMA: 时延高于估计值直接取峰值  否则按距上次样本的时间指数衰减"""
+        state = self.get(endpoint)
+        if error:
+            latency = max(latency, self.error_penalty)
+        now = time.monotonic()
+        with self.lock:
+            if error:
+                state.errors += 1
+            if latency > state.ewma:
+                state.ewma = latency
+            else:
+                w = self._decay(state, now)
+                state.ewma = state.ewma * w + latency * (1 - w)
+            state.ewma_stamp = now
+
+    def ewma(self, endpoint: str) -> float:
+        state = self.loads.get(endpoint)
+        if state is None:
+            return 0.0
+        # 长时间没有样本的节点估计值衰减到 0 重新获得流量
+        return state.ewma * self._decay(state, time.monotonic())
+
+    def cost(self, endpoint: str) -> float:
+        state = self.loads.get(endpoint)
+        if state is None:
+            return 0.0
+        pending = self.load(endpoint)
+        ewma = self.ewma(endpoint)
+        if ewma == 0.0 and pending > 0:
+            return self.unknown_penalty + pending
+        return ewma * (pending + 1)
+
+    @contextmanager
+    def track(self, host: str, api: str = ""):
+        endpoint = endpoint_of_host(host)
+        state = self.get(endpoint)
+        tracked = TrackedRequest(state)
+        with self.lock:
+            state.inflight += 1
+        start = time.perf_counter()
+        try:
+            yield tracked
+        except asyncio.CancelledError:
+            tracked.cancelled = True
+            raise
+        except Exception:
+            tracked.error = True
+            raise
+        finally:
+            latency = time.perf_counter() - start
+            with self.lock:
+                state.inflight -= 1
+            if not tracked.cancelled:
+                self._record(endpoint, api, latency, tracked.error)
+
+    def _record(self, endpoint: str, api: str, latency: float, error: bool):
+        self.observe(endpoint, latency, error)
+
+        breaker = circuit_breaker.get_circuit_breakers().get(endpoint)
+        if error:
+            breaker.on_failure()
+        else:
+            breaker.on_success()
+
+        mgr = get_metrics_manager()
+        if mgr:
+            mgr.caller_histogram.labels(mgr.server_name, f"{endpoint}{api}").observe(latency)
+
+
+load_tracker = LoadTracker()
+
+
+def get_load_tracker() -> LoadTracker:
+    return load_tracker
+
+
+# with track_request(host, "/api/xxx") as tracked:
+#     resp = requests.post(f"{host}/api/xxx", ...)
+#     if not resp.ok: tracked.mark_error()
+def track_request(host: str, api: str = ""):
+    return load_tracker.track(host, api)
+
+
+def parse_task_queue_length(metrics_text: str, metric_name: str = "task_queue_length") -> float:
+    # 只扫描目标指标行 不解析整个 exposition
+    total = 0.0
+    for line in metrics_text.splitlines():
+        if not line.startswith(metric_name):
+            continue
+        rest = line[len(metric_name):]
+        if rest[:1] not in ("{", " "):
+            continue
+        try:
+            total += float(line.rsplit(" ", 1)[1])
+        except (IndexError, ValueError):
+            continue
+    return total
@@ -0,0 +1,221 @@
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List, Optional
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from pybragi.bragi_config import BragiConfig
+from pybragi.base.shutdown import global_exit_event
+from pybragi.server import dao_server_discovery, endpoint_load, circuit_breaker
+
+
+health_api_path = "/health"
+metrics_api_path = "/metrics"
+
+
+def endpoint_of(server: dict) -> str:
+    return f"{server['ipv4']}:{server['port']}"
+
+
+class EndpointHealth:
+    def __init__(self, endpoint: str, server: dict):
+        self.endpoint = endpoint
+        self.server = server
+        self.healthy = True # 未探测过的节点先认为健康 避免冷启动无可用节点
+        self.latency = 0.0
+        self.last_check = 0.0
+        self.last_seen = time.time()
+        self.consecutive_failures = 0
+        self.consecutive_successes = 0
+        self.last_error = ""
+
+    def dict(self):
+        return {
+            "endpoint": self.endpoint,
+            "healthy": self.healthy,
+            "latency": self.latency,
+            "last_check": self.last_check,
+            "consecutive_failures": self.consecutive_failures,
+            "last_error": self.last_error,
+        }
+
+
+# 后台线程周期探测所有节点 负载均衡只读内存表 请求路径上没有网络IO
+class HealthProber:
+    def __init__(
+        self,
+        interval: float = BragiConfig.LBProbeInterval,
+        timeout: float = 0.5,
+        api_path: str = health_api_path,
+        fall: int = 2,
+        rise: int = 1,
+        expire: float = 60.0,
+        max_workers: int = 8,
+        unregister_unhealthy: bool = False,
+        scrape_load: bool = False,
+    ):
+        self.interval = interval
+        self.timeout = timeout
+        self.api_path = api_path
+        self.fall = fall # 连续失败 fall 次标记为 unhealthy
+        self.rise = rise # 连续成功 rise 次恢复 healthy
+        self.expire = expire # 超过 expire 秒没有被 target 或负载均衡引用的节点会被清理
+        self.unregister_unhealthy = unregister_unhealthy
+        self.scrape_load = scrape_load # 顺带抓取对端 task_queue_length 供按负载均衡使用
+
+        self.table: Dict[str, EndpointHealth] = {}
+        self.targets: List[Callable[[], list]] = []
+        self.lock = threading.Lock()
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=max_workers, pool_maxsize=max_workers)
+        self.session.mount("http://", adapter)
+        self.executor = ThreadPoolExecutor(max_workers, thread_name_prefix="health_prober")
+
+        self._stop_event = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def add_target(self, get_servers: Callable[[], list]):
+        self.targets.append(get_servers)
+
+    def watch_service(self, name: str, type: str = ""):
+        self.add_target(lambda: dao_server_discovery.get_server_online(name, type))
+
+    def track(self, server: dict) -> EndpointHealth:
+        endpoint = endpoint_of(server)
+        state = self.table.get(endpoint)
+        if state is None:
+            with self.lock:
+                state = self.table.setdefault(endpoint, EndpointHealth(endpoint, server))
+        state.last_seen = time.time()
+        return state
+
+    def is_healthy(self, server: dict) -> bool:
+        return self.track(server).healthy
+
+    def healthy_servers(self, servers: list) -> list:
+        return [server for server in servers if self.is_healthy(server)]
+
+    def snapshot(self) -> List[dict]:
+        return [state.dict() for state in list(self.table.values())]
+
+    def _probe(self, state: EndpointHealth):
+        start = time.perf_counter()
+        try:
+            resp = self.session.get(f"http://{state.endpoint}{self.api_path}", timeout=self.timeout)
+            ok = resp.ok
+            state.last_error = "" if ok else f"status {resp.status_code}"
+        except Exception as e:
+            ok = False
+            state.last_error = str(e)
+
+        state.latency = time.perf_counter() - start
+        state.last_check = time.time()
+        if ok:
+            if self.scrape_load:
+                self._scrape_load(state)
+            state.consecutive_failures = 0
+            state.consecutive_successes += 1
+            if not state.healthy and state.consecutive_successes >= self.rise:
+                state.healthy = True
+                logging.info(f"{state.endpoint} back to healthy, latency: {state.latency:.3f}")
+            return
+
+        state.consecutive_successes = 0
+        state.consecutive_failures += 1
+        if state.healthy and state.consecutive_failures >= self.fall:
+            state.healthy = False
+            logging.error(f"{self.api_path} failed {state.consecutive_failures} times, mark unhealthy: {state.endpoint} {state.last_error}")
+            if self.unregister_unhealthy:
+                circuit_breaker.remote_unregister(state.server, reason=state.last_error)
+
+    def _scrape_load(self, state: EndpointHealth):
+        try:
+            resp = self.session.get(f"http://{state.endpoint}{metrics_api_path}", timeout=self.timeout)
+            if resp.ok:
+                queue_length = endpoint_load.parse_task_queue_length(resp.text)
+                endpoint_load.get_load_tracker().update_remote(state.endpoint, queue_length)
+        except Exception as e:
+            logging.warning(f"{metrics_api_path} scrape failed: {state.endpoint} {e}")
+
+    def probe_once(self):
+        for get_servers in self.targets:
+            try:
+                for server in get_servers():
+                    self.track(server)
+            except Exception as e:
+                logging.error(f"health prober get servers failed: {e}")
+
+        now = time.time()
+        with self.lock:
+            for endpoint in [k for k, v in self.table.items() if now - v.last_seen > self.expire]:
+                self.table.pop(endpoint, None)
+            states = list(self.table.values())
+
+        list(self.executor.map(self._probe, states))
+
+    def _run(self):
+        while not self._stop_event.is_set() and not global_exit_event().is_set():
+            try:
+                self.probe_once()
+            except Exception as e:
+                logging.error(f"health prober failed: {e}")
+            self._stop_event.wait(self.interval)
+        logging.info("health prober exit")
+
+    def start(self):
+        if self._thread and self._thread.is_alive():
+            return
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._run, name="health_prober", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop_event.set()
+        if self._thread:
+            self._thread.join(timeout=self.interval + self.timeout)
+        self.executor.shutdown(wait=False)
+
+
+health_prober: Optional[HealthProber] = None
+
+
+def get_health_prober() -> Optional[HealthProber]:
+    global health_prober
+    return health_prober
+
+
+def register_health_prober(prober: Optional[HealthProber]):
+    global health_prober
+    health_prober = prober
+
+
+def start_health_prober(*services: str, type: str = "", **kwargs) -> HealthProber:
+    prober = HealthProber(**kwargs)
+    for name in services:
+        prober.watch_service(name, type)
+    prober.start()
+    register_health_prober(prober)
+    return prober
+
+
+if __name__ == "__main__":
+    import argparse
+    from pybragi.store import mongo_impl
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model", type=str, required=True)
+    parser.add_argument("--model-type", type=str, default="")
+    parser.add_argument("--mongo-url", type=str, required=True)
+    parser.add_argument("--mongo-db", type=str, required=True)
+    parser.add_argument("--interval", type=float, default=1.0)
+    args = parser.parse_args()
+
+    mongo_impl.new_store(args.mongo_url, args.mongo_db, 4)
+    prober = start_health_prober(args.model, type=args.model_type, interval=args.interval)
+    for _ in range(10):
+        time.sleep(args.interval)
+        print(prober.snapshot())
+    prober.stop()
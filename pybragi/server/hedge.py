@@ -0,0 +1,103 @@
+import threading
+import time
+from typing import Dict, List, Optional, Set, Tuple
+
+from pybragi.base.metrics import get_metrics_manager
+
+
+def histogram_quantile(buckets: List[Tuple[float, float]], q: float) -> Optional[float]:
+    """和 PromQL histogram_quantile 一致  buckets 为 (le, 累计数量) 按 le 升序"""
+    if not buckets or buckets[-1][1] <= 0:
+        return None
+    rank = q * buckets[-1][1]
+    prev_le, prev_count = 0.0, 0.0
+    for le, count in buckets:
+        if count >= rank:
+            if le == float("inf"):
+                return prev_le
+            if count == prev_count:
+                return le
+            return prev_le + (le - prev_le) * (rank - prev_count) / (count - prev_count)
+        prev_le, prev_count = le, count
+    return prev_le
+
+
+def caller_latency_buckets(*urls: str) -> List[Tuple[float, float]]:
+    """读取 caller_request_latency 中指定 url 子项的累计桶并合并  只访问对应 labels 子项 不扫描全部"""
+    mgr = get_metrics_manager()
+    if not mgr:
+        return []
+
+    merged: Dict[float, float] = {}
+    for url in urls:
+        child = mgr.caller_histogram.labels(mgr.server_name, url)
+        for metric in child.collect():
+            for sample in metric.samples:
+                if sample.name.endswith("_bucket"):
+                    le = float(sample.labels["le"])
+                    merged[le] = merged.get(le, 0.0) + sample.value
+    return sorted(merged.items())
+
+
+class HedgePolicy:
+    """对冲请求: 首个请求超过 p{quantile} 时延仍未返回 则向另一个节点再发一次 取先返回的
+    预算: 每个请求积累 budget 个令牌 每次对冲消耗 1 个  对冲比例不超过 budget
+    """
+    def __init__(
+        self,
+        quantile: float = 0.95,
+        budget: float = 0.05,
+        max_tokens: float = 10.0,
+        min_delay: float = 0.005,
+        default_delay: float = 0.1,
+        min_samples: int = 50,
+        refresh: float = 1.0,
+    ):
+        self.quantile = quantile
+        self.budget = budget
+        self.max_tokens = max_tokens
+        self.min_delay = min_delay
+        self.default_delay = default_delay # 样本不足时的对冲延迟
+        self.min_samples = min_samples
+        self.refresh = refresh # 分位数缓存时间 秒
+
+        self.tokens = 0.0
+        self.lock = threading.Lock()
+        self._delays: Dict[Tuple[str, str], Tuple[float, float]] = {} # (endpoint, path) -> (delay, stamp)
+        self._endpoints: Dict[str, Set[str]] = {} # path -> 见过的节点  用于样本不足时按 path 聚合
+
+    def _compute_delay(self, endpoint: str, path: str) -> float:
+        peers = [f"{e}{path}" for e in self._endpoints.get(path, ())]
+        for buckets in (caller_latency_buckets(f"{endpoint}{path}"), caller_latency_buckets(*peers)):
+            if buckets and buckets[-1][1] >= self.min_samples:
+                value = histogram_quantile(buckets, self.quantile)
+                if value is not None:
+                    return max(value, self.min_delay)
+        return self.default_delay
+
+    def delay(self, endpoint: str, path: str) -> float:
+        now = time.monotonic()
+        cached = self._delays.get((endpoint, path))
+        if cached and now - cached[1] < self.refresh:
+            return cached[0]
+        self._endpoints.setdefault(path, set()).add(endpoint)
+        value = self._compute_delay(endpoint, path)
+        self._delays[(endpoint, path)] = (value, now)
+        return value
+
+    def on_request(self):
+        with self.lock:
+            self.tokens = min(self.tokens + self.budget, self.max_tokens)
+
+    def try_acquire(self) -> bool:
+        with self.lock:
+            if self.tokens < 1:
+                return False
+            self.tokens -= 1
+            return True
+
+
+def record_hedge(path: str, result: str):
+    mgr = get_metrics_manager()
+    if mgr:
+        mgr.hedge_request.labels(mgr.server_name, path, result).inc()
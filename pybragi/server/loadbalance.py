@@ -1,18 +1,21 @@
 
+import random
 import requests
-import traceback
 import logging
+from typing import Dict, Optional
 
 from pybragi.bragi_config import BragiConfig
-from pybragi.server import dao_server_discovery
-from pybragi.base import hash
+from pybragi.server import health_check, consistent_hash, endpoint_load, circuit_breaker
+from pybragi.server.health_check import health_api_path
 
-health_api_path = "/health"
 
 class LoadBalanceStatus:
     roundrobin_cnt = 0
     weighted_roundrobin_cnt = 0
     hash_balance_cnt = 0
+    least_outstanding_cnt = 0
+    power_of_two_cnt = 0
+    peak_ewma_cnt = 0
     boardcast_cnt = 0
 
 
@@ -28,24 +31,45 @@ def boardcast(servers, use_http: bool = True) -> list:
     return hosts
 
 #  health 超时请求最可能的问题是 对端服务阻塞 所以应该检查服务方ioloop等
+def check_health(server: dict, api_path: str = health_api_path, timeout=0.1) -> bool:
+    if not BragiConfig.LBCheck:
+        return True
+
+    # 熔断中的节点不分配流量  这里只读 选中后由 reserve 占用 half_open 试探名额
+    endpoint = f"{server['ipv4']}:{server['port']}"
+    breakers = circuit_breaker.get_circuit_breakers()
+    if not breakers.is_available(endpoint):
+        return False
+
+    # 启动了后台探测 只查内存表
+    prober = health_check.get_health_prober()
+    if prober is not None:
+        return prober.is_healthy(server)
+
+    # 探测失败只计入本地熔断 远端下线走 circuit_breaker.remote_unregister
+    try:
+        resp = requests.get(f"http://{endpoint}{api_path}", timeout=timeout)
+        return resp.ok
+    except Exception as e:
+        breakers.get(endpoint).on_failure()
+        logging.error(f"{api_path} failed: {endpoint} {e}")
+        return False
+
+
+def reserve(server: dict) -> bool:
+    """选中节点后调用  half_open 节点只有真正被选中时才占用试探名额"""
+    if not BragiConfig.LBCheck:
+        return True
+    return circuit_breaker.get_circuit_breakers().allow(f"{server['ipv4']}:{server['port']}")
+
+
 def roundrobin(servers, api_path: str = health_api_path, use_http: bool = True, timeout=0.1) -> str:
     for _ in range(len(servers)):
         server = servers[LoadBalanceStatus.roundrobin_cnt % len(servers)]
         LoadBalanceStatus.roundrobin_cnt += 1
         host = f"{server['ipv4']}:{server['port']}"
-        ret_host = f"http://{host}" if use_http else host
-        if not BragiConfig.LBCheck:
-            return ret_host
-        
-        try:
-            resp = requests.get(f"http://{host}{api_path}", timeout=timeout)
-            if resp.ok:
-                return ret_host
-        except Exception as e:
-            traceback.print_exc()
-            dao_server_discovery.unregister_server(server['ipv4'], server['port'], server['name'], status="offline_unhealthy", type=server['type'])
-            logging.error(f"{api_path} failed, unregister server: {server['ipv4']}:{server['port']}")
-            continue
+        if check_health(server, api_path, timeout) and reserve(server):
+            return f"http://{host}" if use_http else host
     raise Exception("No healthy server found")
 
 
@@ -74,53 +98,94 @@ def weighted_roundrobin(servers, api_path: str = health_api_path, use_http: bool
             pos -= weight
         
         host = f"{server['ipv4']}:{server['port']}"
-        ret_host = f"http://{host}" if use_http else host
-        if not BragiConfig.LBCheck:
-            return ret_host
-        
-        try:
-            resp = requests.get(f"http://{host}{api_path}", timeout=timeout)
-            if resp.ok:
-                return ret_host
-        except Exception as e:
-            traceback.print_exc()
-            dao_server_discovery.unregister_server(server['ipv4'], server['port'], server['name'], status="offline_unhealthy", type=server['type'])
-            logging.error(f"{api_path} failed, unregister server: {server['ipv4']}:{server['port']}")
-            continue
+        if check_health(server, api_path, timeout) and reserve(server):
+            return f"http://{host}" if use_http else host
     
     raise Exception("No healthy server found")
 
 
-def hash_balance(servers: list, key: str, api_path: str = health_api_path, use_http: bool = True, timeout=0.1) -> str:
-    """哈希负载均衡算法"""
+def hash_balance(servers: list, key: str, api_path: str = health_api_path, use_http: bool = True, timeout=0.1,
+                 vnodes: int = consistent_hash.default_vnodes, loads: Optional[Dict[str, int]] = None, load_factor: float = 1.25) -> str:
+    """一致性哈希负载均衡算法  loads 为 endpoint->负载 时启用 bounded-load"""
     if not servers:
         raise Exception("No servers available")
     
-    hash_value = hash.djb2_hash(key)
-    
-    retry_cnt, max_retry_cnt = 0, len(servers)
-    while retry_cnt < max_retry_cnt:
-        server_index = hash_value % len(servers)
-        idx = server_index % len(servers)
-        server = servers[idx]
+    ring = consistent_hash.get_ring(servers, vnodes)
+    if loads is None:
+        candidates = ring.iter_servers(key)
+    else:
+        candidates = ring.iter_bounded(key, loads, load_factor)
+
+    # 不健康时沿环顺延到下一个节点 其他 key 的映射保持不变
+    for server in candidates:
         host = f"{server['ipv4']}:{server['port']}"
-        ret_host = f"http://{host}" if use_http else host
-        if not BragiConfig.LBCheck:
-            return ret_host
-
-
-        try:
-            resp = requests.get(f"http://{host}{api_path}", timeout=timeout)
-            if resp.ok:
-                LoadBalanceStatus.hash_balance_cnt += 1
-                return ret_host
-        except Exception as e:
-            traceback.print_exc()
-            dao_server_discovery.unregister_server(server['ipv4'], server['port'], server['name'], status="offline_unhealthy", type=server['type'])
-            servers = servers[1:] # remove the unhealthy server
-            logging.error(f"{api_path} failed, unregister server: {server['ipv4']}:{server['port']}")
-            continue
-        retry_cnt += 1
+        if check_health(server, api_path, timeout) and reserve(server):
+            LoadBalanceStatus.hash_balance_cnt += 1
+            return f"http://{host}" if use_http else host
     
     raise Exception("No healthy server found")
 
+
+def least_outstanding(servers: list, api_path: str = health_api_path, use_http: bool = True, timeout=0.1) -> str:
+    """最少未完成请求  负载 = 本地 in-flight + 对端 task_queue_length"""
+    if not servers:
+        raise Exception("No servers available")
+
+    tracker = endpoint_load.get_load_tracker()
+    # 同负载时从轮询位置开始 避免总是打到列表第一个
+    offset = LoadBalanceStatus.least_outstanding_cnt
+    order = sorted(range(len(servers)), key=lambda i: (
+        tracker.load(f"{servers[i]['ipv4']}:{servers[i]['port']}"), (i - offset) % len(servers)
+    ))
+    LoadBalanceStatus.least_outstanding_cnt += 1
+
+    for i in order:
+        server = servers[i]
+        host = f"{server['ipv4']}:{server['port']}"
+        if check_health(server, api_path, timeout) and reserve(server):
+            return f"http://{host}" if use_http else host
+
+    raise Exception("No healthy server found")
+
+
+def power_of_two_choices(servers: list, api_path: str = health_api_path, use_http: bool = True, timeout=0.1) -> str:
+    """随机选两个节点 取负载低的  O(1) 且避免所有调用方同时涌向同一个最空闲节点"""
+    if not servers:
+        raise Exception("No servers available")
+
+    tracker = endpoint_load.get_load_tracker()
+    candidates = [server for server in random.sample(servers, min(2, len(servers))) if check_health(server, api_path, timeout)]
+    candidates.sort(key=lambda x: tracker.load(f"{x['ipv4']}:{x['port']}"))
+    for server in candidates:
+        if reserve(server):
+            LoadBalanceStatus.power_of_two_cnt += 1
+            host = f"{server['ipv4']}:{server['port']}"
+            return f"http://{host}" if use_http else host
+    return least_outstanding(servers, api_path, use_http, timeout)
+
+
+def peak_ewma(servers: list, api_path: str = health_api_path, use_http: bool = True, timeout=0.1) -> str:
+    """peak-EWMA  score = 衰减时延估计 * (未完成请求+1)  取最低分
+    时延样本由 endpoint_load.track_request 记录 慢节点和失败节点分数高 流量自然变少
+    """
+    if not servers:
+        raise Exception("No servers available")
+
+    tracker = endpoint_load.get_load_tracker()
+    scored = []
+    # 随机起点 同分时不总是选第一个
+    offset = random.randrange(len(servers))
+    for i in range(len(servers)):
+        server = servers[(offset + i) % len(servers)]
+        if not check_health(server, api_path, timeout):
+            continue
+        scored.append((tracker.cost(f"{server['ipv4']}:{server['port']}"), i, server))
+
+    # 最低分的节点占用不到 half_open 名额时 (并发选中) 顺延到下一个
+    for _, _, server in sorted(scored, key=lambda x: x[:2]):
+        if reserve(server):
+            LoadBalanceStatus.peak_ewma_cnt += 1
+            host = f"{server['ipv4']}:{server['port']}"
+            return f"http://{host}" if use_http else host
+
+    raise Exception("No healthy server found")
@@ -1,12 +1,104 @@
+import asyncio
+import threading
+import warnings
+from abc import ABC, abstractmethod
+from datetime import datetime, timezone
+from functools import partial
+from typing import Callable, List, Optional, Tuple
 
 
+# mongo 默认把 naive datetime 当作 UTC 存储  TTL 索引也按 UTC 比较  其他实现保持一致
+def utc_now() -> datetime:
+    return datetime.now(timezone.utc).replace(tzinfo=None)
 
-class BaseServerDiscoveryStore:
-    def __init__(self, url: str, database: str, max_pool_size: int):
+
+def now_str() -> str:
+    return datetime.now().strftime("%Y-%m-%d %H:%M:%S.%f")
+
+
+class BaseServerDiscoveryStore(ABC):
+    """服务发现存储接口  dao_server_discovery 和 discovery_cache 只依赖这里的方法
+    同步实现的 async 版本默认放到默认线程池执行  原生异步的实现 (postgre) 反过来覆盖
+    """
+    def __init__(self, url: Optional[str] = None, database: Optional[str] = None, max_pool_size: Optional[int] = None):
+        # 旧接口只保存连接参数  连接由各实现自己管理
+        if url is not None or database is not None or max_pool_size is not None:
+            warnings.warn("BaseServerDiscoveryStore(url, database, max_pool_size) is deprecated, "
+                          "connection settings belong to the concrete store", DeprecationWarning, stacklevel=2)
         self.url = url
         self.database = database
         self.max_pool_size = max_pool_size
 
     def get_db(self):
-        return self.db
-    
+        warnings.warn("BaseServerDiscoveryStore.get_db is deprecated", DeprecationWarning, stacklevel=2)
+        return getattr(self, "db", None)
+
+    # ---------------- registry ----------------
+    @abstractmethod
+    def register_server(self, ipv4: str, port: int, name: str, type: str = "", ttl: float = 0):
+        raise NotImplementedError
+
+    @abstractmethod
+    def unregister_server(self, ipv4: str, port: int, name: str, status: str = "offline", type: str = ""):
+        raise NotImplementedError
+
+    @abstractmethod
+    def heartbeat_servers(self, servers: List[Tuple[str, int, str, str]], ttl: float) -> List[Tuple[str, int, str, str]]:
+        """只续期 online 的记录  返回记录已不存在的 server (如被 TTL 删除)  由 Heartbeat 重新注册"""
+        raise NotImplementedError
+
+    @abstractmethod
+    def get_server_online(self, name: str, type: str = "") -> List[dict]:
+        raise NotImplementedError
+
+    @abstractmethod
+    def get_all_server(self, type, online: bool = True) -> List[dict]:
+        raise NotImplementedError
+
+    # ---------------- leader lease ----------------
+    @abstractmethod
+    def acquire_lease(self, key: str, holder: str, ttl: float) -> Optional[int]:
+        """holder 已持有则续期  过期或不存在则抢占并 token+1  返回 fencing token 失败返回 None"""
+        raise NotImplementedError
+
+    @abstractmethod
+    def release_lease(self, key: str, holder: str, token: int):
+        raise NotImplementedError
+
+    # ---------------- discovery_cache source ----------------
+    @abstractmethod
+    def load(self) -> List[dict]:
+        raise NotImplementedError
+
+    @abstractmethod
+    def etag(self):
+        raise NotImplementedError
+
+    def watch(self, on_change: Callable, stop_event: threading.Event, on_tick: Optional[Callable] = None) -> bool:
+        """阻塞直到 stop_event  有变更时回调 on_change  不支持返回 False 由调用方轮询 etag"""
+        return False
+
+    # ---------------- async ----------------
+    async def _run_sync(self, func, *args, **kwargs):
+        return await asyncio.get_running_loop().run_in_executor(None, partial(func, *args, **kwargs))
+
+    async def aregister_server(self, *args, **kwargs):
+        return await self._run_sync(self.register_server, *args, **kwargs)
+
+    async def aunregister_server(self, *args, **kwargs):
+        return await self._run_sync(self.unregister_server, *args, **kwargs)
+
+    async def aheartbeat_servers(self, *args, **kwargs):
+        return await self._run_sync(self.heartbeat_servers, *args, **kwargs)
+
+    async def aget_server_online(self, *args, **kwargs) -> List[dict]:
+        return await self._run_sync(self.get_server_online, *args, **kwargs)
+
+    async def aget_all_server(self, *args, **kwargs) -> List[dict]:
+        return await self._run_sync(self.get_all_server, *args, **kwargs)
+
+    async def aacquire_lease(self, *args, **kwargs) -> Optional[int]:
+        return await self._run_sync(self.acquire_lease, *args, **kwargs)
+
+    async def arelease_lease(self, *args, **kwargs):
+        return await self._run_sync(self.release_lease, *args, **kwargs)
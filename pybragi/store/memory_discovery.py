@@ -0,0 +1,102 @@
+import threading
+from datetime import timedelta
+from typing import Callable, Dict, List, Optional, Tuple
+
+from pybragi.store.base import BaseServerDiscoveryStore, utc_now, now_str
+
+
+class MemoryDiscoveryStore(BaseServerDiscoveryStore):
+    """进程内的 servers 表和租约  用于测试和无数据库的单机部署"""
+    def __init__(self):
+        self.servers: Dict[Tuple, dict] = {}
+        self.leases: Dict[str, dict] = {}
+        self.version = 0
+        self.lock = threading.Lock()
+        self.listeners: List[Callable] = []
+
+    def _alive(self, server: dict, now) -> bool:
+        expire_at = server.get("expire_at")
+        return server["status"] == "online" and (expire_at is None or expire_at > now)
+
+    def _notify(self):
+        for listener in list(self.listeners):
+            listener()
+
+    def register_server(self, ipv4: str, port: int, name: str, type: str = "", ttl: float = 0, **extra):
+        server = {"ipv4": ipv4, "port": port, "name": name, "type": type, "status": "online", "datetime": now_str(), **extra}
+        if ttl > 0:
+            server["expire_at"] = utc_now() + timedelta(seconds=ttl)
+        with self.lock:
+            self.servers[(ipv4, port, name, type)] = server
+            self.version += 1
+        self._notify()
+
+    def unregister_server(self, ipv4: str, port: int, name: str, status: str = "offline", type: str = ""):
+        if status == "online":
+            status = "offline" # online is forbid for unregister
+        with self.lock:
+            server = self.servers.get((ipv4, port, name, type))
+            if server is None:
+                return
+            server.update({"status": status, "datetime": now_str()})
+            self.version += 1
+        self._notify()
+
+    def heartbeat_servers(self, servers: List[Tuple[str, int, str, str]], ttl: float) -> List[Tuple[str, int, str, str]]:
+        expire_at = utc_now() + timedelta(seconds=ttl)
+        missing = []
+        with self.lock:
+            for key in servers:
+                server = self.servers.get(tuple(key))
+                if server is None:
+                    missing.append(tuple(key))
+                elif server["status"] == "online":
+                    server["expire_at"] = expire_at
+        return missing
+
+    def get_server_online(self, name: str, type: str = "") -> List[dict]:
+        now = utc_now()
+        with self.lock:
+            return [dict(server) for server in self.servers.values()
+                    if server["name"] == name and server["type"] == type and self._alive(server, now)]
+
+    def get_all_server(self, type, online: bool = True) -> List[dict]:
+        now = utc_now()
+        with self.lock:
+            return [dict(server) for server in self.servers.values()
+                    if (type is None or server["type"] == type) and (not online or self._alive(server, now))]
+
+    def acquire_lease(self, key: str, holder: str, ttl: float) -> Optional[int]:
+        now = utc_now()
+        with self.lock:
+            lease = self.leases.get(key)
+            if lease is None:
+                lease = self.leases[key] = {"holder": holder, "token": 1, "expire_at": now}
+            elif lease["holder"] != holder:
+                if lease["expire_at"] >= now:
+                    return None
+                lease["holder"] = holder
+                lease["token"] += 1
+            lease["expire_at"] = now + timedelta(seconds=ttl)
+            return lease["token"]
+
+    def release_lease(self, key: str, holder: str, token: int):
+        with self.lock:
+            lease = self.leases.get(key)
+            if lease is not None and lease["holder"] == holder and lease["token"] == token:
+                lease["expire_at"] = utc_now()
+
+    def load(self) -> List[dict]:
+        with self.lock:
+            return [dict(server) for server in self.servers.values()]
+
+    def etag(self):
+        return self.version
+
+    def watch(self, on_change: Callable, stop_event: threading.Event, on_tick: Optional[Callable] = None) -> bool:
+        self.listeners.append(on_change)
+        while not stop_event.wait(1.0):
+            if on_tick:
+                on_tick()
+        self.listeners.remove(on_change)
+        return True
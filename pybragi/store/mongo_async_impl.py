@@ -0,0 +1,305 @@
+import asyncio
+import logging
+import threading
+import traceback
+import uuid
+import weakref
+from datetime import datetime, timedelta, timezone
+from typing import Any, AsyncIterator, Dict, Optional
+
+from pymongo import errors, monitoring, ASCENDING, ReturnDocument
+try:
+    from motor.motor_asyncio import AsyncIOMotorClient, AsyncIOMotorDatabase, AsyncIOMotorCollection
+except ImportError as e:
+    raise ImportError("mongo_async_impl requires motor, install with: pip install 'pybragi[motor]'") from e
+
+from pybragi.base import metrics
+from pybragi.store.mongo_impl import claimable_condition, claim_token_field, claim_expire_field
+
+
+# mongo_impl 的异步版本  函数签名保持一致  在 tornado / asyncio loop 上直接 await 不需要线程池
+# motor client 绑定创建时的 event loop  这里为每个 loop 懒创建一个 client
+
+
+class PoolMetricsListener(monitoring.ConnectionPoolListener):
+    """连接池事件  写入 MetricsManager (已注册时) 并保留本地计数供 pool_stats 查询
+    所有 loop 的 client 共用一个 listener  按服务端地址汇总  事件在 pymongo 线程中回调
+    """
+    def __init__(self):
+        self.stats: Dict[str, Dict[str, float]] = {}
+        self.lock = threading.Lock()
+
+    def _pool(self, address) -> Dict[str, float]:
+        pool = f"{address[0]}:{address[1]}"
+        if pool not in self.stats:
+            self.stats[pool] = {"connections": 0, "checked_out": 0, "checkout_failed": 0}
+        return self.stats[pool]
+
+    def _gauge(self, event, stat: Dict[str, float]):
+        manager = metrics.get_metrics_manager()
+        if manager:
+            pool = f"{event.address[0]}:{event.address[1]}"
+            manager.mongo_pool_connections.labels(pool, "open").set(stat["connections"])
+            manager.mongo_pool_connections.labels(pool, "checked_out").set(stat["checked_out"])
+
+    def pool_created(self, event):
+        with self.lock:
+            self._pool(event.address)
+
+    def pool_ready(self, event):
+        pass
+
+    def pool_cleared(self, event):
+        pass
+
+    def pool_closed(self, event):
+        pass
+
+    def connection_created(self, event):
+        with self.lock:
+            stat = self._pool(event.address)
+            stat["connections"] += 1
+        self._gauge(event, stat)
+
+    def connection_ready(self, event):
+        pass
+
+    def connection_closed(self, event):
+        with self.lock:
+            stat = self._pool(event.address)
+            stat["connections"] = max(stat["connections"] - 1, 0)
+        self._gauge(event, stat)
+
+    def connection_check_out_started(self, event):
+        pass
+
+    def connection_check_out_failed(self, event):
+        with self.lock:
+            stat = self._pool(event.address)
+            stat["checkout_failed"] += 1
+        manager = metrics.get_metrics_manager()
+        if manager:
+            manager.mongo_pool_checkout_failed.labels(f"{event.address[0]}:{event.address[1]}", str(event.reason)).inc()
+
+    def connection_checked_out(self, event):
+        with self.lock:
+            stat = self._pool(event.address)
+            stat["checked_out"] += 1
+        self._gauge(event, stat)
+        duration = getattr(event, "duration", None) # pymongo>=4.7
+        manager = metrics.get_metrics_manager()
+        if manager and duration is not None:
+            manager.mongo_pool_wait.labels(f"{event.address[0]}:{event.address[1]}").observe(duration)
+
+    def connection_checked_in(self, event):
+        with self.lock:
+            stat = self._pool(event.address)
+            stat["checked_out"] = max(stat["checked_out"] - 1, 0)
+        self._gauge(event, stat)
+
+
+class MongoAsyncOnline(object):
+    url: str = ""
+    database: str = ""
+    max_pool_size: int = 10
+    listener = PoolMetricsListener()
+    clients: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, AsyncIOMotorClient]" = weakref.WeakKeyDictionary()
+
+
+def new_store(url: str, database: str, max_pool_size: int):
+    # 只记录配置  client 在每个 loop 第一次使用时创建
+    MongoAsyncOnline.url = url
+    MongoAsyncOnline.database = database
+    MongoAsyncOnline.max_pool_size = max_pool_size
+
+
+def is_configured() -> bool:
+    return bool(MongoAsyncOnline.url)
+
+
+def get_client() -> AsyncIOMotorClient:
+    loop = asyncio.get_running_loop()
+    client = MongoAsyncOnline.clients.get(loop)
+    if client is None:
+        if not is_configured():
+            raise Exception("mongo_async_impl not initialized, call new_store first")
+        client = AsyncIOMotorClient(MongoAsyncOnline.url, maxPoolSize=MongoAsyncOnline.max_pool_size,
+                                    event_listeners=[MongoAsyncOnline.listener], io_loop=loop)
+        MongoAsyncOnline.clients[loop] = client
+        logging.info(f"mongo async client created for loop {id(loop)}")
+    return client
+
+
+def get_db() -> AsyncIOMotorDatabase:
+    return get_client()[MongoAsyncOnline.database]
+
+
+def close_store():
+    loop = asyncio.get_running_loop()
+    client = MongoAsyncOnline.clients.pop(loop, None)
+    if client is not None:
+        client.close()
+
+
+def pool_stats() -> Dict[str, Dict[str, float]]:
+    listener = MongoAsyncOnline.listener
+    with listener.lock:
+        return {pool: dict(stat) for pool, stat in listener.stats.items()}
+
+
+async def insert_item(table, data: dict):
+    try:
+        result = await get_db()[table].insert_one(data)
+        logging.info(f"insert: {result.inserted_id} {result.acknowledged}")
+        return True
+    except errors.DuplicateKeyError:
+        return False
+    except Exception as e:
+        logging.error(traceback.format_exc())
+        return False
+
+
+async def insert_items(table, data: list):
+    try:
+        result = await get_db()[table].insert_many(data)
+        logging.info(f"insert: {result}")
+        return True
+    except errors.DuplicateKeyError as e:
+        return False
+    except Exception as e:
+        logging.error(traceback.format_exc())
+        return False
+
+
+async def update_item(table, condition, update, upsert=False):
+    collection: AsyncIOMotorCollection = get_db()[table]
+    result = await collection.update_many(condition, update, upsert=upsert)
+    return result
+
+
+async def bulk_write(table, operations: list, ordered=False):
+    collection: AsyncIOMotorCollection = get_db()[table]
+    result = await collection.bulk_write(operations, ordered=ordered)
+    return result
+
+
+async def find_one_and_update(table, condition, update, upsert=False, sort=None):
+    collection: AsyncIOMotorCollection = get_db()[table]
+    return await collection.find_one_and_update(condition, update, sort=sort, upsert=upsert, return_document=ReturnDocument.AFTER)
+
+
+async def query_batch_items(table, conditions, sort=[("_id", ASCENDING)], skip=0, limit=0, projection=None):
+    collection: AsyncIOMotorCollection = get_db()[table]
+
+    cursor = collection.find(conditions, projection=projection, skip=skip, sort=sort, limit=limit)
+    return await cursor.to_list(length=None)
+
+
+async def aggregate(table, pipeline: list[Dict[str, Any]]):
+    collection: AsyncIOMotorCollection = get_db()[table]
+
+    results = collection.aggregate(pipeline)
+    return await results.to_list(length=None)
+
+
+#################################################################################
+
+
+async def get_item(table, condition):
+    collection: AsyncIOMotorCollection = get_db()[table]
+
+    item = await collection.find_one(condition)
+    return item
+
+
+async def get_items(table, condition, projection=None):
+    collection: AsyncIOMotorCollection = get_db()[table]
+
+    items = collection.find(condition, projection=projection)
+    return await items.to_list(length=None)
+
+
+async def iter_items(table, condition, projection=None, sort=None, batch_size=1000) -> AsyncIterator[dict]:
+    collection: AsyncIOMotorCollection = get_db()[table]
+
+    cursor = collection.find(condition, projection=projection, sort=sort, batch_size=batch_size)
+    try:
+        async for item in cursor:
+            yield item
+    finally:
+        await cursor.close()
+
+
+async def count(table, condition):
+    collection = get_db()[table]
+
+    cnt = await collection.count_documents(condition)
+    return cnt
+
+
+async def get_batch_items(
+    table,
+    condition,
+    update={"$set": {"processed": True}},
+    sort=[("_id", ASCENDING)],
+    batch_size=8,
+):
+    collection = get_db()[table]
+
+    items = []
+    for _ in range(batch_size):
+        item = await collection.find_one_and_update(condition, update=update, sort=sort)
+        if item:
+            items.append(item)
+    return items
+
+
+async def claim_batch_items(
+    table,
+    condition,
+    lease: float = 60,
+    sort=[("_id", ASCENDING)],
+    batch_size=8,
+    update: Optional[dict] = None,
+):
+    """同 mongo_impl.claim_batch_items"""
+    collection: AsyncIOMotorCollection = get_db()[table]
+    now = datetime.now(timezone.utc).replace(tzinfo=None)
+    claimable = claimable_condition(condition, now)
+
+    cursor = collection.find(claimable, projection={"_id": 1}, sort=sort, limit=batch_size)
+    ids = [item["_id"] for item in await cursor.to_list(length=None)]
+    if not ids:
+        return "", []
+
+    token = uuid.uuid4().hex
+    claim = {"$set": {claim_token_field: token, claim_expire_field: now + timedelta(seconds=lease)}}
+    for op, fields in (update or {}).items():
+        claim[op] = {**claim.get(op, {}), **fields}
+    result = await collection.update_many({"$and": [{"_id": {"$in": ids}}, claimable]}, claim)
+    if result.modified_count == 0:
+        return token, []
+
+    items = await collection.find({claim_token_field: token}, sort=sort).to_list(length=None)
+    return token, items
+
+
+async def ack_claimed_items(table, token: str, update={"$set": {"processed": True}}, ids: Optional[list] = None):
+    condition = {claim_token_field: token}
+    if ids is not None:
+        condition["_id"] = {"$in": ids}
+    ack = {**update, "$unset": {**update.get("$unset", {}), claim_token_field: "", claim_expire_field: ""}}
+    return await get_db()[table].update_many(condition, ack)
+
+
+async def release_claimed_items(table, token: str, ids: Optional[list] = None):
+    condition = {claim_token_field: token}
+    if ids is not None:
+        condition["_id"] = {"$in": ids}
+    return await get_db()[table].update_many(condition, {"$unset": {claim_token_field: "", claim_expire_field: ""}})
+
+#################################################################################
+
+async def delete_items(table, condition):
+    collection = get_db()[table]
+    await collection.delete_many(condition)
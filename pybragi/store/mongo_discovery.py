@@ -0,0 +1,215 @@
+import logging
+import threading
+from datetime import datetime, timedelta
+from typing import Callable, List, Optional, Tuple
+
+from pymongo import UpdateOne, errors
+
+from pybragi.base.shutdown import global_exit_event
+from pybragi.store import mongo_impl
+
+try:
+    from pybragi.store import mongo_async_impl
+except ImportError: # motor 未安装时 async 方法走线程池
+    mongo_async_impl = None
+from pybragi.store.base import BaseServerDiscoveryStore, utc_now, now_str
+
+
+# 没有 expire_at 的旧记录视为不过期
+def not_expired_condition(now: Optional[datetime] = None) -> dict:
+    return {"$or": [{"expire_at": {"$exists": False}}, {"expire_at": {"$gt": now or utc_now()}}]}
+
+
+class MongoDiscoveryStore(BaseServerDiscoveryStore):
+    """基于全局 mongo_impl 连接  servers 表保留最近 10 条 history"""
+    def __init__(self, table: str = "servers", lease_table: str = "server_leases"):
+        self.table = table
+        self.lease_table = lease_table
+        self.projection = {"history": 0} # history 只用于排查 查询时不返回
+        self.key_projection = {"_id": 0, "ipv4": 1, "port": 1, "name": 1, "type": 1}
+        self._etag_index = False
+
+    def _register(self, ipv4: str, port: int, name: str, type: str = "", ttl: float = 0):
+        now = now_str()
+        query = {"ipv4": ipv4, "port": port, "name": name, "type": type}
+
+        fields = {"status": "online", "datetime": now}
+        if ttl > 0:
+            # 配合 Heartbeat 续期  进程崩溃后 ttl 秒自动从在线列表消失
+            fields["expire_at"] = utc_now() + timedelta(seconds=ttl)
+        update = {
+            "$set": fields,
+            "$push": {
+                "history": {
+                    "$each": [{ "status": "online", "datetime": now }],
+                    "$slice": -10  # 只保留最近的10条记录
+                }
+            }
+        }
+        return query, update
+
+    def register_server(self, ipv4: str, port: int, name: str, type: str = "", ttl: float = 0):
+        query, update = self._register(ipv4, port, name, type, ttl)
+        mongo_impl.update_item(self.table, query, update, upsert=True)
+
+    def _unregister(self, ipv4: str, port: int, name: str, status: str = "offline", type: str = ""):
+        if status == "online":
+            status = "offline" # online is forbid for unregister
+
+        now = now_str()
+        query = {"ipv4": ipv4, "port": port, "name": name, "type": type}
+        logging.info(f"{query}")
+        return query, {
+            "$set": { "status": status, "datetime": now },
+            "$push": {
+                "history": {
+                      "$each": [{ "status": status, "datetime": now }],
+                      "$slice": -10  # 只保留最近的10条记录
+                }
+            }
+        }
+
+    def unregister_server(self, ipv4: str, port: int, name: str, status: str = "offline", type: str = ""):
+        mongo_impl.update_item(self.table, *self._unregister(ipv4, port, name, status, type))
+
+    def _heartbeat(self, servers: List[Tuple[str, int, str, str]], ttl: float) -> list:
+        expire_at = utc_now() + timedelta(seconds=ttl)
+        return [
+            UpdateOne({"ipv4": ipv4, "port": port, "name": name, "type": type, "status": "online"}, {"$set": {"expire_at": expire_at}})
+            for ipv4, port, name, type in servers
+        ]
+
+    def _missing_query(self, servers: List[Tuple[str, int, str, str]]) -> dict:
+        return {"$or": [{"ipv4": ipv4, "port": port, "name": name, "type": type} for ipv4, port, name, type in servers]}
+
+    def _missing(self, servers: List[Tuple[str, int, str, str]], existing: List[dict]) -> List[Tuple[str, int, str, str]]:
+        found = {(item["ipv4"], item["port"], item["name"], item["type"]) for item in existing}
+        return [tuple(server) for server in servers if tuple(server) not in found]
+
+    def heartbeat_servers(self, servers: List[Tuple[str, int, str, str]], ttl: float) -> List[Tuple[str, int, str, str]]:
+        """一次 bulk_write 续期  只续期 online 的记录  已下线的不会被心跳拉回
+        返回记录已不存在 (被 TTL 删除) 的 server  由调用方重新注册
+        """
+        if not servers:
+            return []
+        result = mongo_impl.bulk_write(self.table, self._heartbeat(servers, ttl))
+        if result.matched_count >= len(servers):
+            return []
+        existing = mongo_impl.get_items(self.table, self._missing_query(servers), projection=self.key_projection)
+        return self._missing(servers, existing)
+
+    def get_server_online(self, name: str, type: str = "") -> List[dict]:
+        query = {"name": name, "status": "online", "type": type, **not_expired_condition()}
+        return mongo_impl.get_items(self.table, query, projection=self.projection)
+
+    def _all_server_query(self, type, online: bool) -> dict:
+        if type is None:
+            query = {}
+        else:
+            query = {"type": type}
+
+        if online:
+            query["status"] = "online"
+            query.update(not_expired_condition())
+        return query
+
+    def get_all_server(self, type, online: bool = True) -> List[dict]:
+        return mongo_impl.get_items(self.table, self._all_server_query(type, online), projection=self.projection)
+
+    # mongo_async_impl.new_store 之后在 loop 上直接执行  否则回退到线程池
+    def use_async(self) -> bool:
+        return mongo_async_impl is not None and mongo_async_impl.is_configured()
+
+    async def aregister_server(self, ipv4: str, port: int, name: str, type: str = "", ttl: float = 0):
+        if not self.use_async():
+            return await super().aregister_server(ipv4, port, name, type, ttl=ttl)
+        query, update = self._register(ipv4, port, name, type, ttl)
+        await mongo_async_impl.update_item(self.table, query, update, upsert=True)
+
+    async def aunregister_server(self, ipv4: str, port: int, name: str, status: str = "offline", type: str = ""):
+        if not self.use_async():
+            return await super().aunregister_server(ipv4, port, name, status=status, type=type)
+        await mongo_async_impl.update_item(self.table, *self._unregister(ipv4, port, name, status, type))
+
+    async def aheartbeat_servers(self, servers: List[Tuple[str, int, str, str]], ttl: float) -> List[Tuple[str, int, str, str]]:
+        if not self.use_async():
+            return await super().aheartbeat_servers(servers, ttl)
+        if not servers:
+            return []
+        result = await mongo_async_impl.bulk_write(self.table, self._heartbeat(servers, ttl))
+        if result.matched_count >= len(servers):
+            return []
+        existing = await mongo_async_impl.get_items(self.table, self._missing_query(servers), projection=self.key_projection)
+        return self._missing(servers, existing)
+
+    async def aget_server_online(self, name: str, type: str = "") -> List[dict]:
+        if not self.use_async():
+            return await super().aget_server_online(name, type)
+        query = {"name": name, "status": "online", "type": type, **not_expired_condition()}
+        return await mongo_async_impl.get_items(self.table, query, projection=self.projection)
+
+    async def aget_all_server(self, type, online: bool = True) -> List[dict]:
+        if not self.use_async():
+            return await super().aget_all_server(type, online)
+        return await mongo_async_impl.get_items(self.table, self._all_server_query(type, online), projection=self.projection)
+
+    def ensure_ttl_index(self):
+        # expire_at 到期后由 mongo TTL monitor 删除 (约 60s 一次)  查询侧另有 expire_at 过滤
+        mongo_impl.get_db()[self.table].create_index("expire_at", expireAfterSeconds=0)
+
+    def acquire_lease(self, key: str, holder: str, ttl: float) -> Optional[int]:
+        now = utc_now()
+        expire_at = now + timedelta(seconds=ttl)
+
+        # 1. 已经是 holder  续期
+        doc = mongo_impl.find_one_and_update(self.lease_table, {"_id": key, "holder": holder}, {"$set": {"expire_at": expire_at}})
+        if doc is None:
+            # 2. 租约过期或不存在  抢占并自增 token  文档存在且未过期时 upsert 会冲突
+            try:
+                doc = mongo_impl.find_one_and_update(
+                    self.lease_table,
+                    {"_id": key, "expire_at": {"$lt": now}},
+                    {"$set": {"holder": holder, "expire_at": expire_at}, "$inc": {"token": 1}},
+                    upsert=True,
+                )
+            except errors.DuplicateKeyError:
+                doc = None
+
+        if doc is None or doc.get("holder") != holder:
+            return None
+        return doc["token"]
+
+    def release_lease(self, key: str, holder: str, token: int):
+        mongo_impl.update_item(self.lease_table, {"_id": key, "holder": holder, "token": token}, {"$set": {"expire_at": utc_now()}})
+
+    def load(self) -> List[dict]:
+        return list(mongo_impl.iter_items(self.table, {}, projection={**self.projection, "_id": 0}))
+
+    def etag(self):
+        collection = mongo_impl.get_db()[self.table]
+        if not self._etag_index:
+            # 每个 poll_interval 按 datetime 取最新一条  没有索引时是全表排序  已存在时 create_index 不做任何事
+            collection.create_index("datetime")
+            self._etag_index = True
+        latest = collection.find_one({}, sort=[("datetime", -1)], projection={"datetime": 1, "_id": 0})
+        return collection.estimated_document_count(), latest["datetime"] if latest else ""
+
+    def watch(self, on_change: Callable, stop_event: threading.Event, on_tick: Optional[Callable] = None) -> bool:
+        # 只续期 expire_at 的心跳更新不触发刷新  过期由 on_tick 按时间检查
+        pipeline = [{"$match": {"$or": [
+            {"operationType": {"$ne": "update"}},
+            {"updateDescription.updatedFields.status": {"$exists": True}},
+        ]}}]
+        try:
+            with mongo_impl.get_db()[self.table].watch(pipeline, max_await_time_ms=1000) as stream:
+                logging.info(f"discovery watching change stream: {self.table}")
+                while stream.alive and not stop_event.is_set() and not global_exit_event().is_set():
+                    if stream.try_next() is not None:
+                        on_change()
+                    elif on_tick:
+                        on_tick()
+            return True
+        except errors.OperationFailure as e:
+            # standalone mongod 不支持 change stream
+            logging.info(f"change stream unavailable, fallback to polling: {e}")
+            return False
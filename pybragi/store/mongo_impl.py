@@ -2,11 +2,12 @@ import sys, os
 import json
 import logging
 import traceback
-from datetime import datetime
-from typing import Any, Dict
+import uuid
+from datetime import datetime, timedelta, timezone
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple
 
 from pymongo.database import Database, Collection
-from pymongo import errors, MongoClient, ASCENDING
+from pymongo import errors, MongoClient, ASCENDING, ReturnDocument
 
 
 class MongoOnline(object):
@@ -53,10 +54,22 @@ def update_item(table, condition, update, upsert=False):
     return result
 
 
-def query_batch_items(table, conditions, sort=[("_id", ASCENDING)], skip=0, limit=0):
+def bulk_write(table, operations: list, ordered=False):
     collection: Collection = get_db()[table]
+    result = collection.bulk_write(operations, ordered=ordered)
+    return result
+
+
+def find_one_and_update(table, condition, update, upsert=False, sort=None):
+    collection: Collection = get_db()[table]
+    return collection.find_one_and_update(condition, update, sort=sort, upsert=upsert, return_document=ReturnDocument.AFTER)
+
 
-    cursor = collection.find(conditions, skip=skip, sort=sort, limit=limit)
+def query_batch_items(table, conditions, sort=[("_id", ASCENDING)], skip=0, limit=0, projection=None):
+    # skip 需要服务端逐条跳过 深分页请使用 query_page / iter_pages
+    collection: Collection = get_db()[table]
+
+    cursor = collection.find(conditions, projection=projection, skip=skip, sort=sort, limit=limit)
     return list(cursor)
 
 def aggregate(table, pipeline: list[Dict[str, Any]]):
@@ -75,12 +88,78 @@ def get_item(table, condition):
     item = collection.find_one(condition)
     return item
 
-def get_items(table, condition):
+def get_items(table, condition, projection=None):
     collection: Collection = get_db()[table]
 
-    items = collection.find(condition)
+    items = collection.find(condition, projection=projection)
     return list(items)
 
+
+def iter_items(table, condition, projection=None, sort=None, batch_size=1000) -> Iterator[dict]:
+    """流式遍历  每次从服务端取 batch_size 条  内存占用与结果集大小无关"""
+    collection: Collection = get_db()[table]
+
+    with collection.find(condition, projection=projection, sort=sort, batch_size=batch_size) as cursor:
+        yield from cursor
+
+
+def _keyset_condition(condition, key: str, direction: int, after: Optional[Tuple]):
+    if after is None:
+        return condition
+    op = "$gt" if direction == ASCENDING else "$lt"
+    last_key, last_id = after
+    if key == "_id":
+        seek = {"_id": {op: last_id}}
+    else:
+        # key 可能重复  用 _id 做第二排序键保证翻页不重不漏
+        seek = {"$or": [{key: {op: last_key}}, {key: last_key, "_id": {op: last_id}}]}
+    return {"$and": [condition, seek]}
+
+
+def query_page(table, condition, after: Optional[Tuple] = None, limit=100, key="_id", direction=ASCENDING,
+               projection=None) -> Tuple[List[dict], Optional[Tuple]]:
+    """keyset 分页  代替 skip/limit  深分页代价与页号无关 (需要 key 上有索引)
+    after 为上一页返回的游标  返回 (items, next_after)  next_after 为 None 表示没有下一页
+    """
+    collection: Collection = get_db()[table]
+
+    sort = [("_id", direction)] if key == "_id" else [(key, direction), ("_id", direction)]
+    projection, hidden = _page_projection(projection, key)
+
+    items = list(collection.find(_keyset_condition(condition, key, direction, after),
+                                 projection=projection, sort=sort, limit=limit))
+    next_after = (items[-1].get(key), items[-1]["_id"]) if len(items) >= limit else None
+    for item in items if hidden else ():
+        for field in hidden:
+            item.pop(field, None)
+    return items, next_after
+
+
+def _page_projection(projection, key: str) -> Tuple[Optional[dict], List[str]]:
+    """翻页游标需要 key 和 _id  包含型投影补上  排除型投影去掉对它们的排除
+    返回 (实际使用的投影, 调用方投影里不包含 需要从结果中去掉的字段)
+    """
+    if not projection:
+        return projection, []
+    cursor_fields = {key, "_id"}
+    if any(value for field, value in projection.items() if field != "_id"): # 包含型投影 _id 默认返回 其他字段默认不返回
+        hidden = [field for field in cursor_fields if not projection.get(field, field == "_id")]
+        return {**projection, key: 1, "_id": 1}, hidden
+    hidden = [field for field in cursor_fields if field in projection and not projection[field]]
+    projection = {field: value for field, value in projection.items() if field not in cursor_fields}
+    return projection or None, hidden
+
+
+def iter_pages(table, condition, page_size=1000, key="_id", direction=ASCENDING, projection=None) -> Iterator[List[dict]]:
+    after = None
+    while True:
+        items, after = query_page(table, condition, after, page_size, key, direction, projection)
+        if items:
+            yield items
+        if after is None:
+            return
+
+
 def count(table, condition):
     collection = get_db()[table]
 
@@ -104,6 +183,70 @@ def get_batch_items(
             items.append(item)
     return items
 
+
+claim_token_field = "claim_token"
+claim_expire_field = "claim_expire_at"
+
+
+def claimable_condition(condition, now: datetime):
+    # 未被领取 或 租约已过期 (消费者崩溃后可被重新领取)
+    return {"$and": [condition, {"$or": [
+        {claim_token_field: None},
+        {claim_expire_field: {"$lt": now}},
+    ]}]}
+
+
+def claim_batch_items(
+    table,
+    condition,
+    lease: float = 60,
+    sort=[("_id", ASCENDING)],
+    batch_size=8,
+    update: Optional[dict] = None,
+):
+    """批量领取 固定 3 次往返 与 batch_size 无关
+    1. 按 sort 查出候选 _id (只投影 _id)
+    2. update_many 以 "仍未被领取" 为条件写入 claim_token 和租约到期时间  并发消费者之间只有一个能写成功
+    3. 按 claim_token 取回本次领取成功的文档
+    处理完成后调用 ack_claimed_items  超过 lease 秒未 ack 的文档会被其他消费者重新领取
+    返回 (claim_token, items)  需要在领取时设置的字段通过 update 的 $set 传入
+    """
+    collection: Collection = get_db()[table]
+    now = datetime.now(timezone.utc).replace(tzinfo=None)
+    claimable = claimable_condition(condition, now)
+
+    ids = [item["_id"] for item in collection.find(claimable, projection={"_id": 1}, sort=sort, limit=batch_size)]
+    if not ids:
+        return "", []
+
+    token = uuid.uuid4().hex
+    claim = {"$set": {claim_token_field: token, claim_expire_field: now + timedelta(seconds=lease)}}
+    for op, fields in (update or {}).items():
+        claim[op] = {**claim.get(op, {}), **fields}
+    result = collection.update_many({"$and": [{"_id": {"$in": ids}}, claimable]}, claim)
+    if result.modified_count == 0:
+        return token, []
+
+    items = list(collection.find({claim_token_field: token}, sort=sort))
+    return token, items
+
+
+def ack_claimed_items(table, token: str, update={"$set": {"processed": True}}, ids: Optional[list] = None):
+    """确认处理完成  清除租约字段并写入 update  ids 为空时确认整批"""
+    condition = {claim_token_field: token}
+    if ids is not None:
+        condition["_id"] = {"$in": ids}
+    ack = {**update, "$unset": {**update.get("$unset", {}), claim_token_field: "", claim_expire_field: ""}}
+    return get_db()[table].update_many(condition, ack)
+
+
+def release_claimed_items(table, token: str, ids: Optional[list] = None):
+    """放弃领取  文档立即可被重新领取"""
+    condition = {claim_token_field: token}
+    if ids is not None:
+        condition["_id"] = {"$in": ids}
+    return get_db()[table].update_many(condition, {"$unset": {claim_token_field: "", claim_expire_field: ""}})
+
 #################################################################################
 
 def delete_items(table, condition):
@@ -111,15 +254,31 @@ def delete_items(table, condition):
     collection.delete_many(condition)
 
 
+def _json_default(obj):
+    if isinstance(obj, datetime):
+        return obj.strftime("%Y-%m-%d %H:%M:%S.%f")
+    return str(obj)
+
+
+def pretty_print_stream(items: Iterable[dict], fp=None):
+    """逐条输出 JSON 数组  配合 iter_items 导出大表时内存恒定"""
+    fp = fp or sys.stdout
+    fp.write("[")
+    for i, item in enumerate(items):
+        fp.write(",\n" if i else "\n")
+        fp.write(json.dumps(item, indent=2, ensure_ascii=False, default=_json_default))
+    fp.write("\n]\n")
+
+
 def pretty_print(data):
     from pydantic import BaseModel
     if isinstance(data, list):
         for item in data:
             if '_id' in item:
                 item['_id'] = str(item['_id'])
-        return json.dumps(data, indent=2, ensure_ascii=False)
+        return json.dumps(data, indent=2, ensure_ascii=False, default=_json_default)
     elif isinstance(data, dict):
-        return json.dumps(data, indent=2, ensure_ascii=False)
+        return json.dumps(data, indent=2, ensure_ascii=False, default=_json_default)
     elif isinstance(data, BaseModel):
         return data.model_dump_json(indent=2, ensure_ascii=False)
     else:
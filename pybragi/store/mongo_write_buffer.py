@@ -0,0 +1,202 @@
+import asyncio
+import atexit
+import logging
+import threading
+import time
+import traceback
+from typing import Callable, Dict, List, Optional, Tuple
+
+from pymongo import errors
+
+from pybragi.base.metrics import get_metrics_manager
+from pybragi.base.shutdown import global_exit_event
+from pybragi.store import mongo_impl
+
+
+duplicate_key_code = 11000
+
+
+def _on_event_loop() -> bool:
+    try:
+        asyncio.get_running_loop()
+        return True
+    except RuntimeError:
+        return False
+
+
+class WriteBehindBuffer:
+    """按表缓冲 insert  满 max_batch 条或最早一条等待超过 flush_interval 时一次 insert_many(ordered=False)
+    重复 _id 等单条失败不影响同批其他文档  通过 on_duplicate / on_error 回调上报
+    待写总数达到 max_pending 时 普通线程里 put 最多阻塞 block_timeout  仍然满则由调用线程自己写 (caller runs)
+    在 event loop 线程里 put 从不阻塞也不同步写  满了直接丢弃 计入 stats["dropped"] 和 mongo_write_dropped
+    global_exit_event 置位后 (仍在 drain 的请求) 继续接收 put 并且每轮写完全部缓冲  close 或进程退出 (atexit) 时写完剩余数据再退出
+    """
+    def __init__(self, max_batch: int = 500, flush_interval: float = 0.2, max_pending: int = 20000, block_timeout: float = 0.0,
+                 on_duplicate: Optional[Callable[[str, List[dict]], None]] = None,
+                 on_error: Optional[Callable[[str, List[dict], Exception], None]] = None):
+        self.max_batch = max_batch
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self.block_timeout = block_timeout
+        self.on_duplicate = on_duplicate
+        self.on_error = on_error
+
+        self.pending: Dict[str, List[dict]] = {}
+        self.first_put: Dict[str, float] = {}
+        self.pending_count = 0
+        self.stats = {"inserted": 0, "duplicated": 0, "failed": 0, "flushes": 0, "caller_runs": 0, "dropped": 0}
+
+        self.lock = threading.Lock()
+        self.not_empty = threading.Condition(self.lock)
+        self.not_full = threading.Condition(self.lock)
+
+        self._stop_event = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def _exiting(self) -> bool:
+        return self._stop_event.is_set() or global_exit_event().is_set()
+
+    def put(self, table: str, doc: dict) -> bool:
+        """返回 False 表示在 event loop 上缓冲已满或已停止  doc 被丢弃"""
+        on_loop = _on_event_loop()
+        with self.lock:
+            if self.pending_count >= self.max_pending and self.block_timeout > 0 and not on_loop and not self._exiting():
+                self.not_full.wait_for(lambda: self.pending_count < self.max_pending or self._exiting(), self.block_timeout)
+
+            direct = self.pending_count >= self.max_pending or not self.is_running()
+            if not direct:
+                docs = self.pending.setdefault(table, [])
+                if not docs:
+                    self.first_put[table] = time.monotonic()
+                docs.append(doc)
+                self.pending_count += 1
+                if len(docs) >= self.max_batch:
+                    self.not_empty.notify()
+                return True
+
+            if on_loop:
+                self.stats["dropped"] += 1
+            else:
+                self.stats["caller_runs"] += 1
+
+        if on_loop:
+            logging.warning(f"write buffer full or stopped, drop {table} doc on event loop")
+            mgr = get_metrics_manager()
+            if mgr:
+                mgr.mongo_write_dropped.labels(table).inc()
+            return False
+        # 写线程跟不上或已退出  调用方同步写入 自然限速
+        self._write(table, [doc])
+        return True
+
+    def _take(self, force: bool) -> List[Tuple[str, List[dict]]]:
+        now = time.monotonic()
+        batches = []
+        for table in list(self.pending):
+            docs = self.pending[table]
+            if not docs:
+                continue
+            if force or len(docs) >= self.max_batch or now - self.first_put[table] >= self.flush_interval:
+                for i in range(0, len(docs), self.max_batch):
+                    batches.append((table, docs[i:i + self.max_batch]))
+                self.pending[table] = []
+                self.pending_count -= len(docs)
+        if batches:
+            self.not_full.notify_all()
+        return batches
+
+    def _write(self, table: str, docs: List[dict]):
+        inserted, duplicated, failed = len(docs), [], []
+        try:
+            mongo_impl.get_db()[table].insert_many(docs, ordered=False)
+        except errors.BulkWriteError as e:
+            write_errors = e.details.get("writeErrors", [])
+            for error in write_errors:
+                if error.get("code") == duplicate_key_code:
+                    duplicated.append(docs[error["index"]])
+                else:
+                    failed.append(docs[error["index"]])
+                    logging.error(f"insert {table} failed: {error.get('code')} {error.get('errmsg')}")
+            inserted = e.details.get("nInserted", len(docs) - len(write_errors))
+            if failed and self.on_error:
+                self.on_error(table, failed, e)
+        except Exception as e:
+            logging.error(traceback.format_exc())
+            inserted, failed = 0, docs
+            if self.on_error:
+                self.on_error(table, docs, e)
+
+        if duplicated:
+            logging.info(f"insert {table} duplicated: {len(duplicated)}")
+            if self.on_duplicate:
+                self.on_duplicate(table, duplicated)
+
+        with self.lock:
+            self.stats["inserted"] += inserted
+            self.stats["duplicated"] += len(duplicated)
+            self.stats["failed"] += len(failed)
+            self.stats["flushes"] += 1
+
+    def flush(self):
+        """同步写入当前缓冲的全部数据"""
+        with self.lock:
+            batches = self._take(force=True)
+        for table, docs in batches:
+            self._write(table, docs)
+
+    def _run(self):
+        while not self._stop_event.is_set():
+            with self.lock:
+                self.not_empty.wait(self.flush_interval / 2)
+                batches = self._take(force=global_exit_event().is_set())
+            for table, docs in batches:
+                self._write(table, docs)
+
+        self.flush()
+        logging.info(f"write behind buffer exit, stats: {self.stats}")
+
+    def is_running(self) -> bool:
+        """close 之前都接收 put  global_exit_event 不影响  否则 drain 中的请求写入会被丢弃"""
+        return self._thread is not None and self._thread.is_alive() and not self._stop_event.is_set()
+
+    def start(self):
+        if self._thread and self._thread.is_alive():
+            return
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._run, name="mongo_write_buffer", daemon=True)
+        self._thread.start()
+        # 写线程是 daemon  解释器退出前由 atexit 写完剩余数据
+        atexit.unregister(self.close)
+        atexit.register(self.close)
+
+    def close(self, timeout: float = 5.0):
+        self._stop_event.set()
+        with self.lock:
+            self.not_empty.notify_all()
+            self.not_full.notify_all()
+        if self._thread:
+            self._thread.join(timeout=timeout)
+        self.flush() # join 超时或未启动时兜底
+
+
+write_buffer: Optional[WriteBehindBuffer] = None
+
+
+def get_write_buffer() -> Optional[WriteBehindBuffer]:
+    global write_buffer
+    return write_buffer
+
+
+def start_write_buffer(**kwargs) -> WriteBehindBuffer:
+    global write_buffer
+    buffer = WriteBehindBuffer(**kwargs)
+    buffer.start()
+    write_buffer = buffer
+    return buffer
+
+
+def insert_item_later(table: str, data: dict):
+    """start_write_buffer 之后合并写入  否则退化为 mongo_impl.insert_item (同步写 不要在 event loop 上调用)"""
+    if write_buffer is None:
+        return mongo_impl.insert_item(table, data)
+    return write_buffer.put(table, data)
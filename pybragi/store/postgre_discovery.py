@@ -0,0 +1,203 @@
+import asyncio
+import functools
+import logging
+import threading
+from datetime import timedelta
+from typing import List, Optional, Tuple
+
+from pybragi.store.base import BaseServerDiscoveryStore, utc_now, now_str
+from pybragi.store.postgre_impl import PostgreImpl
+
+
+servers_ddl = """
+CREATE TABLE IF NOT EXISTS {table} (
+    ipv4 VARCHAR(64) NOT NULL,
+    port INTEGER NOT NULL,
+    name VARCHAR(128) NOT NULL,
+    type VARCHAR(128) NOT NULL DEFAULT '',
+    status VARCHAR(32) NOT NULL,
+    datetime VARCHAR(32) NOT NULL,
+    expire_at TIMESTAMP NULL,
+    updated_at TIMESTAMP NOT NULL DEFAULT (now() at time zone 'utc'),
+    PRIMARY KEY (ipv4, port, name, type)
+);
+CREATE INDEX IF NOT EXISTS {table}_name_type_idx ON {table} (name, type, status);
+"""
+
+leases_ddl = """
+CREATE TABLE IF NOT EXISTS {table} (
+    key VARCHAR(256) PRIMARY KEY,
+    holder VARCHAR(128) NOT NULL,
+    token BIGINT NOT NULL DEFAULT 1,
+    expire_at TIMESTAMP NOT NULL
+);
+"""
+
+server_columns = "ipv4, port, name, type, status, datetime, expire_at"
+
+
+def _row_to_server(row) -> dict:
+    server = dict(row)
+    if server.get("expire_at") is None:
+        server.pop("expire_at", None) # 和 mongo 保持一致  未设置 ttl 的记录没有 expire_at
+    return server
+
+
+def _on_store_loop(func):
+    """连接池绑定在创建它的 loop 上  在其他 loop 调用时提交到 store 的 loop 执行 再在调用方的 loop 上等待"""
+    @functools.wraps(func)
+    async def wrapper(self, *args, **kwargs):
+        coro = func(self, *args, **kwargs)
+        if self.loop is None or self.loop is asyncio.get_running_loop():
+            return await coro
+        return await asyncio.wrap_future(asyncio.run_coroutine_threadsafe(coro, self.loop))
+    return wrapper
+
+
+class PostgreDiscoveryStore(BaseServerDiscoveryStore):
+    """PostgreSQL 实现  async 方法原生执行  调用方的 loop 不是 self.loop 时提交到 self.loop 执行
+    同步方法提交到 PostgreImpl 所在的 loop 并等待结果  不在 loop 线程内调用同步方法  否则会死锁
+    没有 history 和变更通知  discovery_cache 按 etag 轮询
+    """
+    def __init__(self, db: PostgreImpl, loop: Optional[asyncio.AbstractEventLoop] = None,
+                 table: str = "servers", lease_table: str = "server_leases"):
+        self.db = db
+        self.loop = loop
+        self.table = table
+        self.lease_table = lease_table
+
+    @classmethod
+    def start(cls, host: str, port: int, database: str, user: str, password: str, max_pool_size: int = 4, **kwargs) -> "PostgreDiscoveryStore":
+        """同步程序使用  在后台线程起一个 loop 持有连接池"""
+        loop = asyncio.new_event_loop()
+        threading.Thread(target=loop.run_forever, name="postgre_discovery", daemon=True).start()
+
+        db = PostgreImpl(host, port, database, user, password, max_pool_size)
+        store = cls(db, loop, **kwargs)
+        asyncio.run_coroutine_threadsafe(db.initdb(), loop).result()
+        asyncio.run_coroutine_threadsafe(store.init_tables(), loop).result()
+        return store
+
+    async def init_tables(self):
+        await self.db.check_table(self.table, servers_ddl.format(table=self.table))
+        await self.db.check_table(self.lease_table, leases_ddl.format(table=self.lease_table))
+
+    def _run(self, coro):
+        if self.loop is None:
+            raise Exception("PostgreDiscoveryStore sync api needs a loop, use PostgreDiscoveryStore.start")
+        return asyncio.run_coroutine_threadsafe(coro, self.loop).result()
+
+    # ---------------- async ----------------
+    @_on_store_loop
+    async def aregister_server(self, ipv4: str, port: int, name: str, type: str = "", ttl: float = 0):
+        expire_at = utc_now() + timedelta(seconds=ttl) if ttl > 0 else None
+        await self.db.execute(f"""
+            INSERT INTO {self.table} (ipv4, port, name, type, status, datetime, expire_at, updated_at)
+            VALUES ($1, $2, $3, $4, 'online', $5, $6, $7)
+            ON CONFLICT (ipv4, port, name, type) DO UPDATE
+            SET status = EXCLUDED.status, datetime = EXCLUDED.datetime,
+                expire_at = EXCLUDED.expire_at, updated_at = EXCLUDED.updated_at
+        """, {"ipv4": ipv4, "port": port, "name": name, "type": type, "datetime": now_str(), "expire_at": expire_at, "updated_at": utc_now()})
+
+    @_on_store_loop
+    async def aunregister_server(self, ipv4: str, port: int, name: str, status: str = "offline", type: str = ""):
+        if status == "online":
+            status = "offline" # online is forbid for unregister
+        logging.info(f"unregister {ipv4}:{port} {name} {type} {status}")
+        await self.db.execute(f"""
+            UPDATE {self.table} SET status = $5, datetime = $6, updated_at = $7
+            WHERE ipv4 = $1 AND port = $2 AND name = $3 AND type = $4
+        """, {"ipv4": ipv4, "port": port, "name": name, "type": type, "status": status, "datetime": now_str(), "updated_at": utc_now()})
+
+    @_on_store_loop
+    async def aheartbeat_servers(self, servers: List[Tuple[str, int, str, str]], ttl: float) -> List[Tuple[str, int, str, str]]:
+        # 续期不更新 updated_at  不会触发 discovery_cache 刷新  offline 的记录不续期
+        # 记录被删除时直接重新插入 (updated_at 取默认值 触发刷新)  所以不会有需要调用方重新注册的 server
+        if not servers:
+            return []
+        expire_at = utc_now() + timedelta(seconds=ttl)
+        await self.db.execute_many(f"""
+            INSERT INTO {self.table} AS server (ipv4, port, name, type, status, datetime, expire_at)
+            VALUES ($1, $2, $3, $4, 'online', $5, $6)
+            ON CONFLICT (ipv4, port, name, type) DO UPDATE
+            SET expire_at = EXCLUDED.expire_at WHERE server.status = 'online'
+        """, [(ipv4, port, name, type, now_str(), expire_at) for ipv4, port, name, type in servers])
+        return []
+
+    @_on_store_loop
+    async def aget_server_online(self, name: str, type: str = "") -> List[dict]:
+        rows = await self.db.query(f"""
+            SELECT {server_columns} FROM {self.table}
+            WHERE name = $1 AND type = $2 AND status = 'online' AND (expire_at IS NULL OR expire_at > $3)
+        """, {"name": name, "type": type, "now": utc_now()}, multirows=True)
+        return [_row_to_server(row) for row in rows]
+
+    @_on_store_loop
+    async def aget_all_server(self, type, online: bool = True) -> List[dict]:
+        conditions, params = [], {}
+        if type is not None:
+            params["type"] = type
+            conditions.append(f"type = ${len(params)}")
+        if online:
+            params["now"] = utc_now()
+            conditions.append(f"status = 'online' AND (expire_at IS NULL OR expire_at > ${len(params)})")
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+        rows = await self.db.query(f"SELECT {server_columns} FROM {self.table} {where}", params, multirows=True)
+        return [_row_to_server(row) for row in rows]
+
+    @_on_store_loop
+    async def aacquire_lease(self, key: str, holder: str, ttl: float) -> Optional[int]:
+        # 单条语句完成 续期 / 抢占过期租约 / 首次创建  未过期且 holder 不同时 WHERE 不满足 不返回行
+        now = utc_now()
+        row = await self.db.query(f"""
+            INSERT INTO {self.lease_table} AS lease (key, holder, token, expire_at) VALUES ($1, $2, 1, $3)
+            ON CONFLICT (key) DO UPDATE
+            SET holder = EXCLUDED.holder, expire_at = EXCLUDED.expire_at,
+                token = CASE WHEN lease.holder = EXCLUDED.holder THEN lease.token ELSE lease.token + 1 END
+            WHERE lease.holder = EXCLUDED.holder OR lease.expire_at < $4
+            RETURNING token
+        """, {"key": key, "holder": holder, "expire_at": now + timedelta(seconds=ttl), "now": now})
+        return row["token"] if row else None
+
+    @_on_store_loop
+    async def arelease_lease(self, key: str, holder: str, token: int):
+        await self.db.execute(f"UPDATE {self.lease_table} SET expire_at = $4 WHERE key = $1 AND holder = $2 AND token = $3",
+                              {"key": key, "holder": holder, "token": token, "expire_at": utc_now()})
+
+    @_on_store_loop
+    async def aload(self) -> List[dict]:
+        rows = await self.db.query(f"SELECT {server_columns} FROM {self.table}", multirows=True)
+        return [_row_to_server(row) for row in rows]
+
+    @_on_store_loop
+    async def aetag(self):
+        row = await self.db.query(f"SELECT count(*) AS count, max(updated_at) AS updated_at FROM {self.table}")
+        return row["count"], row["updated_at"]
+
+    # ---------------- sync ----------------
+    def register_server(self, *args, **kwargs):
+        return self._run(self.aregister_server(*args, **kwargs))
+
+    def unregister_server(self, *args, **kwargs):
+        return self._run(self.aunregister_server(*args, **kwargs))
+
+    def heartbeat_servers(self, *args, **kwargs):
+        return self._run(self.aheartbeat_servers(*args, **kwargs))
+
+    def get_server_online(self, *args, **kwargs) -> List[dict]:
+        return self._run(self.aget_server_online(*args, **kwargs))
+
+    def get_all_server(self, *args, **kwargs) -> List[dict]:
+        return self._run(self.aget_all_server(*args, **kwargs))
+
+    def acquire_lease(self, *args, **kwargs) -> Optional[int]:
+        return self._run(self.aacquire_lease(*args, **kwargs))
+
+    def release_lease(self, *args, **kwargs):
+        return self._run(self.arelease_lease(*args, **kwargs))
+
+    def load(self) -> List[dict]:
+        return self._run(self.aload())
+
+    def etag(self):
+        return self._run(self.aetag())
@@ -1,25 +1,107 @@
 import logging
+import threading
+import time
 import traceback
-from typing import Any, Optional
+import weakref
+from contextlib import asynccontextmanager
+from typing import Any, AsyncIterator, Dict, Iterable, Optional, Sequence
 import asyncio
 import asyncpg
+import numpy as np
+
+from pybragi.base import metrics
+
+
+row_formats = ("dict", "record", "tuple", "columns", "numpy")
+
+
+def _args(params) -> Sequence:
+    # dict 按插入顺序对应 $1 $2 ...  也可以直接传 list/tuple
+    if not params:
+        return ()
+    if isinstance(params, dict):
+        return tuple(params.values())
+    return params
+
+
+def format_rows(rows: list, row_format: str = "dict"):
+    """record: 原样返回 asyncpg.Record (支持 r["col"] / r[0] / dict(r))  无额外分配
+    tuple: list[tuple]  columns: {列名: tuple}  numpy: {列名: np.ndarray}  后两种为列式
+    """
+    if row_format == "record":
+        return rows
+    if row_format == "dict":
+        return [dict(row) for row in rows]
+    if row_format == "tuple":
+        return [tuple(row) for row in rows]
+    if row_format in ("columns", "numpy"):
+        names = list(rows[0].keys()) if rows else []
+        columns = zip(*rows) if rows else []
+        if row_format == "numpy":
+            return {name: np.asarray(column) for name, column in zip(names, columns)}
+        return dict(zip(names, columns))
+    raise ValueError(f"row_format must be one of {row_formats}, got {row_format}")
+
 
 class PostgreImpl:
-    def __init__(self, host: str, port: int, database: str, user: str, password: str, max_pool_size: int = 10):
+    def __init__(self, host: str, port: int, database: str, user: str, password: str, max_pool_size: int = 10,
+                 statement_cache_size: int = 1024, max_cacheable_statement_size: int = 64 * 1024):
         self.host = host
         self.port = port
         self.user = user
         self.password = password
         self.database = database
         self.max_pool_size = max_pool_size
+        # asyncpg 每个连接按 sql 文本缓存 prepared statement (LRU)  相同 sql 只在第一次 parse/plan
+        self.statement_cache_size = statement_cache_size
+        self.max_cacheable_statement_size = max_cacheable_statement_size
 
         self.pool: Optional[asyncpg.Pool] = None
+        # 每个 loop 一个连接池  用线程名区分  thread_bind_async_manager 的线程数固定 标签数量有限
+        self.pool_label = f"{database}@{host}:{port}/{threading.current_thread().name}"
+        self._metric_children: Dict[tuple, Any] = {}
+
+    def _metric(self, name: str, *labels):
+        key = (name, *labels)
+        child = self._metric_children.get(key)
+        if child is None:
+            manager = metrics.get_metrics_manager()
+            if manager is None:
+                return None
+            child = self._metric_children[key] = getattr(manager, name).labels(self.pool_label, *labels)
+        return child
+
+    def _report_pool_size(self):
+        if self.pool is None or metrics.get_metrics_manager() is None:
+            return
+        self._metric("pg_pool_connections", "size").set(self.pool.get_size())
+        self._metric("pg_pool_connections", "idle").set(self.pool.get_idle_size())
+        self._metric("pg_pool_connections", "max").set(self.pool.get_max_size())
+
+    @asynccontextmanager
+    async def acquire(self, op: str = "query"):
+        """从连接池取连接  记录等待时延和占用时延 (即单次操作时延)"""
+        start = time.perf_counter()
+        async with self.pool.acquire() as connection:  # type: ignore
+            acquired = time.perf_counter()
+            wait = self._metric("pg_acquire_wait")
+            if wait is not None:
+                wait.observe(acquired - start)
+                self._report_pool_size()
+            try:
+                yield connection
+            finally:
+                latency = self._metric("pg_query_latency", op)
+                if latency is not None:
+                    latency.observe(time.perf_counter() - acquired)
 
     async def initdb(self):
         try:
             self.pool = await asyncpg.create_pool(user=self.user, password=self.password,
-                                        database=self.database, host=self.host,
-                                        min_size=1, max_size=self.max_pool_size)
+                                        database=self.database, host=self.host, port=self.port,
+                                        min_size=1, max_size=self.max_pool_size,
+                                        statement_cache_size=self.statement_cache_size,
+                                        max_cacheable_statement_size=self.max_cacheable_statement_size)
         except Exception as e:
             traceback.print_exc()
             logging.error(
@@ -52,37 +134,28 @@ class PostgreImpl:
     async def query(
         self,
         sql: str,
-        params: dict[str, Any] | None = None,
+        params: dict[str, Any] | Sequence | None = None,
         multirows: bool = False,
         with_age: bool = False,
         graph_name: str | None = None,
+        row_format: str = "dict",
     ) -> dict[str, Any] | None | list[dict[str, Any]]:
-        async with self.pool.acquire() as connection:  # type: ignore
+        """row_format 见 format_rows  columns / numpy 只对 multirows 生效"""
+        async with self.acquire("query") as connection:
             if with_age and graph_name:
                 await self.configure_age(connection, graph_name)  # type: ignore
             elif with_age and not graph_name:
                 raise ValueError("Graph name is required when with_age is True")
 
             try:
-                if params:
-                    rows = await connection.fetch(sql, *params.values())
-                else:
-                    rows = await connection.fetch(sql)
-
-                if multirows:
-                    if rows:
-                        columns = [col for col in rows[0].keys()]
-                        data = [dict(zip(columns, row)) for row in rows]
-                    else:
-                        data = []
-                else:
-                    if rows:
-                        columns = rows[0].keys()
-                        data = dict(zip(columns, rows[0]))
-                    else:
-                        data = None
-
-                return data
+                if not multirows:
+                    row = await connection.fetchrow(sql, *_args(params))
+                    if row is None or row_format == "record":
+                        return row
+                    return tuple(row) if row_format == "tuple" else dict(row)
+
+                rows = await connection.fetch(sql, *_args(params))
+                return format_rows(rows, row_format)
             except Exception as e:
                 logging.error(f"PostgreSQL database, error:{e}")
                 raise
@@ -90,22 +163,19 @@ class PostgreImpl:
     async def execute(
         self,
         sql: str,
-        data: dict[str, Any] | None = None,
+        data: dict[str, Any] | Sequence | None = None,
         upsert: bool = False,
         with_age: bool = False,
         graph_name: str | None = None,
     ):
         try:
-            async with self.pool.acquire() as connection:  # type: ignore
+            async with self.acquire("execute") as connection:
                 if with_age and graph_name:
                     await self.configure_age(connection, graph_name)  # type: ignore
                 elif with_age and not graph_name:
                     raise ValueError("Graph name is required when with_age is True")
 
-                if data is None:
-                    await connection.execute(sql)  # type: ignore
-                else:
-                    await connection.execute(sql, *data.values())  # type: ignore
+                return await connection.execute(sql, *_args(data))  # type: ignore
         except (
             asyncpg.exceptions.UniqueViolationError,
             asyncpg.exceptions.DuplicateTableError,
@@ -120,45 +190,139 @@ class PostgreImpl:
             traceback.print_exc()
             raise
 
+    async def execute_many(self, sql: str, rows: Iterable, timeout: Optional[float] = None):
+        """同一条 sql 批量执行  一次 prepare 多组参数流水线发送  rows 元素为 tuple 或 dict"""
+        args = [_args(row) for row in rows]
+        if not args:
+            return
+        try:
+            async with self.acquire("execute_many") as connection:
+                await connection.executemany(sql, args, timeout=timeout)
+        except Exception as e:
+            logging.error(f"PostgreSQL database,\nsql:{sql},\nrows:{len(args)},\nerror:{e}")
+            raise
+
+    async def copy_records_to_table(self, table_name: str, records: Iterable, columns: Optional[Sequence[str]] = None,
+                                    schema_name: Optional[str] = None, timeout: Optional[float] = None) -> str:
+        """COPY 协议批量导入  比 INSERT 快一个数量级  不支持 ON CONFLICT
+        records 为 dict 时 columns 默认取第一条的 key
+        """
+        records = list(records)
+        if not records:
+            return "COPY 0"
+        if isinstance(records[0], dict):
+            columns = list(columns or records[0].keys())
+            records = [tuple(record[column] for column in columns) for record in records]
+        try:
+            async with self.acquire("copy") as connection:
+                return await connection.copy_records_to_table(
+                    table_name, records=records, columns=columns, schema_name=schema_name, timeout=timeout
+                )
+        except Exception as e:
+            logging.error(f"PostgreSQL database, copy to {table_name} rows:{len(records)} error:{e}")
+            raise
+
+    async def cursor(self, sql: str, params: dict[str, Any] | Sequence | None = None, prefetch: int = 1000,
+                     record: bool = False) -> AsyncIterator[dict[str, Any]]:
+        """服务端游标  每次取 prefetch 行  内存占用与结果集大小无关
+        游标需要事务  遍历期间占用一个连接  提前 break 时连接随生成器关闭归还
+        record=True 时直接返回 asyncpg.Record 不转换 dict
+        """
+        async with self.acquire("cursor") as connection:
+            async with connection.transaction():
+                async for row in connection.cursor(sql, *_args(params), prefetch=prefetch):
+                    yield row if record else dict(row)
+
+    async def fetch_batches(self, sql: str, params: dict[str, Any] | Sequence | None = None, batch_size: int = 1000,
+                            row_format: str = "record") -> AsyncIterator[Any]:
+        """服务端游标分批读取  每批按 row_format 转换  适合列式 (numpy) 分析大结果集"""
+        async with self.acquire("cursor") as connection:
+            async with connection.transaction():
+                cursor = await connection.cursor(sql, *_args(params))
+                while True:
+                    rows = await cursor.fetch(batch_size)
+                    if not rows:
+                        return
+                    yield format_rows(rows, row_format)
+
 class ClientManager:
-    _instances: dict[str, Any] = {"db": None, "ref_count": 0}
-    _lock = asyncio.Lock()
+    """每个 event loop 一个 PostgreImpl (asyncpg 连接池绑定创建时的 loop 不能跨 loop 使用)
+    init_client 记录连接参数并为当前 loop 建池  其他 loop (如 thread_bind_async_manager 的线程) 第一次 get_client 时懒创建
+    get_client / release_client 按 loop 引用计数  计数归零时关闭该 loop 的连接池
+    """
+    _config: Optional[tuple] = None
+    _instances: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, dict[str, Any]]" = weakref.WeakKeyDictionary()
+    _locks: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, asyncio.Lock]" = weakref.WeakKeyDictionary()
+    _registry_lock = threading.Lock() # 保护上面两个 dict  asyncio.Lock 需要在各自 loop 内创建
 
     @classmethod
-    async def init_client(cls, *args, **kwargs):
-        if cls._instances["db"] is None:
+    def _loop_lock(cls) -> asyncio.Lock:
+        loop = asyncio.get_running_loop()
+        with cls._registry_lock:
+            lock = cls._locks.get(loop)
+            if lock is None:
+                lock = cls._locks[loop] = asyncio.Lock()
+            return lock
+
+    @classmethod
+    async def _ensure_client(cls) -> dict[str, Any]:
+        loop = asyncio.get_running_loop()
+        instance = cls._instances.get(loop)
+        if instance is None:
+            if cls._config is None:
+                raise Exception("Client not initialized")
+            args, kwargs = cls._config
             db = PostgreImpl(*args, **kwargs)
             await db.initdb()
-            cls._instances["db"] = db
-            cls._instances["ref_count"] = 0
-        else:
-            db = cls._instances["db"]
+            instance = {"db": db, "ref_count": 0}
+            with cls._registry_lock:
+                cls._instances[loop] = instance
+            logging.info(f"PostgreSQL pool created for loop {id(loop)} {db.pool_label}")
+        return instance
+
+    @classmethod
+    async def init_client(cls, *args, **kwargs):
+        if cls._config is None:
+            cls._config = (args, kwargs)
+        async with cls._loop_lock():
+            await cls._ensure_client()
 
-    async def check_table(self, table_name: str, ddl: str):
-        if self._instances["db"] is None:
-            raise Exception("Client not initialized")
-        await self._instances["db"].check_table(table_name, ddl)
+    @classmethod
+    async def check_table(cls, table_name: str, ddl: str):
+        async with cls._loop_lock():
+            instance = await cls._ensure_client()
+        await instance["db"].check_table(table_name, ddl)
 
     @classmethod
     async def get_client(cls) -> PostgreImpl:
-        async with cls._lock:
-            if cls._instances["db"] is None:
-                raise Exception("Client not initialized")
-            cls._instances["ref_count"] += 1
-            return cls._instances["db"]
+        async with cls._loop_lock():
+            instance = await cls._ensure_client()
+            instance["ref_count"] += 1
+            return instance["db"]
 
     @classmethod
     async def release_client(cls, db: PostgreImpl):
-        async with cls._lock:
-            if not db:
-                return
-            
-            if db is cls._instances["db"]:
-                cls._instances["ref_count"] -= 1
-                if cls._instances["ref_count"] == 0:
+        if not db:
+            return
+        loop = asyncio.get_running_loop()
+        async with cls._loop_lock():
+            instance = cls._instances.get(loop)
+            if instance is not None and db is instance["db"]:
+                instance["ref_count"] -= 1
+                if instance["ref_count"] <= 0:
                     await db.pool.close()
-                    logging.info("Closed PostgreSQL database connection pool")
-                    cls._instances["db"] = None
+                    logging.info(f"Closed PostgreSQL database connection pool {db.pool_label}")
+                    with cls._registry_lock:
+                        cls._instances.pop(loop, None)
             else:
                 await db.pool.close()
 
+    @classmethod
+    def pool_stats(cls) -> list[dict[str, Any]]:
+        with cls._registry_lock:
+            instances = list(cls._instances.values())
+        return [
+            {"pool": instance["db"].pool_label, "ref_count": instance["ref_count"],
+             "size": instance["db"].pool.get_size(), "idle": instance["db"].pool.get_idle_size()}
+            for instance in instances if instance["db"].pool is not None
+        ]
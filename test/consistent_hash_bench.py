@@ -0,0 +1,77 @@
+import time
+import random
+import string
+
+from pybragi.base.hash import djb2_hash
+from pybragi.server.consistent_hash import ConsistentHashRing
+from pybragi.server.health_check import endpoint_of
+
+
+def make_servers(n, start=0):
+    return [{"ipv4": f"10.0.0.{i}", "port": 13700, "name": "rvc_infer", "type": "", "weight": 1} for i in range(start, start + n)]
+
+
+def modulo_pick(servers, key):
+    return endpoint_of(servers[djb2_hash(key) % len(servers)])
+
+
+def ring_pick(ring: ConsistentHashRing, key):
+    return endpoint_of(ring.get(key))
+
+
+def bench_lookup(keys, servers, vnodes):
+    ring = ConsistentHashRing(servers, vnodes)
+
+    start = time.perf_counter()
+    for key in keys:
+        modulo_pick(servers, key)
+    modulo_cost = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for key in keys:
+        ring_pick(ring, key)
+    ring_cost = time.perf_counter() - start
+
+    start = time.perf_counter()
+    ConsistentHashRing(servers, vnodes)
+    build_cost = time.perf_counter() - start
+
+    print(f"lookup servers:{len(servers)} vnodes:{vnodes} keys:{len(keys)} "
+          f"modulo:{modulo_cost/len(keys)*1e6:.2f}us/op ring:{ring_cost/len(keys)*1e6:.2f}us/op ring-build:{build_cost*1e3:.2f}ms")
+
+
+def bench_movement(keys, before, after, vnodes, tag):
+    ring_before = ConsistentHashRing(before, vnodes)
+    ring_after = ConsistentHashRing(after, vnodes)
+
+    modulo_moved = sum(1 for key in keys if modulo_pick(before, key) != modulo_pick(after, key))
+    ring_moved = sum(1 for key in keys if ring_pick(ring_before, key) != ring_pick(ring_after, key))
+    print(f"{tag:<12} {len(before)}->{len(after)} ideal:{abs(len(after)-len(before))/max(len(before), len(after)):.3f} "
+          f"modulo moved:{modulo_moved/len(keys):.3f} ring moved:{ring_moved/len(keys):.3f}")
+
+
+def bench_balance(keys, servers, vnodes):
+    ring = ConsistentHashRing(servers, vnodes)
+    counts = {}
+    for key in keys:
+        endpoint = ring_pick(ring, key)
+        counts[endpoint] = counts.get(endpoint, 0) + 1
+    mean = len(keys) / len(servers)
+    print(f"balance vnodes:{vnodes} max/mean:{max(counts.values())/mean:.3f} min/mean:{min(counts.values())/mean:.3f}")
+
+
+# python test/consistent_hash_bench.py
+if __name__ == "__main__":
+    random.seed(0)
+    keys = ["".join(random.choices(string.digits, k=8)) for _ in range(100000)]
+
+    for n in [4, 16, 64]:
+        bench_lookup(keys, make_servers(n), 160)
+
+    for vnodes in [40, 160, 320]:
+        bench_balance(keys, make_servers(16), vnodes)
+
+    servers = make_servers(16)
+    bench_movement(keys, servers, servers + make_servers(1, 16), 160, "scale-up")
+    bench_movement(keys, servers, servers[:-1], 160, "scale-down")
+    bench_movement(keys, servers, servers[:5] + servers[6:], 160, "remove-mid")
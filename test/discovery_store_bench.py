@@ -0,0 +1,63 @@
+import time
+import argparse
+
+from pybragi.server import dao_server_discovery
+from pybragi.server.discovery_cache import DiscoveryCache
+from pybragi.store.memory_discovery import MemoryDiscoveryStore
+
+
+def bench(store, label, servers, loop):
+    dao_server_discovery.use_store(store)
+    for i in range(servers):
+        dao_server_discovery.register_server(f"10.0.0.{i}", 13700, "rvc_infer", ttl=60)
+
+    start = time.perf_counter()
+    for _ in range(loop):
+        dao_server_discovery.get_server_online("rvc_infer")
+    query_cost = time.perf_counter() - start
+
+    keys = [(f"10.0.0.{i}", 13700, "rvc_infer", "") for i in range(servers)]
+    start = time.perf_counter()
+    for _ in range(loop // 10):
+        dao_server_discovery.heartbeat_servers(keys, 60)
+    heartbeat_cost = time.perf_counter() - start
+
+    cache = DiscoveryCache(store)
+    cache.refresh()
+    start = time.perf_counter()
+    for _ in range(loop):
+        cache.get_server_online("rvc_infer")
+    cache_cost = time.perf_counter() - start
+
+    print(f"{label:8s} servers:{servers} get_server_online:{query_cost/loop*1e6:.1f}us/op "
+          f"heartbeat:{heartbeat_cost/(loop//10)*1e6:.1f}us/op cache:{cache_cost/loop*1e6:.2f}us/op")
+
+    for i in range(servers):
+        dao_server_discovery.unregister_server(f"10.0.0.{i}", 13700, "rvc_infer")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--servers", type=int, default=16)
+    parser.add_argument("--loop", type=int, default=2000)
+    parser.add_argument("--mongo-url", type=str, default="")
+    parser.add_argument("--mongo-db", type=str, default="bench")
+    parser.add_argument("--pg-host", type=str, default="")
+    parser.add_argument("--pg-port", type=int, default=5432)
+    parser.add_argument("--pg-db", type=str, default="postgres")
+    parser.add_argument("--pg-user", type=str, default="postgres")
+    parser.add_argument("--pg-password", type=str, default="")
+    args = parser.parse_args()
+
+    bench(MemoryDiscoveryStore(), "memory", args.servers, args.loop)
+
+    if args.mongo_url:
+        from pybragi.store import mongo_impl
+        from pybragi.store.mongo_discovery import MongoDiscoveryStore
+        mongo_impl.new_store(args.mongo_url, args.mongo_db, 4)
+        bench(MongoDiscoveryStore(), "mongo", args.servers, args.loop)
+
+    if args.pg_host:
+        from pybragi.store.postgre_discovery import PostgreDiscoveryStore
+        store = PostgreDiscoveryStore.start(args.pg_host, args.pg_port, args.pg_db, args.pg_user, args.pg_password)
+        bench(store, "postgre", args.servers, args.loop)
@@ -0,0 +1,67 @@
+import time
+import random
+import threading
+
+import prometheus_client as pc
+
+from pybragi.base import metrics
+
+
+def bench_raw(mgr: metrics.MetricsManager, routes, loop):
+    # on_finish 原来的写法  每次请求两次 labels()
+    start = time.perf_counter()
+    for i in range(loop):
+        route, status, latency = routes[i % len(routes)]
+        mgr.request_histogram.labels(mgr.server_name, route, status).observe(latency)
+        mgr.request_qps.labels(mgr.server_name, route, status).inc()
+    return time.perf_counter() - start
+
+
+def bench_recorder(recorder: metrics.RequestRecorder, routes, loop):
+    start = time.perf_counter()
+    for i in range(loop):
+        route, status, latency = routes[i % len(routes)]
+        recorder.record(route, status, latency)
+    return time.perf_counter() - start
+
+
+def bench_threads(func, threads, *args):
+    costs = []
+    def run():
+        costs.append(func(*args))
+    workers = [threading.Thread(target=run) for _ in range(threads)]
+    start = time.perf_counter()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    return time.perf_counter() - start
+
+
+if __name__ == "__main__":
+    loop = 200000
+    routes = [(f"/v1/route_{i % 16}", random.choice([200, 200, 200, 500]), random.random()) for i in range(1024)]
+
+    mgr = metrics.MetricsManager("bench")
+    accumulate = metrics.RequestRecorder(mgr, local_accumulate=True)
+
+    raw = bench_raw(mgr, routes, loop)
+    cached = bench_recorder(mgr.request_recorder, routes, loop)
+    local = bench_recorder(accumulate, routes, loop)
+    start = time.perf_counter()
+    accumulate.flush()
+    flush = time.perf_counter() - start
+    print(f"single thread  raw labels:{raw/loop*1e9:.0f}ns/op cached children:{cached/loop*1e9:.0f}ns/op "
+          f"local accumulate:{local/loop*1e9:.0f}ns/op flush:{flush*1e3:.2f}ms incl. flush:{(local + flush)/loop*1e9:.0f}ns/op")
+
+    threads = 4
+    raw = bench_threads(bench_raw, threads, mgr, routes, loop // threads)
+    cached = bench_threads(bench_recorder, threads, mgr.request_recorder, routes, loop // threads)
+    local = bench_threads(bench_recorder, threads, accumulate, routes, loop // threads)
+    print(f"{threads} threads      raw labels:{raw/loop*1e9:.0f}ns/op cached children:{cached/loop*1e9:.0f}ns/op "
+          f"local accumulate:{local/loop*1e9:.0f}ns/op")
+
+    start = time.perf_counter()
+    accumulate.flush()
+    pc.generate_latest()
+    print(f"flush + generate_latest: {(time.perf_counter() - start)*1e3:.2f}ms")
@@ -0,0 +1,69 @@
+import time
+import argparse
+import threading
+
+from pybragi.store import mongo_impl
+
+
+table = "claim_bench"
+
+
+def prepare(total):
+    mongo_impl.delete_items(table, {})
+    mongo_impl.get_db()[table].create_index([("processed", 1), ("_id", 1)])
+    mongo_impl.insert_items(table, [{"processed": False, "payload": i} for i in range(total)])
+
+
+def loop_consumer(batch_size, counter):
+    while True:
+        items = mongo_impl.get_batch_items(table, {"processed": False}, batch_size=batch_size)
+        if not items:
+            return
+        counter.append(len(items))
+
+
+def claim_consumer(batch_size, counter):
+    while True:
+        token, items = mongo_impl.claim_batch_items(table, {"processed": False}, batch_size=batch_size)
+        if not token:
+            return
+        if items:
+            mongo_impl.ack_claimed_items(table, token)
+            counter.append(len(items))
+
+
+def bench(label, consumer, total, batch_size, workers):
+    prepare(total)
+    counter = []
+    threads = [threading.Thread(target=consumer, args=(batch_size, counter)) for _ in range(workers)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    cost = time.perf_counter() - start
+
+    # 只比较吞吐  mongomock 不是线程安全的 多线程下 items 可能不等于 total  不能据此判断重复消费
+    processed = sum(counter)
+    print(f"{label:6s} workers:{workers} batch:{batch_size} items:{processed} "
+          f"batches/s:{len(counter)/cost:.0f} items/s:{processed/cost:.0f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--mongo-url", type=str, default="", help="empty to use mongomock")
+    parser.add_argument("--mongo-db", type=str, default="bench")
+    parser.add_argument("--total", type=int, default=1000, help="mongomock scans every document, keep it small")
+    parser.add_argument("--batch-size", type=int, default=8)
+    parser.add_argument("--workers", type=int, default=2)
+    args = parser.parse_args()
+
+    if args.mongo_url:
+        mongo_impl.new_store(args.mongo_url, args.mongo_db, args.workers * 2)
+    else:
+        import mongomock
+        mongo_impl.MongoOnline.mongoDB = mongomock.MongoClient()[args.mongo_db]
+
+    # loop: batch_size 次 find_one_and_update    claim: find + update_many + find + ack 固定 4 次
+    bench("loop", loop_consumer, args.total, args.batch_size, args.workers)
+    bench("claim", claim_consumer, args.total, args.batch_size, args.workers)
@@ -0,0 +1,68 @@
+import time
+import asyncio
+import argparse
+
+from pybragi.store.postgre_impl import PostgreImpl
+
+
+table = "bulk_bench"
+ddl = f"CREATE TABLE IF NOT EXISTS {table} (id BIGINT PRIMARY KEY, name VARCHAR(64), score DOUBLE PRECISION)"
+insert_sql = f"INSERT INTO {table} (id, name, score) VALUES ($1, $2, $3)"
+
+
+async def bench(db: PostgreImpl, rows: int):
+    records = [(i, f"name_{i}", i * 0.5) for i in range(rows)]
+
+    await db.execute(f"TRUNCATE {table}")
+    start = time.perf_counter()
+    for record in records:
+        await db.execute(insert_sql, record)
+    loop_cost = time.perf_counter() - start
+
+    await db.execute(f"TRUNCATE {table}")
+    start = time.perf_counter()
+    await db.execute_many(insert_sql, records)
+    many_cost = time.perf_counter() - start
+
+    await db.execute(f"TRUNCATE {table}")
+    start = time.perf_counter()
+    await db.copy_records_to_table(table, records, columns=["id", "name", "score"])
+    copy_cost = time.perf_counter() - start
+
+    start = time.perf_counter()
+    fetched = 0
+    async for _ in db.cursor(f"SELECT id, name, score FROM {table}", prefetch=1000):
+        fetched += 1
+    cursor_cost = time.perf_counter() - start
+
+    read_costs = []
+    for row_format in ("dict", "record", "numpy"):
+        start = time.perf_counter()
+        await db.query(f"SELECT id, name, score FROM {table}", multirows=True, row_format=row_format)
+        read_costs.append(f"{row_format}:{rows/(time.perf_counter() - start):.0f}rows/s")
+
+    print(f"rows:{rows} execute-loop:{rows/loop_cost:.0f}rows/s execute_many:{rows/many_cost:.0f}rows/s "
+          f"copy:{rows/copy_cost:.0f}rows/s cursor-read:{fetched/cursor_cost:.0f}rows/s")
+    print(f"query {' '.join(read_costs)}")
+
+
+async def main(args):
+    db = PostgreImpl(args.host, args.port, args.database, args.user, args.password, 4)
+    await db.initdb()
+    await db.check_table(table, ddl)
+    await bench(db, args.rows)
+    await db.execute(f"DROP TABLE {table}")
+    await db.pool.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", type=str, default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=5432)
+    parser.add_argument("--database", type=str, default="postgres")
+    parser.add_argument("--user", type=str, default="postgres")
+    parser.add_argument("--password", type=str, default="")
+    parser.add_argument("--rows", type=int, default=10000)
+    args = parser.parse_args()
+
+    asyncio.run(main(args))
@@ -0,0 +1,64 @@
+import asyncio
+import gc
+
+from tornado import httpclient, httpserver, testing, web
+
+from pybragi.base import metrics
+
+
+class Handler:
+    pass
+
+
+def test_wait_drained_after_discard():
+    active = metrics.ActiveRequests()
+
+    async def main():
+        handler = Handler()
+        active.add(handler, "/a")
+        assert not await active.wait_drained(timeout=0.05)
+        asyncio.get_running_loop().call_later(0.05, active.discard, handler)
+        return await active.wait_drained(timeout=1)
+
+    assert asyncio.run(main())
+    assert active.count() == 0 and active.class_counts == {}
+
+
+def test_leaked_handler_does_not_block_drain():
+    active = metrics.ActiveRequests()
+
+    async def main():
+        handler = Handler()
+        active.add(handler, "/a")
+        waiter = asyncio.ensure_future(active.wait_drained(timeout=1))
+        await asyncio.sleep(0)
+        del handler # 没有 discard  回收后自动移除
+        gc.collect()
+        return await waiter
+
+    assert asyncio.run(main())
+    assert active.count(Handler) == 0
+
+
+class PrepareFails(metrics.PrometheusMixIn, web.RequestHandler):
+    async def prepare(self):
+        await super().prepare()
+        raise ValueError("prepare failed")
+
+    def get(self):
+        self.write("unreachable")
+
+
+def test_prepare_raising_does_not_block_drain():
+    async def main():
+        sock, port = testing.bind_unused_port()
+        server = httpserver.HTTPServer(web.Application([(r"/fail", PrepareFails)]))
+        server.add_sockets([sock])
+        response = await httpclient.AsyncHTTPClient().fetch(f"http://127.0.0.1:{port}/fail", raise_error=False)
+        drained = await metrics.active_requests.wait_drained(timeout=1, handler_class=PrepareFails)
+        server.stop()
+        return response.code, drained
+
+    code, drained = asyncio.run(main())
+    assert code == 500
+    assert drained
@@ -0,0 +1,189 @@
+import asyncio
+import time
+
+import pytest
+from tornado import httpserver, testing, web
+
+from pybragi.bragi_config import BragiConfig
+from pybragi.server import circuit_breaker, endpoint_load, loadbalance
+from pybragi.server.async_loadbalance import AsyncLBStatus, AsyncLoadBalanceClient
+from pybragi.server.hedge import HedgePolicy
+
+
+class Status(web.RequestHandler):
+    def get(self, code):
+        self.set_status(int(code))
+        self.write(self.request.host)
+
+
+class Sleep(web.RequestHandler):
+    async def get(self, seconds):
+        await asyncio.sleep(float(seconds))
+        self.write(self.request.host)
+
+
+class Echo(web.RequestHandler):
+    def get(self):
+        self.write(self.request.host)
+
+
+# 按后端配置返回 503 或变慢  同一个 path 在不同节点表现不同
+class Backend(web.RequestHandler):
+    async def get(self):
+        if self.settings.get("fail"):
+            self.set_status(503)
+        await asyncio.sleep(self.settings.get("delay", 0))
+        self.write(self.request.host)
+
+
+def make_app(**settings):
+    return web.Application([(r"/status/(\d+)", Status), (r"/sleep/([\d.]+)", Sleep), (r"/echo", Echo), (r"/backend", Backend)],
+                           **settings)
+
+
+@pytest.fixture
+def lb_env(monkeypatch):
+    monkeypatch.setattr(BragiConfig, "LBCheck", False)
+    monkeypatch.setattr(endpoint_load, "load_tracker", endpoint_load.LoadTracker())
+    monkeypatch.setattr(loadbalance.LoadBalanceStatus, "roundrobin_cnt", 0) # 从第一个节点开始轮询
+    circuit_breaker.configure_circuit_breakers(failure_threshold=100)
+    yield
+    circuit_breaker.configure_circuit_breakers()
+
+
+def run_with_backends(count, test, settings=()):
+    """启动 count 个后端  test(servers) 在同一个 loop 上运行  settings[i] 为第 i 个后端的 app 配置"""
+    async def main():
+        servers, http_servers = [], []
+        for i in range(count):
+            sock, port = testing.bind_unused_port()
+            server = httpserver.HTTPServer(make_app(**(settings[i] if i < len(settings) else {})))
+            server.add_sockets([sock])
+            http_servers.append(server)
+            servers.append({"ipv4": "127.0.0.1", "port": port})
+        try:
+            return await test(servers)
+        finally:
+            for server in http_servers:
+                server.stop()
+    return asyncio.run(main())
+
+
+def host_of(server):
+    return f"{server['ipv4']}:{server['port']}"
+
+
+def test_500_counts_as_error_without_retry(lb_env):
+    client = AsyncLoadBalanceClient(use_curl=False, retries=2)
+
+    async def test(servers):
+        response = await client.fetch(servers, "/status/500")
+        return servers, response
+
+    servers, response = run_with_backends(1, test)
+    assert response.code == 500
+    state = endpoint_load.get_load_tracker().get(host_of(servers[0]))
+    assert state.errors == 1 # 只请求一次 不重试 但计入错误
+    assert circuit_breaker.get_circuit_breakers().get(host_of(servers[0])).consecutive_failures == 1
+
+
+def test_4xx_is_not_an_error(lb_env):
+    client = AsyncLoadBalanceClient(use_curl=False)
+
+    async def test(servers):
+        return servers, await client.fetch(servers, "/status/404")
+
+    servers, response = run_with_backends(1, test)
+    assert response.code == 404
+    assert endpoint_load.get_load_tracker().get(host_of(servers[0])).errors == 0
+
+
+def test_503_retries_on_next_node(lb_env):
+    client = AsyncLoadBalanceClient(use_curl=False, retries=1)
+    retry_cnt = AsyncLBStatus.retry_cnt
+
+    async def test(servers):
+        return servers, await client.fetch(servers, "/backend")
+
+    servers, response = run_with_backends(2, test, [{"fail": True}])
+    assert response.code == 200
+    assert response.body.decode() == host_of(servers[1])
+    assert AsyncLBStatus.retry_cnt == retry_cnt + 1
+    assert endpoint_load.get_load_tracker().get(host_of(servers[0])).errors == 1
+
+
+def test_connection_error_retries(lb_env):
+    client = AsyncLoadBalanceClient(use_curl=False, retries=1)
+
+    async def test(servers):
+        sock, dead_port = testing.bind_unused_port()
+        sock.close() # 端口已关闭 连接被拒绝
+        return servers, await client.fetch([{"ipv4": "127.0.0.1", "port": dead_port}, *servers], "/echo")
+
+    servers, response = run_with_backends(1, test)
+    assert response.code == 200
+    assert response.body.decode() == host_of(servers[0])
+
+
+def test_retries_exhausted_returns_last_response(lb_env):
+    client = AsyncLoadBalanceClient(use_curl=False, retries=1)
+    failed_cnt = AsyncLBStatus.failed_cnt
+
+    async def test(servers):
+        return await client.fetch(servers, "/backend")
+
+    response = run_with_backends(3, test, [{"fail": True}] * 3)
+    assert response.code == 503
+    assert AsyncLBStatus.failed_cnt == failed_cnt + 1
+    tracker = endpoint_load.get_load_tracker()
+    assert sum(state.errors for state in tracker.loads.values()) == 2 # retries=1 只试两个节点
+
+
+def test_hedge_wins_and_cancels_slow_request(lb_env):
+    policy = HedgePolicy(budget=1, default_delay=0.05)
+    client = AsyncLoadBalanceClient(use_curl=False, hedge_policy=policy)
+    hedge_cnt = AsyncLBStatus.hedge_cnt
+
+    async def test(servers):
+        start = time.perf_counter()
+        response = await client.fetch(servers, "/backend", hedge=True)
+        elapsed = time.perf_counter() - start
+        await asyncio.sleep(0.01) # 等待被取消的请求退出 track
+        return servers, response, elapsed
+
+    servers, response, elapsed = run_with_backends(2, test, [{"delay": 1}])
+    assert response.code == 200
+    assert response.body.decode() == host_of(servers[1])
+    assert elapsed < 0.5
+    assert AsyncLBStatus.hedge_cnt == hedge_cnt + 1
+    assert policy.tokens == pytest.approx(0)
+
+    # 被取消的请求不计入时延和错误
+    slow = endpoint_load.get_load_tracker().get(host_of(servers[0]))
+    assert slow.inflight == 0
+    assert slow.errors == 0 and slow.ewma == 0
+
+
+def test_hedge_without_budget_waits_first(lb_env):
+    policy = HedgePolicy(budget=0, default_delay=0.05)
+    client = AsyncLoadBalanceClient(use_curl=False, hedge_policy=policy)
+    hedge_cnt = AsyncLBStatus.hedge_cnt
+
+    async def test(servers):
+        return servers, await client.fetch(servers, "/backend", hedge=True)
+
+    servers, response = run_with_backends(2, test, [{"delay": 0.2}])
+    assert response.body.decode() == host_of(servers[0])
+    assert AsyncLBStatus.hedge_cnt == hedge_cnt
+
+
+def test_hedge_not_sent_when_first_is_fast(lb_env):
+    policy = HedgePolicy(budget=1, default_delay=0.5)
+    client = AsyncLoadBalanceClient(use_curl=False, hedge_policy=policy)
+
+    async def test(servers):
+        return servers, await client.fetch(servers, "/backend", hedge=True)
+
+    servers, response = run_with_backends(2, test)
+    assert response.body.decode() == host_of(servers[0])
+    assert policy.tokens == pytest.approx(1) # 未消耗令牌
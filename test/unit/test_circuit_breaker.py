@@ -0,0 +1,85 @@
+import time
+
+import pytest
+
+from pybragi.server import circuit_breaker, loadbalance
+
+
+def make_breaker(**kwargs) -> circuit_breaker.CircuitBreaker:
+    params = dict(failure_threshold=2, open_timeout=0.05, max_open_timeout=1.0)
+    params.update(kwargs)
+    return circuit_breaker.CircuitBreaker("127.0.0.1:1", **params)
+
+
+def trip(breaker: circuit_breaker.CircuitBreaker):
+    for _ in range(breaker.failure_threshold):
+        breaker.on_failure()
+
+
+def test_state_transitions():
+    breaker = make_breaker()
+    assert breaker.state == circuit_breaker.CircuitBreaker.closed
+    trip(breaker)
+    assert breaker.state == circuit_breaker.CircuitBreaker.open
+    assert not breaker.is_available()
+    assert not breaker.allow()
+
+    time.sleep(0.06)
+    assert breaker.is_available()
+    assert breaker.allow()
+    assert breaker.state == circuit_breaker.CircuitBreaker.half_open
+    assert not breaker.allow() # 只有一个试探名额
+
+    breaker.on_failure()
+    assert breaker.state == circuit_breaker.CircuitBreaker.open
+    assert breaker.open_timeout == pytest.approx(0.1)
+
+    time.sleep(0.11)
+    assert breaker.allow()
+    breaker.on_success()
+    assert breaker.state == circuit_breaker.CircuitBreaker.closed
+    assert breaker.open_timeout == pytest.approx(0.05)
+
+
+def test_is_available_does_not_take_half_open_slot():
+    breaker = make_breaker()
+    trip(breaker)
+    time.sleep(0.06)
+    breaker.allow()
+    breaker.on_failure() # half_open -> open
+    time.sleep(0.11)
+    for _ in range(10):
+        assert breaker.is_available()
+    assert breaker.state == circuit_breaker.CircuitBreaker.open
+    assert breaker.allow()
+    assert not breaker.is_available()
+
+
+class _Healthy:
+    def is_healthy(self, server):
+        return True
+
+
+@pytest.fixture
+def servers(monkeypatch):
+    monkeypatch.setattr(loadbalance.health_check, "get_health_prober", lambda: _Healthy())
+    circuit_breaker.configure_circuit_breakers(failure_threshold=1, open_timeout=0.05)
+    yield [{"ipv4": "127.0.0.1", "port": port} for port in (1, 2, 3)]
+    circuit_breaker.configure_circuit_breakers()
+
+
+@pytest.mark.parametrize("pick", [loadbalance.peak_ewma, loadbalance.power_of_two_choices, loadbalance.least_outstanding])
+def test_pick_reserves_only_selected_half_open(servers, pick):
+    breakers = circuit_breaker.get_circuit_breakers()
+    half_open = breakers.get("127.0.0.1:1")
+    half_open.on_failure()
+    time.sleep(0.06)
+
+    picked = [pick(servers, use_http=False) for _ in range(30)]
+    # 没选中时不会占用试探名额  选中一次后其余请求避开该节点
+    assert picked.count("127.0.0.1:1") <= 1
+    if "127.0.0.1:1" in picked:
+        assert half_open.state == circuit_breaker.CircuitBreaker.half_open
+        assert half_open.half_open_inflight == 1
+    else:
+        assert half_open.state == circuit_breaker.CircuitBreaker.open
@@ -0,0 +1,40 @@
+from collections import Counter
+
+from pybragi.server import consistent_hash
+from pybragi.server.health_check import endpoint_of
+
+
+def make_servers(n, weight=1):
+    return [{"ipv4": f"10.0.0.{i}", "port": 8000, "weight": weight} for i in range(n)]
+
+
+def test_ring_balance_and_minimal_movement():
+    keys = [f"user-{i}" for i in range(20000)]
+    ring = consistent_hash.ConsistentHashRing(make_servers(10))
+    before = {key: endpoint_of(ring.get(key)) for key in keys}
+
+    counts = Counter(before.values())
+    assert len(counts) == 10
+    assert max(counts.values()) < 2 * len(keys) / 10
+
+    grown = consistent_hash.ConsistentHashRing(make_servers(11))
+    moved = sum(before[key] != endpoint_of(grown.get(key)) for key in keys)
+    assert moved < 2 * len(keys) / 11 # 约 1/N 的 key 迁移
+    assert all(endpoint_of(grown.get(key)) == "10.0.0.10:8000" for key in keys if before[key] != endpoint_of(grown.get(key)))
+
+
+def test_iter_servers_visits_each_server_once():
+    ring = consistent_hash.ConsistentHashRing(make_servers(5))
+    order = [endpoint_of(server) for server in ring.iter_servers("key")]
+    assert len(order) == len(set(order)) == 5
+    assert order[0] == endpoint_of(ring.get("key"))
+
+
+def test_get_ring_cache():
+    servers = make_servers(4)
+    ring = consistent_hash.get_ring(servers)
+    assert consistent_hash.get_ring(servers) is ring
+    # 新 list 成员相同 (顺序不同) 命中版本缓存
+    assert consistent_hash.get_ring(list(reversed(make_servers(4)))) is ring
+    # weight 变化需要重建
+    assert consistent_hash.get_ring(make_servers(4, weight=2)) is not ring
@@ -0,0 +1,84 @@
+import time
+
+import pytest
+
+from pybragi.server.discovery_cache import DiscoveryCache
+from pybragi.store.memory_discovery import MemoryDiscoveryStore
+
+
+class PollingStore(MemoryDiscoveryStore):
+    """不支持 watch  DiscoveryCache 按 etag 轮询"""
+    def __init__(self):
+        super().__init__()
+        self.loads = 0
+
+    def load(self):
+        self.loads += 1
+        return super().load()
+
+    def watch(self, on_change, stop_event, on_tick=None) -> bool:
+        return False
+
+
+@pytest.fixture
+def store():
+    store = PollingStore()
+    store.register_server("127.0.0.1", 8000, "svc")
+    return store
+
+
+@pytest.fixture
+def cache(store):
+    cache = DiscoveryCache(store, poll_interval=0.01)
+    yield cache
+    cache.stop()
+
+
+def wait_for(predicate, timeout=1.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if predicate():
+            return True
+        time.sleep(0.01)
+    return False
+
+
+def test_start_does_not_reload_twice(store, cache):
+    cache.start()
+    time.sleep(0.1)
+    assert store.loads == 1
+    assert cache.etag == store.etag()
+
+
+def test_poll_detects_change(store, cache):
+    changes = []
+    cache.add_listener(lambda name, type, servers: changes.append((name, [s["port"] for s in servers])))
+    cache.start()
+    first = cache.get_server_online("svc")
+    assert [s["port"] for s in first] == [8000]
+
+    store.register_server("127.0.0.1", 8001, "svc")
+    # listener 在更新 online 之后回调  等 listener 而不是 online
+    assert wait_for(lambda: changes and changes[-1] == ("svc", [8000, 8001]))
+    assert len(cache.get_server_online("svc")) == 2
+    assert cache.version == 2
+
+    store.unregister_server("127.0.0.1", 8000, "svc")
+    assert wait_for(lambda: [s["port"] for s in cache.get_server_online("svc")] == [8001])
+
+
+def test_heartbeat_keeps_list_object(store, cache):
+    cache.start()
+    servers = cache.get_server_online("svc")
+    loads = store.loads
+    store.heartbeat_servers([("127.0.0.1", 8000, "svc", "")], ttl=10)
+    time.sleep(0.1)
+    assert store.loads == loads # etag 不变 不重新加载
+    assert cache.get_server_online("svc") is servers
+
+
+def test_expired_server_dropped_by_tick(store, cache):
+    store.register_server("127.0.0.1", 8001, "svc", ttl=0.2)
+    cache.start()
+    assert len(cache.get_server_online("svc")) == 2
+    assert wait_for(lambda: [s["port"] for s in cache.get_server_online("svc")] == [8000])
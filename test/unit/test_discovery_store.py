@@ -0,0 +1,27 @@
+import pytest
+
+from pybragi.store.base import BaseServerDiscoveryStore
+from pybragi.store.memory_discovery import MemoryDiscoveryStore
+
+
+def test_base_store_is_abstract():
+    with pytest.raises(TypeError):
+        BaseServerDiscoveryStore()
+
+    class Partial(BaseServerDiscoveryStore):
+        def register_server(self, ipv4, port, name, type="", ttl=0):
+            pass
+
+    with pytest.raises(TypeError):
+        Partial()
+
+
+def test_legacy_constructor_is_deprecated():
+    class Legacy(MemoryDiscoveryStore):
+        def __init__(self, url, database, max_pool_size):
+            MemoryDiscoveryStore.__init__(self)
+            BaseServerDiscoveryStore.__init__(self, url, database, max_pool_size)
+
+    with pytest.deprecated_call():
+        store = Legacy("mongodb://localhost", "db", 4)
+    assert (store.url, store.database, store.max_pool_size) == ("mongodb://localhost", "db", 4)
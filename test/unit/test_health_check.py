@@ -0,0 +1,93 @@
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from pybragi.bragi_config import BragiConfig
+from pybragi.server import health_check, loadbalance
+
+
+class StatusHandler(BaseHTTPRequestHandler):
+    status = 200
+
+    def do_GET(self):
+        self.send_response(self.server.status)
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def backend():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StatusHandler)
+    server.status = 200
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def server_of(backend) -> dict:
+    return {"ipv4": "127.0.0.1", "port": backend.server_address[1]}
+
+
+def test_fall_and_rise(backend):
+    server = server_of(backend)
+    prober = health_check.HealthProber(timeout=1, fall=2, rise=2)
+    prober.add_target(lambda: [server])
+    try:
+        prober.probe_once()
+        assert prober.is_healthy(server)
+
+        backend.status = 503
+        prober.probe_once()
+        assert prober.is_healthy(server) # 失败次数未到 fall
+        prober.probe_once()
+        assert not prober.is_healthy(server)
+        assert prober.snapshot()[0]["last_error"] == "status 503"
+
+        backend.status = 200
+        prober.probe_once()
+        assert not prober.is_healthy(server) # 成功次数未到 rise
+        prober.probe_once()
+        assert prober.is_healthy(server)
+    finally:
+        prober.stop()
+
+
+def test_unreachable_and_expire(backend):
+    dead = {"ipv4": "127.0.0.1", "port": 1}
+    prober = health_check.HealthProber(timeout=0.5, fall=1, expire=0.2)
+    try:
+        prober.track(dead)
+        prober.probe_once()
+        assert not prober.table[health_check.endpoint_of(dead)].healthy
+
+        time.sleep(0.25)
+        prober.probe_once() # 没有 target 引用 超过 expire 被清理
+        assert prober.table == {}
+    finally:
+        prober.stop()
+
+
+def test_check_health_reads_prober(backend, monkeypatch):
+    server = server_of(backend)
+    prober = health_check.HealthProber(timeout=1, fall=1)
+    monkeypatch.setattr(BragiConfig, "LBCheck", True)
+    monkeypatch.setattr(health_check, "health_prober", prober)
+    try:
+        backend.status = 500
+        prober.track(server)
+        prober.probe_once()
+        assert not loadbalance.check_health(server)
+
+        # 有 prober 时请求路径不访问网络  恢复后仍以内存表为准 直到下一轮探测
+        backend.status = 200
+        assert not loadbalance.check_health(server)
+        prober.probe_once()
+        assert loadbalance.check_health(server)
+    finally:
+        prober.stop()
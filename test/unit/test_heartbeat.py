@@ -0,0 +1,32 @@
+import pytest
+
+from pybragi.server import dao_server_discovery
+from pybragi.store.memory_discovery import MemoryDiscoveryStore
+
+
+@pytest.fixture
+def store():
+    previous = dao_server_discovery.discovery_store
+    store = MemoryDiscoveryStore()
+    dao_server_discovery.use_store(store)
+    yield store
+    dao_server_discovery.use_store(previous)
+
+
+def test_beat_registers_deleted_record_again(store):
+    heartbeat = dao_server_discovery.Heartbeat(ttl=10)
+    heartbeat.register("127.0.0.1", 8000, "svc")
+    store.servers.clear() # 模拟 TTL 删除
+
+    heartbeat.beat()
+    assert [s["port"] for s in store.get_server_online("svc")] == [8000]
+
+
+def test_beat_keeps_unregistered_offline(store):
+    heartbeat = dao_server_discovery.Heartbeat(ttl=10)
+    heartbeat.register("127.0.0.1", 8000, "svc")
+    heartbeat.register("127.0.0.1", 8001, "svc")
+    heartbeat.unregister("127.0.0.1", 8001, "svc")
+
+    heartbeat.beat()
+    assert [s["port"] for s in store.get_server_online("svc")] == [8000]
@@ -0,0 +1,71 @@
+from types import SimpleNamespace
+
+import prometheus_client as pc
+import pytest
+
+from pybragi.base import metrics
+from pybragi.server import hedge
+
+
+@pytest.fixture
+def caller_histogram(monkeypatch):
+    histogram = pc.Histogram("caller_latency", "", ["service", "url"], buckets=[0.01, 0.05, 0.1, 0.5, 1],
+                             registry=pc.CollectorRegistry())
+    monkeypatch.setattr(metrics, "metrics_manager", SimpleNamespace(server_name="test", caller_histogram=histogram))
+    return histogram
+
+
+def observe(histogram, url, latency, n):
+    for _ in range(n):
+        histogram.labels("test", url).observe(latency)
+
+
+def test_histogram_quantile_interpolates():
+    buckets = [(0.1, 50.0), (0.2, 100.0), (float("inf"), 100.0)]
+    assert hedge.histogram_quantile(buckets, 0.5) == pytest.approx(0.1)
+    assert hedge.histogram_quantile(buckets, 0.75) == pytest.approx(0.15)
+    assert hedge.histogram_quantile([], 0.5) is None
+
+
+def test_delay_reads_only_matching_child(caller_histogram, monkeypatch):
+    observe(caller_histogram, "http://a/api", 0.03, 100)
+    observe(caller_histogram, "http://b/api", 0.8, 100)
+    # 不应扫描全部子项
+    monkeypatch.setattr(caller_histogram, "collect", lambda: pytest.fail("full scan"))
+
+    policy = hedge.HedgePolicy(quantile=0.5, min_samples=50)
+    assert 0.01 < policy.delay("http://a", "/api") <= 0.05
+    assert 0.5 < policy.delay("http://b", "/api") <= 1
+
+
+def test_delay_falls_back_to_path_aggregate(caller_histogram):
+    observe(caller_histogram, "http://a/api", 0.03, 100)
+    observe(caller_histogram, "http://a/other", 0.8, 100)
+
+    policy = hedge.HedgePolicy(quantile=0.5, min_samples=50, default_delay=0.123)
+    assert policy.delay("http://c", "/api") == 0.123 # 该 path 尚未见过有样本的节点
+    policy.delay("http://a", "/api")
+    policy._delays.clear()
+    assert 0.01 < policy.delay("http://c", "/api") <= 0.05
+
+
+def test_delay_is_cached(caller_histogram):
+    policy = hedge.HedgePolicy(quantile=0.5, min_samples=50, default_delay=0.123, refresh=60)
+    assert policy.delay("http://a", "/api") == 0.123
+    observe(caller_histogram, "http://a/api", 0.03, 100)
+    assert policy.delay("http://a", "/api") == 0.123
+
+
+def test_token_budget():
+    policy = hedge.HedgePolicy(budget=0.25, max_tokens=2)
+    assert not policy.try_acquire()
+    for _ in range(4):
+        policy.on_request()
+    assert policy.try_acquire()
+    assert not policy.try_acquire()
+
+    for _ in range(100):
+        policy.on_request()
+    assert policy.tokens == pytest.approx(2) # 不超过 max_tokens
+    assert policy.try_acquire() and policy.try_acquire()
+    assert not policy.try_acquire()
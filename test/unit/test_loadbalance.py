@@ -0,0 +1,115 @@
+import pytest
+
+from pybragi.bragi_config import BragiConfig
+from pybragi.server import endpoint_load, loadbalance
+
+
+servers = [{"ipv4": "127.0.0.1", "port": port} for port in (8001, 8002, 8003)]
+
+
+@pytest.fixture
+def tracker(monkeypatch):
+    monkeypatch.setattr(BragiConfig, "LBCheck", False)
+    tracker = endpoint_load.LoadTracker()
+    monkeypatch.setattr(endpoint_load, "load_tracker", tracker)
+    return tracker
+
+
+def test_least_outstanding_picks_min_load(tracker):
+    busy = [tracker.track("http://127.0.0.1:8001"), tracker.track("127.0.0.1:8003")]
+    for ctx in busy:
+        ctx.__enter__()
+    tracker.update_remote("127.0.0.1:8002", 0.5)
+    assert tracker.inflight_map() == {"127.0.0.1:8001": 1, "127.0.0.1:8003": 1, "127.0.0.1:8002": 0}
+
+    assert loadbalance.least_outstanding(servers) == "http://127.0.0.1:8002"
+    tracker.update_remote("127.0.0.1:8002", 5)
+    assert loadbalance.least_outstanding(servers, use_http=False) in ("127.0.0.1:8001", "127.0.0.1:8003")
+
+    for ctx in busy:
+        ctx.__exit__(None, None, None)
+    assert tracker.inflight_map()["127.0.0.1:8001"] == 0
+
+
+def test_least_outstanding_rotates_on_tie(tracker):
+    picked = {loadbalance.least_outstanding(servers) for _ in range(len(servers))}
+    assert len(picked) == len(servers)
+
+
+def test_remote_queue_expires(tracker):
+    tracker.remote_expire = 0
+    tracker.update_remote("127.0.0.1:8001", 10)
+    assert tracker.load("127.0.0.1:8001") == 0
+
+
+def test_power_of_two_choices_avoids_busiest(tracker):
+    tracker.update_remote("127.0.0.1:8001", 100)
+    picked = {loadbalance.power_of_two_choices(servers) for _ in range(200)}
+    assert "http://127.0.0.1:8001" not in picked
+    assert picked == {"http://127.0.0.1:8002", "http://127.0.0.1:8003"}
+
+
+def test_parse_task_queue_length():
+    text = "\n".join([
+        "# HELP task_queue_length queue",
+        'task_queue_length{service="a",queue_type="normal"} 3.0',
+        'task_queue_length{service="a",queue_type="batch"} 2.0',
+        'task_queue_length_other{service="a"} 100.0',
+    ])
+    assert endpoint_load.parse_task_queue_length(text) == 5.0
+
+
+def test_peak_ewma_takes_peak_then_decays(tracker):
+    tracker.decay_time = 1.0
+    tracker.observe("127.0.0.1:8001", 0.1)
+    tracker.observe("127.0.0.1:8001", 0.5)
+    assert tracker.ewma("127.0.0.1:8001") == pytest.approx(0.5, rel=0.01) # 高于估计值直接取峰值
+
+    tracker.observe("127.0.0.1:8001", 0.1)
+    assert 0.1 < tracker.ewma("127.0.0.1:8001") < 0.5
+
+    state = tracker.get("127.0.0.1:8001")
+    state.ewma_stamp -= 100 # 长时间无样本 估计值衰减到 0
+    assert tracker.ewma("127.0.0.1:8001") == pytest.approx(0.0, abs=1e-9)
+
+
+def test_peak_ewma_cost_ordering(tracker):
+    tracker.observe("127.0.0.1:8001", 0.2)
+    tracker.observe("127.0.0.1:8002", 0.05)
+    tracker.observe("127.0.0.1:8003", 0.1)
+    assert loadbalance.peak_ewma(servers) == "http://127.0.0.1:8002"
+
+    # cost = ewma * (未完成请求+1)  8002 有 2 个未完成 0.15 > 0.1
+    pending = [tracker.track("127.0.0.1:8002") for _ in range(2)]
+    for ctx in pending:
+        ctx.__enter__()
+    assert tracker.cost("127.0.0.1:8002") == pytest.approx(0.15, rel=0.01)
+    assert loadbalance.peak_ewma(servers) == "http://127.0.0.1:8003"
+    for ctx in pending:
+        ctx.__exit__(None, None, None)
+
+
+def test_peak_ewma_penalises_errors_and_unknown(tracker):
+    tracker.observe("127.0.0.1:8001", 0.01, error=True)
+    assert tracker.ewma("127.0.0.1:8001") == pytest.approx(tracker.error_penalty, rel=0.01)
+    assert tracker.get("127.0.0.1:8001").errors == 1
+
+    # 尚无样本但已有 in-flight 的节点排在有样本的节点之后
+    pending = tracker.track("127.0.0.1:8002")
+    pending.__enter__()
+    tracker.observe("127.0.0.1:8003", 0.1)
+    assert tracker.cost("127.0.0.1:8002") > tracker.cost("127.0.0.1:8001") > tracker.cost("127.0.0.1:8003")
+    assert loadbalance.peak_ewma(servers) == "http://127.0.0.1:8003"
+    pending.__exit__(None, None, None)
+
+
+def test_track_records_failure(tracker):
+    with pytest.raises(ValueError):
+        with tracker.track("http://127.0.0.1:8001/"):
+            raise ValueError()
+    assert tracker.get("127.0.0.1:8001").errors == 1
+    assert tracker.get("127.0.0.1:8001").inflight == 0
+
+    with tracker.track("127.0.0.1:8002") as tracked:
+        tracked.mark_error()
+    assert tracker.get("127.0.0.1:8002").errors == 1
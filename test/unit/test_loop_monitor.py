@@ -0,0 +1,88 @@
+import asyncio
+import logging
+import time
+from types import SimpleNamespace
+
+import prometheus_client as pc
+import pytest
+from tornado import httpclient, httpserver, testing, web
+
+from pybragi.base import loop_monitor, metrics
+
+
+class StepHandler(metrics.PrometheusMixIn, web.RequestHandler):
+    async def get(self):
+        time.sleep(0.05) # 两段同步耗时之间 await  等待期间不计入
+        await asyncio.sleep(0.2)
+        time.sleep(0.05)
+        self.write("ok")
+
+
+class FailHandler(metrics.PrometheusMixIn, web.RequestHandler):
+    async def get(self):
+        await asyncio.sleep(0.01)
+        time.sleep(0.05)
+        raise ValueError("fail")
+
+
+class BlockHandler(metrics.PrometheusMixIn, web.RequestHandler):
+    def get(self):
+        time.sleep(0.4)
+        self.write("ok")
+
+
+@pytest.fixture
+def registry(monkeypatch):
+    registry = pc.CollectorRegistry()
+    labels = ["service"]
+    monkeypatch.setattr(metrics, "metrics_manager", SimpleNamespace(
+        server_name="test",
+        request_recorder=SimpleNamespace(record=lambda *args: None),
+        active_requests=pc.Gauge("active_requests", "", [*labels, "uri"], registry=registry),
+        ioloop_lag=pc.Histogram("ioloop_lag", "", [*labels, "loop"], registry=registry),
+        ioloop_blocked=pc.Counter("ioloop_blocked", "", [*labels, "loop", "handler"], registry=registry),
+        handler_loop_seconds=pc.Counter("handler_loop_seconds", "", [*labels, "handler"], registry=registry),
+    ))
+    monkeypatch.setattr(metrics, "loop_monitor", loop_monitor.LoopMonitor(interval=0.02, block_threshold=0.15))
+    return registry
+
+
+def fetch(path: str):
+    async def main():
+        sock, port = testing.bind_unused_port()
+        app = web.Application([(r"/step", StepHandler), (r"/fail", FailHandler), (r"/block", BlockHandler)])
+        server = httpserver.HTTPServer(app)
+        server.add_sockets([sock])
+        client = httpclient.AsyncHTTPClient(force_instance=True)
+        try:
+            return await client.fetch(f"http://127.0.0.1:{port}{path}", raise_error=False)
+        finally:
+            client.close()
+            server.stop()
+    return asyncio.run(main())
+
+
+def loop_seconds(registry, handler: str) -> float:
+    return registry.get_sample_value("handler_loop_seconds_total", {"service": "test", "handler": handler}) or 0.0
+
+
+def test_handler_loop_time_excludes_await(registry):
+    assert fetch("/step").code == 200
+    elapsed = loop_seconds(registry, "StepHandler")
+    assert 0.1 <= elapsed < 0.2
+
+
+def test_handler_loop_time_recorded_on_error(registry):
+    assert fetch("/fail").code == 500
+    assert 0.05 <= loop_seconds(registry, "FailHandler") < 0.2
+
+
+def test_blocked_loop_reports_handler(registry, caplog):
+    with caplog.at_level(logging.WARNING, logger=""):
+        assert fetch("/block").code == 200
+
+    blocked = [s for m in registry.collect() for s in m.samples if s.name == "ioloop_blocked_total"]
+    assert [s.labels["handler"] for s in blocked] == ["BlockHandler"]
+    messages = [r.getMessage() for r in caplog.records if "blocked" in r.getMessage()]
+    assert any("BlockHandler GET /block" in message and "time.sleep" in message for message in messages)
+    assert registry.get_sample_value("ioloop_lag_count", {"service": "test", "loop": "MainThread"}) > 0
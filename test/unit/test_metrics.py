@@ -0,0 +1,176 @@
+import asyncio
+import gzip
+import logging
+import random
+import time
+from types import SimpleNamespace
+
+import prometheus_client as pc
+import pytest
+from tornado import httpclient, httpserver, httputil, testing, web
+
+from pybragi.base import metrics
+
+
+def make_manager():
+    registry = pc.CollectorRegistry()
+    return SimpleNamespace(
+        server_name="test",
+        request_histogram=pc.Histogram("latency", "", metrics.MetricsManager.server_labels,
+                                       buckets=metrics.MetricsManager.latency_buckets, registry=registry),
+        request_qps=pc.Counter("qps", "", metrics.MetricsManager.server_labels, registry=registry),
+        request_sketch=None,
+    ), registry
+
+
+def histogram_samples(registry):
+    return {(s.name, tuple(sorted(s.labels.items()))): s.value for m in registry.collect() for s in m.samples
+            if not s.name.endswith("_created")}
+
+
+def test_local_accumulate_matches_direct_observe():
+    direct_mgr, direct_registry = make_manager()
+    local_mgr, local_registry = make_manager()
+    direct = metrics.RequestRecorder(direct_mgr)
+    local = metrics.RequestRecorder(local_mgr, local_accumulate=True)
+
+    rng = random.Random(0)
+    for _ in range(2000):
+        route, status, latency = rng.choice(["/a", "/b"]), rng.choice([200, 500]), rng.expovariate(20)
+        direct.record(route, status, latency)
+        local.record(route, status, latency)
+    local.flush()
+
+    expected, actual = histogram_samples(direct_registry), histogram_samples(local_registry)
+    assert expected.keys() == actual.keys()
+    for key, value in expected.items():
+        assert actual[key] == pytest.approx(value), key
+
+
+class ItemHandler(metrics.PrometheusMixIn, web.RequestHandler):
+    pass
+
+
+class RawItemHandler(ItemHandler):
+    metrics_raw_path = True
+
+
+def make_handler(handler_class, path):
+    app = web.Application([(r"/items/\d+", ItemHandler), (r"/raw/.*", RawItemHandler)])
+    request = httputil.HTTPServerRequest(method="GET", uri=path, connection=SimpleNamespace(set_close_callback=lambda cb: None))
+    handler = handler_class(app, request)
+    handler.path_args, handler.path_kwargs = [], {}
+    return handler
+
+
+def test_route_of_defaults_to_route_pattern():
+    assert metrics.route_of(make_handler(ItemHandler, "/items/1")) == r"/items/\d+"
+    assert metrics.route_of(make_handler(ItemHandler, "/items/2")) == r"/items/\d+"
+    assert metrics.route_of(make_handler(RawItemHandler, "/raw/x")) == "/raw/x"
+
+
+class PostHandler(metrics.PrometheusMixIn, web.RequestHandler):
+    pass
+
+
+def test_large_json_body_logged_without_json_body(caplog):
+    app = web.Application([(r"/post", PostHandler)])
+    body = b'{"audio": "' + b"A" * 5000 + b'"}'
+    request = httputil.HTTPServerRequest(method="POST", uri="/post", body=body,
+                                         headers=httputil.HTTPHeaders({"Content-Type": "application/json"}),
+                                         connection=SimpleNamespace(set_close_callback=lambda cb: None))
+    handler = PostHandler(app, request)
+    handler.path_args, handler.path_kwargs = [], {}
+
+    with caplog.at_level(logging.INFO, logger=""):
+        asyncio.run(handler.prepare())
+    metrics.active_requests.discard(handler)
+
+    lines = [r.getMessage() for r in caplog.records if "part body" in r.getMessage()]
+    assert len(lines) == 1
+    assert lines[0].endswith(f"...({len(body)})")
+    assert len(lines[0]) < PostHandler.body_log_limit + 100
+
+
+def make_cache(**kwargs):
+    registry = pc.CollectorRegistry()
+    pc.Counter("scraped", "", registry=registry).inc()
+    cache = metrics.ExpositionCache(registry=registry, **kwargs)
+    renders = []
+    cache.hooks = [lambda: renders.append(time.monotonic())]
+    return cache, renders
+
+
+def age(cache, content_type, seconds):
+    rendered_at, body, gzipped = cache.cache[content_type]
+    cache.cache[content_type] = (rendered_at - seconds, body, gzipped)
+
+
+def test_exposition_cache_ttl_hit():
+    cache, renders = make_cache(ttl=60, max_stale=120)
+    content_type, first = cache.get()
+    _, second = cache.get()
+    assert second is first
+    assert len(renders) == 1
+    assert b"scraped_total 1.0" in first[1]
+    assert gzip.decompress(first[2]) == first[1]
+
+    # text 和 openmetrics 分别缓存
+    openmetrics, entry = cache.get("application/openmetrics-text; version=1.0.0")
+    assert openmetrics != content_type and "openmetrics" in openmetrics
+    assert entry[1].endswith(b"# EOF\n")
+    assert len(renders) == 2
+
+
+def test_exposition_cache_stale_refreshes_in_background():
+    cache, renders = make_cache(ttl=60, max_stale=120)
+    content_type, first = cache.get()
+    age(cache, content_type, 61)
+
+    _, cached, need_render = cache.lookup("")
+    assert not need_render and cached[1] == first[1] # 先返回旧结果
+    deadline = time.monotonic() + 2
+    while len(renders) < 2 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert len(renders) == 2
+    assert cache.cache[content_type] is not cached
+
+
+def test_exposition_cache_too_stale_renders_sync():
+    cache, renders = make_cache(ttl=60, max_stale=120)
+    content_type, first = cache.get()
+    age(cache, content_type, 121)
+
+    _, cached, need_render = cache.lookup("")
+    assert need_render
+    _, second = cache.get()
+    assert second is not first
+    assert len(renders) == 2
+
+
+def test_metrics_handler_gzip():
+    cache, _ = make_cache(ttl=60, max_stale=120)
+
+    class Handler(metrics.MetricsHandler):
+        pass
+    Handler.cache = cache
+
+    async def main():
+        sock, port = testing.bind_unused_port()
+        server = httpserver.HTTPServer(web.Application([(r"/metrics", Handler)]))
+        server.add_sockets([sock])
+        client = httpclient.AsyncHTTPClient(force_instance=True)
+        try:
+            url = f"http://127.0.0.1:{port}/metrics"
+            plain = await client.fetch(url)
+            gzipped = await client.fetch(url, headers={"Accept-Encoding": "gzip"}, decompress_response=False)
+            return plain, gzipped
+        finally:
+            client.close()
+            server.stop()
+
+    plain, gzipped = asyncio.run(main())
+    assert "Content-Encoding" not in plain.headers
+    assert gzipped.headers["Content-Encoding"] == "gzip"
+    assert gzip.decompress(gzipped.body) == plain.body
+    assert "Accept-Encoding" in gzipped.headers["Vary"]
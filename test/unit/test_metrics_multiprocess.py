@@ -0,0 +1,69 @@
+import json
+import os
+import subprocess
+import sys
+import textwrap
+
+from pybragi.base import metrics_multiprocess
+
+
+root = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# enable_multiprocess 修改进程级全局状态 (ValueClass / 环境变量 / exposition_cache)  在子进程中运行
+worker_script = textwrap.dedent("""
+    import json, os, sys
+    from pybragi.base import metrics_multiprocess
+    metrics_multiprocess.enable_multiprocess(sys.argv[1])
+
+    import prometheus_client as pc
+    from pybragi.base import metrics
+    requests = pc.Counter("requests", "", ["worker"])
+    busy = pc.Gauge("busy", "", multiprocess_mode="livesum")
+    busy.set(1)
+
+    children = []
+    for i in range(2):
+        pid = os.fork()
+        if pid == 0:
+            requests.labels("child").inc(i + 1)
+            busy.set(10)
+            os._exit(0)
+        children.append(pid)
+    for pid in children:
+        os.waitpid(pid, 0)
+    requests.labels("parent").inc()
+
+    def samples(body):
+        return [line for line in body.decode().splitlines() if line.startswith(("requests_total", "busy "))]
+
+    before = samples(pc.generate_latest(metrics_multiprocess.registry))
+    _, (_, body, _) = metrics.exposition_cache.get() # 渲染前的 hook 清理已退出进程的 live gauge
+    print(json.dumps({"before": before, "after": samples(body)}))
+""")
+
+
+def test_enable_multiprocess_merges_forked_workers(tmp_path):
+    env = {**os.environ, "PYTHONPATH": root}
+    env.pop("PROMETHEUS_MULTIPROC_DIR", None)
+    env.pop("prometheus_multiproc_dir", None)
+    output = subprocess.run([sys.executable, "-c", worker_script, str(tmp_path)], env=env, capture_output=True,
+                            text=True, timeout=60, check=True).stdout
+    result = json.loads(output.strip().splitlines()[-1])
+
+    assert 'requests_total{worker="child"} 3.0' in result["before"] # 两个 worker 的计数相加
+    assert 'requests_total{worker="parent"} 1.0' in result["before"]
+    assert "busy 21.0" in result["before"]
+    # 退出的 worker 不再计入 live gauge  counter 保留
+    assert "busy 1.0" in result["after"]
+    assert 'requests_total{worker="child"} 3.0' in result["after"]
+
+
+def test_clear_stale_files(tmp_path):
+    dead = subprocess.Popen([sys.executable, "-c", "pass"])
+    dead.wait()
+    for pid in (dead.pid, os.getpid()):
+        (tmp_path / f"counter_{pid}.db").write_bytes(b"")
+        (tmp_path / f"sketch_latency_{pid}.json").write_text("{}")
+
+    metrics_multiprocess.clear_stale_files(str(tmp_path))
+    assert sorted(p.name for p in tmp_path.iterdir()) == [f"counter_{os.getpid()}.db", f"sketch_latency_{os.getpid()}.json"]
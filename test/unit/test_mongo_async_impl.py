@@ -0,0 +1,73 @@
+import asyncio
+
+import pytest
+
+pytest.importorskip("motor")
+mongomock_motor = pytest.importorskip("mongomock_motor")
+
+from pybragi.store import mongo_async_impl
+
+
+@pytest.fixture
+def store(monkeypatch):
+    monkeypatch.setattr(mongo_async_impl, "AsyncIOMotorClient", mongomock_motor.AsyncMongoMockClient)
+    monkeypatch.setattr(mongo_async_impl.MongoAsyncOnline, "clients", mongo_async_impl.weakref.WeakKeyDictionary())
+    monkeypatch.setattr(mongo_async_impl.MongoAsyncOnline, "url", "")
+    mongo_async_impl.new_store("mongodb://mock", "test", 4)
+
+
+def test_not_configured(monkeypatch):
+    monkeypatch.setattr(mongo_async_impl.MongoAsyncOnline, "url", "")
+
+    async def main():
+        mongo_async_impl.get_client()
+
+    with pytest.raises(Exception, match="not initialized"):
+        asyncio.run(main())
+
+
+def test_client_per_loop(store):
+    async def main():
+        client = mongo_async_impl.get_client()
+        assert mongo_async_impl.get_client() is client
+        return client
+
+    first, second = asyncio.run(main()), asyncio.run(main())
+    assert first is not second # 每个 loop 各自创建 client
+
+    async def close():
+        client = mongo_async_impl.get_client()
+        mongo_async_impl.close_store()
+        assert mongo_async_impl.get_client() is not client
+
+    asyncio.run(close())
+
+
+def test_claim_ack_release(store):
+    async def main():
+        await mongo_async_impl.insert_items("q", [{"_id": i, "processed": False} for i in range(5)])
+        condition = {"processed": False}
+
+        token, items = await mongo_async_impl.claim_batch_items("q", condition, batch_size=3)
+        assert [item["_id"] for item in items] == [0, 1, 2]
+        # 已认领且未过期的不会被再次认领
+        other, rest = await mongo_async_impl.claim_batch_items("q", condition, batch_size=3)
+        assert [item["_id"] for item in rest] == [3, 4]
+
+        await mongo_async_impl.ack_claimed_items("q", token, ids=[0, 1])
+        await mongo_async_impl.release_claimed_items("q", token, ids=[2])
+        await mongo_async_impl.release_claimed_items("q", other)
+        assert await mongo_async_impl.count("q", {"processed": True}) == 2
+
+        _, again = await mongo_async_impl.claim_batch_items("q", condition, batch_size=10)
+        return [item["_id"] for item in again]
+
+    assert asyncio.run(main()) == [2, 3, 4]
+
+
+def test_iter_items(store):
+    async def main():
+        await mongo_async_impl.insert_items("it", [{"_id": i, "v": -i} for i in range(7)])
+        return [item["_id"] async for item in mongo_async_impl.iter_items("it", {}, sort=[("v", 1)], batch_size=2)]
+
+    assert asyncio.run(main()) == [6, 5, 4, 3, 2, 1, 0]
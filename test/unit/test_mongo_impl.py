@@ -0,0 +1,48 @@
+import pytest
+
+mongomock = pytest.importorskip("mongomock")
+
+from pybragi.store import mongo_impl
+
+
+@pytest.fixture
+def db(monkeypatch):
+    db = mongomock.MongoClient()["test"]
+    monkeypatch.setattr(mongo_impl, "get_db", lambda: db)
+    db["p"].insert_many([{"_id": i, "rank": i % 3, "name": f"n{i}", "blob": "x" * 10} for i in range(7)])
+    return db
+
+
+def collect(**kwargs):
+    pages, after = [], None
+    while True:
+        items, after = mongo_impl.query_page("p", {}, after, limit=2, **kwargs)
+        pages.append(items)
+        if after is None:
+            return [item for page in pages for item in page]
+
+
+@pytest.mark.parametrize("projection", [{"_id": 0}, {"blob": 0, "_id": 0}, {"rank": 0}, {"rank": 0, "_id": 0}])
+def test_exclusion_projection_keeps_cursor(db, projection):
+    items = collect(key="rank", projection=projection)
+    assert len(items) == 7
+    for field, value in projection.items():
+        assert all(field not in item for item in items)
+    assert all("name" in item for item in items)
+
+
+@pytest.mark.parametrize("projection, fields", [
+    ({"name": 1}, {"_id", "name"}),
+    ({"name": 1, "_id": 0}, {"name"}),
+    ({"name": 1, "rank": 1}, {"_id", "name", "rank"}),
+])
+def test_inclusion_projection_keeps_cursor(db, projection, fields):
+    items = collect(key="rank", projection=projection)
+    assert len(items) == 7
+    assert all(set(item) == fields for item in items)
+
+
+def test_pages_in_key_order(db):
+    items = collect(key="rank")
+    assert [(item["rank"], item["_id"]) for item in items] == sorted((i % 3, i) for i in range(7))
+    assert [item["name"] for item in collect(projection={"_id": 0, "blob": 0})] == [f"n{i}" for i in range(7)]
@@ -0,0 +1,65 @@
+import asyncio
+import threading
+import time
+
+from pybragi.base.shutdown import global_exit_event
+from pybragi.store import mongo_impl, mongo_write_buffer
+
+
+class SlowCollection:
+    def __init__(self, release: threading.Event):
+        self.release = release
+        self.docs = []
+
+    def insert_many(self, docs, ordered=False):
+        self.release.wait(5)
+        self.docs.extend(docs)
+
+
+def test_put_on_event_loop_never_blocks(monkeypatch):
+    release = threading.Event()
+    collection = SlowCollection(release)
+    monkeypatch.setattr(mongo_impl, "get_db", lambda: {"t": collection})
+
+    buffer = mongo_write_buffer.WriteBehindBuffer(max_batch=1, flush_interval=0.01, max_pending=2, block_timeout=1.0)
+    buffer.start()
+    try:
+        async def main():
+            start = time.perf_counter()
+            results = [buffer.put("t", {"i": i}) for i in range(10)]
+            return results, time.perf_counter() - start
+
+        results, elapsed = asyncio.run(main())
+        assert elapsed < 0.5
+        assert not all(results)
+        assert buffer.stats["dropped"] == results.count(False)
+        assert buffer.stats["caller_runs"] == 0
+    finally:
+        release.set()
+        buffer.close()
+    assert len(collection.docs) == results.count(True)
+
+
+def test_put_during_shutdown_drain_is_written(monkeypatch):
+    release = threading.Event()
+    release.set()
+    collection = SlowCollection(release)
+    monkeypatch.setattr(mongo_impl, "get_db", lambda: {"t": collection})
+
+    buffer = mongo_write_buffer.WriteBehindBuffer(flush_interval=0.01)
+    buffer.start()
+    global_exit_event().set()
+    try:
+        async def main():
+            return [buffer.put("t", {"i": i}) for i in range(5)]
+        assert all(asyncio.run(main()))
+        for _ in range(100): # 退出期间写线程仍在工作  不需要等 close
+            if len(collection.docs) == 5:
+                break
+            time.sleep(0.01)
+        assert len(collection.docs) == 5
+    finally:
+        global_exit_event().clear()
+        buffer.close()
+    assert buffer.stats["dropped"] == 0
+    assert len(collection.docs) == 5
@@ -0,0 +1,61 @@
+import asyncio
+import threading
+
+import pytest
+
+pytest.importorskip("asyncpg")
+
+from pybragi.store.postgre_discovery import PostgreDiscoveryStore
+
+
+class LoopBoundDb:
+    """模拟绑定在创建 loop 上的连接池  在其他 loop 上使用直接报错"""
+    def __init__(self, loop: asyncio.AbstractEventLoop):
+        self.loop = loop
+        self.calls = []
+
+    def _check(self, sql: str):
+        assert asyncio.get_running_loop() is self.loop, "pool used from a foreign loop"
+        self.calls.append(" ".join(sql.split())[:20])
+
+    async def execute(self, sql, params=None):
+        self._check(sql)
+
+    async def execute_many(self, sql, rows):
+        self._check(sql)
+
+    async def query(self, sql, params=None, multirows=False):
+        self._check(sql)
+        if multirows:
+            return [{"ipv4": "127.0.0.1", "port": 8000, "name": "svc", "type": "", "status": "online", "datetime": "", "expire_at": None}]
+        return {"count": 1, "updated_at": None, "token": 1}
+
+
+@pytest.fixture
+def store():
+    loop = asyncio.new_event_loop()
+    thread = threading.Thread(target=loop.run_forever, daemon=True)
+    thread.start()
+    yield PostgreDiscoveryStore(LoopBoundDb(loop), loop)
+    loop.call_soon_threadsafe(loop.stop)
+    thread.join()
+    loop.close()
+
+
+def test_async_api_from_another_loop(store):
+    async def main():
+        await store.aregister_server("127.0.0.1", 8000, "svc")
+        await store.aheartbeat_servers([("127.0.0.1", 8000, "svc", "")], ttl=10)
+        servers = await store.aget_server_online("svc")
+        token = await store.aacquire_lease("leader", "me", ttl=10)
+        return servers, token
+
+    servers, token = asyncio.run(main())
+    assert servers == [{"ipv4": "127.0.0.1", "port": 8000, "name": "svc", "type": "", "status": "online", "datetime": ""}]
+    assert token == 1
+    assert len(store.db.calls) == 4
+
+
+def test_sync_api(store):
+    assert store.get_server_online("svc")[0]["port"] == 8000
+    assert store.etag() == (1, None)
@@ -0,0 +1,255 @@
+import asyncio
+from contextlib import asynccontextmanager
+from types import SimpleNamespace
+
+import prometheus_client as pc
+import pytest
+
+pytest.importorskip("asyncpg")
+
+from pybragi.base import metrics
+from pybragi.store import postgre_impl
+
+
+class FakeRecord:
+    """和 asyncpg.Record 一样  按列名/下标取值  迭代得到值"""
+    def __init__(self, **values):
+        self._values = values
+
+    def keys(self):
+        return self._values.keys()
+
+    def __getitem__(self, key):
+        if isinstance(key, int):
+            return list(self._values.values())[key]
+        return self._values[key]
+
+    def __iter__(self):
+        return iter(self._values.values())
+
+
+class FakeCursor:
+    """connection.cursor(): async for 逐行  await 后 fetch(n) 分批"""
+    def __init__(self, rows):
+        self.rows = list(rows)
+
+    async def __aiter__(self):
+        for row in self.rows:
+            yield row
+
+    def __await__(self):
+        if False:
+            yield
+        return self
+
+    async def fetch(self, n):
+        rows, self.rows = self.rows[:n], self.rows[n:]
+        return rows
+
+
+class FakeConnection:
+    def __init__(self, rows=()):
+        self.calls = []
+        self.rows = list(rows)
+        self.in_transaction = False
+
+    @asynccontextmanager
+    async def transaction(self):
+        self.in_transaction = True
+        try:
+            yield
+        finally:
+            self.in_transaction = False
+
+    def cursor(self, sql, *args, prefetch=None):
+        assert self.in_transaction, "cursor requires a transaction"
+        self.calls.append(("cursor", sql, args, prefetch))
+        return FakeCursor(self.rows)
+
+    async def executemany(self, sql, args, timeout=None):
+        self.calls.append(("executemany", sql, list(args)))
+
+    async def copy_records_to_table(self, table_name, records, columns=None, schema_name=None, timeout=None):
+        self.calls.append(("copy", table_name, records, columns))
+        return f"COPY {len(records)}"
+
+
+class FakePool:
+    def __init__(self, rows=()):
+        self.connection = FakeConnection(rows)
+        self.closed = False
+
+    @asynccontextmanager
+    async def acquire(self):
+        yield self.connection
+
+    async def close(self):
+        self.closed = True
+
+    def get_size(self):
+        return 1
+
+    def get_idle_size(self):
+        return 1
+
+    def get_max_size(self):
+        return 10
+
+
+rows = [FakeRecord(id=i, name=f"n{i}", score=i / 2) for i in range(5)]
+
+
+def make_db(rows=()) -> postgre_impl.PostgreImpl:
+    db = postgre_impl.PostgreImpl("127.0.0.1", 5432, "test", "user", "password")
+    db.pool = FakePool(rows)
+    return db
+
+
+def test_execute_many_converts_rows():
+    db = make_db()
+
+    async def main():
+        await db.execute_many("INSERT INTO t VALUES ($1, $2)", [{"a": 1, "b": 2}, (3, 4)])
+        await db.execute_many("INSERT INTO t VALUES ($1, $2)", []) # 空数据不占用连接
+
+    asyncio.run(main())
+    assert db.pool.connection.calls == [("executemany", "INSERT INTO t VALUES ($1, $2)", [(1, 2), (3, 4)])]
+
+
+def test_copy_records_from_dicts():
+    db = make_db()
+
+    async def main():
+        empty = await db.copy_records_to_table("t", [])
+        result = await db.copy_records_to_table("t", [{"a": 1, "b": "x"}, {"b": "y", "a": 2}])
+        picked = await db.copy_records_to_table("t", [{"a": 3, "b": "z"}], columns=["b"])
+        return empty, result, picked
+
+    assert asyncio.run(main()) == ("COPY 0", "COPY 2", "COPY 1")
+    calls = db.pool.connection.calls
+    assert calls[0] == ("copy", "t", [(1, "x"), (2, "y")], ["a", "b"]) # 按第一条的 key 顺序取列
+    assert calls[1] == ("copy", "t", [("z",)], ["b"])
+
+
+def test_cursor_streams_rows():
+    db = make_db(rows)
+
+    async def main():
+        dicts = [row async for row in db.cursor("SELECT * FROM t WHERE id < $1", {"id": 10}, prefetch=2)]
+        records = [row async for row in db.cursor("SELECT * FROM t", record=True)]
+        return dicts, records
+
+    dicts, records = asyncio.run(main())
+    assert dicts == [{"id": i, "name": f"n{i}", "score": i / 2} for i in range(5)]
+    assert records == rows
+    assert db.pool.connection.calls[0] == ("cursor", "SELECT * FROM t WHERE id < $1", (10,), 2)
+
+
+def test_format_rows():
+    assert postgre_impl.format_rows(rows, "record") is rows
+    assert postgre_impl.format_rows(rows, "dict")[1] == {"id": 1, "name": "n1", "score": 0.5}
+    assert postgre_impl.format_rows(rows, "tuple")[2] == (2, "n2", 1.0)
+    assert postgre_impl.format_rows(rows, "columns") == {
+        "id": (0, 1, 2, 3, 4), "name": ("n0", "n1", "n2", "n3", "n4"), "score": (0.0, 0.5, 1.0, 1.5, 2.0),
+    }
+
+    columns = postgre_impl.format_rows(rows, "numpy")
+    assert columns["id"].tolist() == [0, 1, 2, 3, 4]
+    assert columns["score"].dtype.kind == "f"
+    assert columns["score"].sum() == pytest.approx(5.0)
+
+
+@pytest.mark.parametrize("row_format", ["dict", "tuple", "columns", "numpy"])
+def test_format_rows_empty(row_format):
+    assert not postgre_impl.format_rows([], row_format)
+
+
+def test_format_rows_unknown():
+    with pytest.raises(ValueError):
+        postgre_impl.format_rows(rows, "pandas")
+
+
+def test_fetch_batches():
+    db = make_db(rows)
+
+    async def main():
+        return [batch async for batch in db.fetch_batches("SELECT * FROM t", batch_size=2, row_format="columns")]
+
+    batches = asyncio.run(main())
+    assert [batch["id"] for batch in batches] == [(0, 1), (2, 3), (4,)]
+
+
+@pytest.fixture
+def manager(monkeypatch):
+    async def initdb(self):
+        self.pool = FakePool()
+
+    monkeypatch.setattr(postgre_impl.PostgreImpl, "initdb", initdb)
+    monkeypatch.setattr(postgre_impl.ClientManager, "_config", None)
+    monkeypatch.setattr(postgre_impl.ClientManager, "_instances", postgre_impl.weakref.WeakKeyDictionary())
+    monkeypatch.setattr(postgre_impl.ClientManager, "_locks", postgre_impl.weakref.WeakKeyDictionary())
+    return postgre_impl.ClientManager
+
+
+def test_client_manager_not_initialized(manager):
+    with pytest.raises(Exception, match="not initialized"):
+        asyncio.run(manager.get_client())
+
+
+def test_client_manager_refcount(manager):
+    async def main():
+        await manager.init_client("127.0.0.1", 5432, "test", "user", "password")
+        first, second = await asyncio.gather(manager.get_client(), manager.get_client())
+        assert first is second # 同一个 loop 共用连接池
+        assert [stat["ref_count"] for stat in manager.pool_stats()] == [2]
+
+        await manager.release_client(first)
+        assert not first.pool.closed
+        await manager.release_client(second)
+        assert first.pool.closed # 计数归零关闭
+        assert manager.pool_stats() == []
+
+        third = await manager.get_client() # 关闭后重新建池
+        assert third is not first
+        await manager.release_client(third)
+
+    asyncio.run(main())
+
+
+def test_client_manager_per_loop(manager):
+    async def get():
+        return await manager.get_client()
+
+    async def init():
+        await manager.init_client("127.0.0.1", 5432, "test", "user", "password")
+        return await get()
+
+    first = asyncio.run(init())
+    second = asyncio.run(get()) # 其他 loop 按 init_client 的参数懒创建
+    assert first is not second
+    assert (second.host, second.database) == ("127.0.0.1", "test")
+
+    # 非当前 loop 的 db 直接关闭 不影响当前 loop 的计数
+    async def release_foreign():
+        own = await manager.get_client()
+        await manager.release_client(first)
+        return own
+
+    own = asyncio.run(release_foreign())
+    assert first.pool.closed and not own.pool.closed
+
+
+def test_acquire_reports_pool_metrics(monkeypatch):
+    registry = pc.CollectorRegistry()
+    monkeypatch.setattr(metrics, "metrics_manager", SimpleNamespace(
+        pg_pool_connections=pc.Gauge("pg_pool_connections", "", ["pool", "state"], registry=registry),
+        pg_acquire_wait=pc.Histogram("pg_acquire_wait", "", ["pool"], registry=registry),
+        pg_query_latency=pc.Histogram("pg_query_latency", "", ["pool", "op"], registry=registry),
+    ))
+    db = make_db()
+    asyncio.run(db.execute_many("INSERT INTO t VALUES ($1)", [(1,), (2,)]))
+
+    pool = {"pool": db.pool_label}
+    assert registry.get_sample_value("pg_acquire_wait_count", pool) == 1
+    assert registry.get_sample_value("pg_query_latency_count", {**pool, "op": "execute_many"}) == 1
+    assert registry.get_sample_value("pg_pool_connections", {**pool, "state": "idle"}) == 1
@@ -0,0 +1,80 @@
+import os
+import random
+import threading
+
+import pytest
+
+from pybragi.base import metrics_multiprocess
+from pybragi.base.sketch import DDSketch, SketchSummary, merge_sketches
+
+
+def exact_quantile(values, q):
+    values = sorted(values)
+    return values[int(q * (len(values) - 1))]
+
+
+@pytest.mark.parametrize("q", [0.01, 0.5, 0.9, 0.99, 0.999])
+def test_relative_accuracy(q):
+    rng = random.Random(1)
+    values = [rng.lognormvariate(-3, 1.5) for _ in range(20000)]
+    sketch = DDSketch(0.01)
+    sketch.add_many(values)
+    assert sketch.quantile(q) == pytest.approx(exact_quantile(values, q), rel=0.01)
+
+
+def test_merge_equals_single_sketch():
+    rng = random.Random(2)
+    parts = [[rng.expovariate(10) for _ in range(5000)] for _ in range(4)]
+    whole = DDSketch()
+    for part in parts:
+        whole.add_many(part)
+
+    sketches = []
+    for part in parts:
+        sketch = DDSketch()
+        sketch.add_many(part)
+        sketches.append(DDSketch.from_dict(sketch.to_dict()))
+    merged = merge_sketches(sketches)
+
+    assert merged.count == whole.count
+    assert merged.bins == whole.bins
+    assert merged.quantiles([0.5, 0.99]) == whole.quantiles([0.5, 0.99])
+
+
+def test_merge_rejects_different_accuracy():
+    with pytest.raises(ValueError):
+        DDSketch(0.01).merge(DDSketch(0.02))
+
+
+def test_bin_count():
+    sketch = DDSketch(0.01)
+    value = 1e-6
+    while value < 50:
+        sketch.add(value)
+        value *= 1.001
+    assert 880 <= len(sketch.bins) <= 890
+
+
+def test_dump_dirty_concurrent_observe(tmp_path, monkeypatch):
+    monkeypatch.setattr(metrics_multiprocess, "multiproc_dir", str(tmp_path))
+    monkeypatch.setattr(SketchSummary, "_dump_pid", os.getpid()) # 不启动后台线程 由测试线程 dump
+    summaries = [SketchSummary(f"dirty_{i}", "", registry=None) for i in range(8)]
+    dumped = []
+    for summary in summaries:
+        monkeypatch.setattr(summary, "dump", lambda s=summary: dumped.append(s))
+
+    stop = threading.Event()
+    def observe():
+        while not stop.is_set():
+            for summary in summaries:
+                summary.labels().observe(0.1)
+    threads = [threading.Thread(target=observe) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for _ in range(200):
+        SketchSummary._dump_dirty() # 并发修改集合时不能抛 RuntimeError
+    stop.set()
+    for thread in threads:
+        thread.join()
+    SketchSummary._dump_dirty()
+    assert set(dumped) == set(summaries)
@@ -0,0 +1,25 @@
+import time
+
+import pytest
+
+from pybragi.base.metrics import StreamMetrics
+
+
+def test_max_itl_during_stream():
+    metrics = StreamMetrics("req", time.time(), 10)
+    metrics.output_token()
+    assert metrics.dict()["max_itl"] == float("inf") # 只有一个 token 还没有间隔
+
+    time.sleep(0.02)
+    metrics.output_token()
+    first = metrics.dict()["max_itl"]
+    assert 0.02 <= first < 1
+    assert "max_itl:inf" not in str(metrics)
+
+    metrics.output_token() # 更短的间隔不影响最大值
+    assert metrics.max_token_delta == first
+
+    metrics.finish_infer()
+    assert metrics.max_token_delta == first
+    assert metrics.itl_p99 == pytest.approx(first, rel=1e-6)
+    assert metrics.delta_count == 2